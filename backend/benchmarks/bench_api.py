@@ -0,0 +1,185 @@
+# Drives every route of the API, /login included, one after the other against a
+# running server seeded by seed.py, each for --duration seconds with --concurrency
+# clients sending requests back to back:
+#   python benchmarks/bench_api.py --url http://127.0.0.1:8080 --rows 1000000 --cities 1000 --server-pid 1234
+# --rows and --cities must match the seed, they pick the ids and cities requested.
+# Routes that return the whole table run with a single client. With --server-pid
+# the resident memory of the server is reported after each route.
+import argparse
+import asyncio
+import os
+import random
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import login, process_rss, summarize, write_results
+from seed import city_coordinates, city_name
+
+DELETE_POOL_SIZE = 5000
+
+
+def reading(rng, cities):
+    city = rng.randrange(cities)
+    lat, lon = city_coordinates(city)
+    return {
+        'city_name': city_name(city), 'latitude': lat, 'longitude': lon,
+        'temperature': round(rng.uniform(-10, 35), 2), 'feels_like': round(rng.uniform(-15, 38), 2),
+        'humidity': rng.randint(20, 100), 'pressure': rng.randint(980, 1040), 'description': 'benchmark',
+    }
+
+
+def scenarios(args, deletable):
+    # (name, Flask rule, method, request factory, single client). A factory returns
+    # the path and JSON body of the next request, or None when it has nothing left.
+    rng = random.Random(0)
+    today = datetime.utcnow().date()
+    day = lambda days: (today - timedelta(days=days)).isoformat()
+    city = lambda: city_name(rng.randrange(args.cities))
+    row_id = lambda: rng.randint(1, args.rows)
+
+    def point():
+        lat, lon = city_coordinates(rng.randrange(args.cities))
+        return min(max(lat + rng.uniform(-1, 1), -90), 90), min(max(lon + rng.uniform(-1, 1), -180), 180)
+
+    def nearest():
+        lat, lon = point()
+        return f'/weather/nearest?lat={lat:.4f}&lon={lon:.4f}&k=5', None
+
+    def bbox():
+        lat, lon = point()
+        return f'/weather/bbox?min_lat={max(lat - 10, -90):.4f}&min_lon={max(lon - 10, -180):.4f}' \
+               f'&max_lat={min(lat + 10, 90):.4f}&max_lon={min(lon + 10, 180):.4f}', None
+
+    def patch():
+        return '/weather', {**reading(rng, args.cities), 'id': row_id()}
+
+    def delete():
+        return (f'/weather/{deletable.pop()}', None) if deletable else None
+
+    return [
+        ('login', '/login', 'POST', lambda: ('/login', {'username': args.username, 'password': args.password}), False),
+        ('weather_page', '/weather', 'GET', lambda: (f'/weather?limit=100&after_id={row_id()}', None), False),
+        ('weather_page_columnar', '/weather', 'GET', lambda: (f'/weather?limit=1000&after_id={row_id()}&format=columnar', None), False),
+        ('weather_all', '/weather', 'GET', lambda: ('/weather', None), True),
+        ('weather_stream_ndjson', '/weather', 'GET', lambda: ('/weather?stream=ndjson', None), True),
+        ('weather_city_day', '/weather/city/<string:city>', 'GET', lambda: (f'/weather/city/{city()}?start_time={day(1)}&end_time={day(1)}', None), False),
+        ('weather_city_all', '/weather/city/<string:city>', 'GET', lambda: (f'/weather/city/{city()}', None), False),
+        ('weather_aggregate', '/weather/city/<string:city>/aggregate', 'GET', lambda: (f'/weather/city/{city()}/aggregate?bucket=1h&start_time={day(7)}', None), False),
+        ('weather_downsample', '/weather/city/<string:city>/downsample', 'GET', lambda: (f'/weather/city/{city()}/downsample?points=500', None), False),
+        ('weather_by_id', '/weather/<int:id>', 'GET', lambda: (f'/weather/{row_id()}', None), False),
+        ('weather_latest', '/weather/latest', 'GET', lambda: ('/weather/latest', None), False),
+        ('weather_latest_city', '/weather/latest', 'GET', lambda: (f'/weather/latest?city={city()}', None), False),
+        ('weather_latest_stats', '/weather/latest/stats', 'GET', lambda: ('/weather/latest/stats', None), False),
+        ('weather_nearest', '/weather/nearest', 'GET', nearest, False),
+        ('weather_bbox', '/weather/bbox', 'GET', bbox, False),
+        ('weather_export_arrow', '/weather/export', 'GET', lambda: (f'/weather/export?format=arrow&start_time={day(1)}', None), True),
+        ('weather_create', '/weather', 'POST', lambda: ('/weather', reading(rng, args.cities)), False),
+        ('weather_batch', '/weather/batch', 'POST', lambda: ('/weather/batch', [reading(rng, args.cities) for _ in range(100)]), False),
+        ('weather_update', '/weather', 'PATCH', patch, False),
+        ('weather_delete', '/weather/<int:id>', 'DELETE', delete, False),
+        ('health', '/health', 'GET', lambda: ('/health', None), False),
+        ('metrics', '/metrics', 'GET', lambda: ('/metrics', None), False),
+    ]
+
+
+async def load_route(http_client, method, next_request, connections, duration):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            request = next_request()
+            if request is None:
+                return
+            path, body = request
+            started = time.perf_counter()
+            try:
+                response = await http_client.request(method, path, json=body)
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            latencies.append(time.perf_counter() - started)
+            errors += failed
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(connections)))
+    return latencies, errors, time.perf_counter() - started
+
+
+async def create_deletable(http_client, cities, count):
+    # Rows for the DELETE route to remove, so that it does not eat into the seed
+    rng = random.Random(1)
+    ids = []
+    for first in range(0, count, 1000):
+        response = await http_client.post('/weather/batch', json=[reading(rng, cities) for _ in range(min(1000, count - first))])
+        ids += [row['id'] for row in response.json()['created']]
+    return ids
+
+
+def uncovered_routes(url, covered):
+    # Routes documented in the Swagger spec that no scenario requests
+    try:
+        spec = httpx.get(f'{url}/apispec_1.json', timeout=30).json()
+    except (httpx.HTTPError, ValueError):
+        return None
+    documented = {(method.upper(), path) for path, methods in spec.get('paths', {}).items() for method in methods}
+    covered = {(method, re.sub(r'<(?:\w+:)?(\w+)>', r'{\1}', rule)) for method, rule in covered}
+    return sorted(f'{method} {path}' for method, path in documented - covered)
+
+
+async def run(args):
+    token = login(args.url, args.username, args.password)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    results = []
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=300,
+                                 headers={'Authorization': f'Bearer {token}'}) as http_client:
+        deletable = await create_deletable(http_client, args.cities, DELETE_POOL_SIZE)
+        selected = [scenario for scenario in scenarios(args, deletable) if not args.route or scenario[0] in args.route]
+        for name, rule, method, next_request, single_client in selected:
+            connections = 1 if single_client else args.concurrency
+            latencies, errors, elapsed = await load_route(http_client, method, next_request, connections, args.duration)
+            result = summarize(name, latencies, elapsed, errors)
+            result.update({'route': f'{method} {rule}', 'connections': connections})
+            if args.server_pid:
+                rss = process_rss(args.server_pid)
+                result['server_rss_mb'] = round(rss / 2 ** 20, 1) if rss is not None else None
+            print(f"{name}: {result['rps']} req/s, p99 {result['p99_ms']} ms, {errors} errors", file=sys.stderr)
+            results.append(result)
+
+    uncovered = uncovered_routes(args.url, [(method, rule) for _, rule, method, _, _ in scenarios(args, [])])
+    if uncovered:
+        print(f"Routes without a scenario: {', '.join(uncovered)}", file=sys.stderr)
+    results.append({'name': 'route_coverage', 'uncovered': uncovered})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load every API route of a running server')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--rows', type=int, default=100000, help='rows in the seeded database')
+    parser.add_argument('--cities', type=int, default=100, help='cities in the seeded database')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of load per route')
+    parser.add_argument('--route', action='append', help='only run this scenario, repeat for several')
+    parser.add_argument('--server-pid', type=int)
+    parser.add_argument('--username', default='test')
+    parser.add_argument('--password', default='testtest')
+    parser.add_argument('--label', default='current')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    for result in results:
+        result['label'] = args.label
+    write_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# Measures what authentication costs per request, in process and without a
+# database: the same trivial route is requested without a token, with the stock
+# JWTManager and with CachedJWTManager, then the password check behind /login is
+# timed for each hash method:
+#   python benchmarks/bench_auth.py --requests 20000 --tokens 100
+#   python benchmarks/bench_auth.py --method scrypt --method pbkdf2:sha256:600000
+# --tokens spreads the requests over that many clients, each with its own token.
+import argparse
+import os
+import sys
+import time
+
+from flask import Flask, jsonify
+from flask_jwt_extended import JWTManager, create_access_token, jwt_required
+from werkzeug.security import check_password_hash, generate_password_hash
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import summarize, write_results
+from weather_auth import CachedJWTManager
+
+DEFAULT_METHODS = ['scrypt', 'pbkdf2:sha256:600000', 'pbkdf2:sha256:100000']
+
+
+def create_bench_app(manager_class):
+    app = Flask(__name__)
+    app.config['JWT_SECRET_KEY'] = 'benchmark-secret-benchmark-secret'
+
+    @app.route('/open')
+    def open_route():
+        return jsonify(ok=True)
+
+    @app.route('/protected')
+    @jwt_required()
+    def protected_route():
+        return jsonify(ok=True)
+
+    if manager_class is not None:
+        manager_class(app)
+    else:
+        JWTManager(app)
+    return app
+
+
+def measure_route(name, app, path, tokens, requests):
+    client = app.test_client()
+    headers = [{'Authorization': f'Bearer {token}'} for token in tokens] or [{}]
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for i in range(requests):
+        request_started = time.perf_counter()
+        response = client.get(path, headers=headers[i % len(headers)])
+        latencies.append(time.perf_counter() - request_started)
+        errors += response.status_code != 200
+    return summarize(name, latencies, time.perf_counter() - started, errors)
+
+
+def measure_tokens(args):
+    results = []
+    for name, manager_class, path in (
+        ('request_no_auth', None, '/open'),
+        ('request_jwt', JWTManager, '/protected'),
+        ('request_jwt_cached', CachedJWTManager, '/protected'),
+    ):
+        app = create_bench_app(manager_class)
+        with app.app_context():
+            tokens = [create_access_token(identity=f'user{i}') for i in range(args.tokens)] if path == '/protected' else []
+        measure_route(name, app, path, tokens, min(args.requests, 1000))  # warm up
+        result = measure_route(name, app, path, tokens, args.requests)
+        result['tokens'] = len(tokens)
+        results.append(result)
+
+    baseline = results[0]['p50_ms']
+    for result in results[1:]:
+        result['auth_overhead_p50_us'] = round((result['p50_ms'] - baseline) * 1000, 1)
+    return results
+
+
+def measure_logins(args):
+    results = []
+    for method in args.method:
+        password_hash = generate_password_hash('benchmark-password', method=method)
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(args.logins):
+            check_started = time.perf_counter()
+            check_password_hash(password_hash, 'benchmark-password')
+            latencies.append(time.perf_counter() - check_started)
+        result = summarize('login_password_check', latencies, time.perf_counter() - started)
+        result['method'] = password_hash.split('$', 1)[0]
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the authentication cost per request and per login')
+    parser.add_argument('--requests', type=int, default=20000, help='requests per variant')
+    parser.add_argument('--tokens', type=int, default=100, help='distinct tokens the requests cycle through')
+    parser.add_argument('--method', action='append', help='password hash method, repeat for several')
+    parser.add_argument('--logins', type=int, default=20, help='password checks per method')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+    args.method = args.method or DEFAULT_METHODS
+
+    write_results(measure_tokens(args) + measure_logins(args), args.output)
+
+
+if __name__ == '__main__':
+    main()
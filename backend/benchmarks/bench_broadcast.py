@@ -0,0 +1,113 @@
+# Connects thousands of Socket.IO clients to one or more workers, writes readings
+# through the API and measures how long each broadcast takes to reach every client.
+#   python benchmarks/bench_broadcast.py --clients 2000 --url http://127.0.0.1:8080 --url http://127.0.0.1:8081
+# Needs the asyncio Socket.IO client: pip install "python-socketio[asyncio_client]"
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+import zlib
+
+import requests
+import socketio
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import login, summarize, write_results
+
+
+async def connect_clients(urls, count, on_row):
+    clients = []
+    for i in range(count):
+        client = socketio.AsyncClient(reconnection=False)
+
+        async def handle_row(row):
+            on_row(row)
+
+        async def handle_rows(rows):
+            for row in rows:
+                on_row(row)
+
+        async def handle_batch(frame):
+            # Returning acknowledges the frame, so the server sends the next one
+            events = json.loads(zlib.decompress(frame['deflate'])) if 'deflate' in frame else frame['events']
+            for event, data in events:
+                if event == 'send_newdata':
+                    on_row(data)
+                elif event == 'send_newdata_batch':
+                    await handle_rows(data)
+            return True
+
+        client.on('send_newdata', handle_row, namespace='/data')
+        client.on('send_newdata_batch', handle_rows, namespace='/data')
+        client.on('batch', handle_batch, namespace='/data')
+        clients.append(client)
+
+    async def connect(i, client):
+        await client.connect(urls[i % len(urls)], namespaces=['/data'], transports=['websocket'], auth={'cities': ['*']})
+
+    for start in range(0, count, 200):
+        await asyncio.gather(*(connect(i, client) for i, client in enumerate(clients[start:start + 200], start)))
+    return clients
+
+
+async def run(args):
+    token = login(args.url[0])
+    sent_at = {}
+    latencies = []
+
+    def on_row(row):
+        started = sent_at.get(row.get('description'))
+        if started is not None:
+            latencies.append(time.perf_counter() - started)
+
+    clients = await connect_clients(args.url, args.clients, on_row)
+    print(f"{len(clients)} clients connected")
+
+    session = requests.Session()
+    session.headers['Authorization'] = f'Bearer {token}'
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    for i in range(args.messages):
+        marker = f'bench-{uuid.uuid4().hex}'
+        sent_at[marker] = time.perf_counter()
+        await loop.run_in_executor(None, lambda: session.post(f'{args.url[i % len(args.url)]}/weather', json={
+            'city_name': 'Benchmark', 'latitude': 0, 'longitude': 0, 'temperature': 20,
+            'feels_like': 20, 'humidity': 50, 'pressure': 1013, 'description': marker,
+        }))
+        await asyncio.sleep(args.interval)
+
+    await asyncio.sleep(args.settle)
+    elapsed = time.perf_counter() - started
+    await asyncio.gather(*(client.disconnect() for client in clients))
+
+    expected = args.clients * args.messages
+    result = summarize('broadcast_latency', latencies, elapsed)
+    result.update({
+        'clients': args.clients,
+        'workers': len(args.url),
+        'messages': args.messages,
+        'delivered': len(latencies),
+        'delivery_ratio': round(len(latencies) / expected, 4) if expected else 0.0,
+    })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure Socket.IO broadcast latency to many clients')
+    parser.add_argument('--url', action='append', help='worker URL, repeat for several workers')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--interval', type=float, default=0.5, help='seconds between writes')
+    parser.add_argument('--settle', type=float, default=5.0, help='seconds to wait for the last deliveries')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+    args.url = args.url or ['http://127.0.0.1:8080']
+
+    write_results([asyncio.run(run(args))], args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# Holds N concurrent connections against a running server: idle Socket.IO clients
+# on /data plus N HTTP clients sending requests back to back for --duration seconds.
+# Run it against both deployment modes with a different --label:
+#   python weather.py                                  (threaded, port 8080)
+#   uvicorn weather_asgi:app --port 8081               (ASGI)
+#   python benchmarks/bench_concurrency.py --url http://127.0.0.1:8080 --label threaded --output bench.jsonl
+#   python benchmarks/bench_concurrency.py --url http://127.0.0.1:8081 --label asgi --output bench.jsonl
+# Run the benchmark on another machine than the server, the client is CPU-bound too.
+# Needs the asyncio Socket.IO client: pip install "python-socketio[asyncio_client]"
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import httpx
+import socketio
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import login, summarize, write_results
+
+
+async def hold_sockets(url, count):
+    clients = [socketio.AsyncClient(reconnection=False) for _ in range(count)]
+
+    async def connect(client):
+        try:
+            await client.connect(url, namespaces=['/data'], transports=['websocket'], auth={'cities': ['*']})
+            return True
+        except socketio.exceptions.ConnectionError:
+            return False
+
+    connected = 0
+    for start in range(0, count, 200):
+        connected += sum(await asyncio.gather(*(connect(client) for client in clients[start:start + 200])))
+    return clients, connected
+
+
+async def load_route(url, path, token, connections, duration):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60,
+                                 headers={'Authorization': f'Bearer {token}'}) as http_client:
+        async def worker():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    response = await http_client.get(path)
+                    failed = response.status_code >= 400
+                except httpx.HTTPError:
+                    failed = True
+                latencies.append(time.perf_counter() - started)
+                errors += failed
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(connections)))
+        elapsed = time.perf_counter() - started
+
+    return summarize(path, latencies, elapsed, errors)
+
+
+async def run(args):
+    token = login(args.url)
+    clients, connected = await hold_sockets(args.url, args.sockets)
+    print(f"{connected}/{args.sockets} Socket.IO clients connected")
+
+    results = []
+    for path in args.path:
+        result = await load_route(args.url, path, token, args.connections, args.duration)
+        result.update({'label': args.label, 'connections': args.connections, 'sockets': connected})
+        results.append(result)
+
+    await asyncio.gather(*(client.disconnect() for client in clients if client.connected))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure latency and throughput under many concurrent connections')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--path', action='append', help='route to load, repeat for several')
+    parser.add_argument('--connections', type=int, default=1000, help='concurrent HTTP clients')
+    parser.add_argument('--sockets', type=int, default=1000, help='idle Socket.IO clients held open meanwhile')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds of load per route')
+    parser.add_argument('--label', default='current')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+    args.path = args.path or ['/weather/latest', '/weather/city/Paris?start_time=2024-03-01']
+
+    write_results(asyncio.run(run(args)), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# Compares the size and throughput of the Arrow IPC and Parquet exports with the
+# JSON served by GET /weather, on synthetic rows and without the database.
+#   python benchmarks/bench_export.py --rows 1000000
+# Rows are generated while they are written, the same way for every format.
+# Needs pyarrow: pip install pyarrow
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import write_results
+from weather_export import EXPORT_BATCH_SIZE, read_export, write_export
+from weather_serialize import dumps, format_timestamps
+
+CITIES = 50
+DESCRIPTIONS = ('clear sky', 'few clouds', 'scattered clouds', 'broken clouds', 'light rain', 'mist')
+START_MS = 1704067200000
+
+
+def synthetic_batches(count, batch_size):
+    # Rows as fetch_export_rows returns them: one reading per city every 5 minutes
+    rng = random.Random(count)
+    for first in range(0, count, batch_size):
+        yield [
+            {
+                'id': i + 1,
+                'city_name': f'City {i % CITIES}',
+                'latitude': (i % CITIES) * 1.7 - 40,
+                'longitude': (i % CITIES) * 3.1 - 80,
+                'temperature': round(rng.uniform(-10, 35), 2),
+                'feels_like': round(rng.uniform(-15, 38), 2),
+                'humidity': rng.randint(20, 100),
+                'pressure': rng.randint(980, 1040),
+                'description': rng.choice(DESCRIPTIONS),
+                'timestamp': START_MS + 5 * 60 * 1000 * (i // CITIES),
+            }
+            for i in range(first, min(first + batch_size, count))
+        ]
+
+
+def json_export(batches):
+    # Same shape as GET /weather?stream=json
+    yield b'['
+    first = True
+    for rows in batches:
+        stamps = format_timestamps([datetime.fromtimestamp(row['timestamp'] / 1000, timezone.utc) for row in rows])
+        for row, stamp in zip(rows, stamps):
+            row['timestamp'] = stamp
+        chunk = dumps(rows)[1:-1]
+        yield chunk if first else b',' + chunk
+        first = False
+    yield b']'
+
+
+def measure_write(name, chunks, path, rows):
+    started = time.perf_counter()
+    with open(path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    elapsed = time.perf_counter() - started
+    return {
+        'name': f'write_{name}',
+        'rows': rows,
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(rows / elapsed),
+        'bytes': os.path.getsize(path),
+    }
+
+
+def measure_read(name, path, rows):
+    started = time.perf_counter()
+    read = sum(len(batch) for batch in read_export(path))
+    elapsed = time.perf_counter() - started
+    return {'name': f'read_{name}', 'rows': read, 'seconds': round(elapsed, 3), 'rows_per_second': round(rows / elapsed)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare export size and throughput with JSON')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--batch-size', type=int, default=EXPORT_BATCH_SIZE)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        json_path = os.path.join(directory, 'weather.json')
+        results.append(measure_write('json', json_export(synthetic_batches(args.rows, args.batch_size)), json_path, args.rows))
+        for export_format in ('arrow', 'parquet'):
+            path = os.path.join(directory, f'weather.{export_format}')
+            chunks = write_export(synthetic_batches(args.rows, args.batch_size), export_format)
+            results.append(measure_write(export_format, chunks, path, args.rows))
+            results.append(measure_read(export_format, path, args.rows))
+    write_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
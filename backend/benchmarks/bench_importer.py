@@ -0,0 +1,104 @@
+# Times one importer cycle for N cities against the local OpenWeatherMap stub.
+#   python benchmarks/bench_importer.py --cities 1000 --latency-ms 100
+# By default the rows are counted and dropped so only the fetch side is measured;
+# pass --database-url to insert them into a real (scratch) database. With
+# --cycles 2 the cities are fetched again right away: the stub's observations
+# have not changed, so the second cycle should queue nothing.
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import write_results
+from stub_openweather import start_stub
+from weather_scheduler import StationScheduler
+
+
+class DiscardedRows:
+    def __init__(self):
+        self.rows = 0
+
+    async def queue_records(self, records, observed=()):
+        self.rows += len(records)
+        return len(records)
+
+
+def synthetic_cities(count):
+    return [
+        {'id': i, 'name': f'City {i}', 'lat': (i * 7.31) % 180 - 90, 'lon': (i * 13.7) % 360 - 180}
+        for i in range(1, count + 1)
+    ]
+
+
+async def run(args, server, url):
+    import importWeatherData
+    importWeatherData.OPENWEATHER_URL = url
+    importWeatherData.MAX_CONCURRENT_REQUESTS = args.concurrency
+
+    if args.database_url:
+        from prisma import Client
+        from weather_ingest import start_ingest, stop_ingest
+        db = Client(datasource={'url': args.database_url})
+        await db.connect()
+        await start_ingest(db, 'bench-importer')
+    else:
+        importWeatherData.queue_records = DiscardedRows().queue_records
+
+    http_client = importWeatherData.create_http_client()
+    cities = synthetic_cities(args.cities)
+    scheduler = StationScheduler()
+    validators = {}
+    queued = []
+    try:
+        started = time.perf_counter()
+        for _ in range(args.cycles):
+            queued.append(await importWeatherData.scheduled_job(http_client, cities, 'stub', args.mode, scheduler, validators))
+        if args.database_url:
+            # The cycle ends once its rows are committed, not when they are queued
+            await stop_ingest()
+        elapsed = time.perf_counter() - started
+    finally:
+        await http_client.aclose()
+        if args.database_url:
+            await db.disconnect()
+
+    return {
+        'name': 'importer_cycle',
+        'cities': args.cities,
+        'mode': args.mode,
+        'concurrency': args.concurrency,
+        'stub_latency_ms': args.latency_ms,
+        'cycles': args.cycles,
+        'rows_queued': queued,
+        'http_requests': server.RequestHandlerClass.requests_served,
+        'cycle_seconds': round(elapsed, 3),
+        'cities_per_second': round(args.cities * args.cycles / elapsed, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark one importer cycle against a stub API')
+    parser.add_argument('--cities', type=int, default=500)
+    parser.add_argument('--mode', choices=['group', 'single'], default='group')
+    parser.add_argument('--cycles', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--database-url')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    server, url = start_stub(0, args.latency_ms, args.error_rate)
+    try:
+        result = asyncio.run(run(args, server, url))
+    finally:
+        server.shutdown()
+    write_results([result], args.output)
+
+
+if __name__ == '__main__':
+    main()
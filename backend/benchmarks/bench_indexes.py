@@ -0,0 +1,142 @@
+# Grows a synthetic WeatherData table and times the queries behind
+# get_weather_by_filter_service and get_latest_data_from_db at each size.
+#   python benchmarks/bench_indexes.py --sizes 1000000,10000000,50000000 --output bench.jsonl
+# With the indexes in place the timings should stay roughly flat while the table grows;
+# --unindexed runs the same thing on the old schema for comparison.
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import write_results
+
+START_MS = 1704067200000
+STEP_MS = 5 * 60 * 1000
+HOUR_MS = 60 * 60 * 1000
+DAY_MS = 24 * HOUR_MS
+
+SCHEMA = '''
+CREATE TABLE "WeatherData" (
+    "id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+    "city_name" TEXT NOT NULL,
+    "latitude" REAL NOT NULL,
+    "longitude" REAL NOT NULL,
+    "temperature" REAL NOT NULL,
+    "feels_like" REAL NOT NULL,
+    "humidity" INTEGER NOT NULL,
+    "pressure" INTEGER NOT NULL,
+    "description" TEXT NOT NULL,
+    "timestamp" DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+)
+'''
+
+INDEXES = [
+    'CREATE INDEX "WeatherData_city_name_timestamp_idx" ON "WeatherData"("city_name", "timestamp")',
+    'CREATE INDEX "WeatherData_timestamp_idx" ON "WeatherData"("timestamp")',
+]
+
+QUERIES = {
+    'city_day': 'SELECT * FROM "WeatherData" WHERE "city_name" = ? AND "timestamp" >= ? AND "timestamp" <= ?',
+    'city_hour': 'SELECT * FROM "WeatherData" WHERE "city_name" = ? AND "timestamp" >= ? AND "timestamp" <= ?',
+    'latest_5min': 'SELECT * FROM "WeatherData" WHERE "timestamp" >= ? AND "timestamp" <= ?',
+}
+
+
+def synthetic_rows(first, last, cities):
+    rng = random.Random(first)
+    for i in range(first, last):
+        city = i % cities
+        yield (
+            f'City {city}',
+            (city * 7.31) % 180 - 90,
+            (city * 13.7) % 360 - 180,
+            round(rng.uniform(-10, 35), 2),
+            round(rng.uniform(-15, 38), 2),
+            rng.randint(20, 100),
+            rng.randint(980, 1040),
+            'clear sky',
+            START_MS + (i // cities) * STEP_MS,
+        )
+
+
+def grow(connection, current, target, cities):
+    connection.executemany(
+        'INSERT INTO "WeatherData" ("city_name", "latitude", "longitude", "temperature", "feels_like", '
+        '"humidity", "pressure", "description", "timestamp") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        synthetic_rows(current, target, cities),
+    )
+    connection.commit()
+
+
+def time_query(connection, sql, params, repeat):
+    timings = []
+    rows = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = len(connection.execute(sql, params).fetchall())
+        timings.append(time.perf_counter() - started)
+    plan = ' / '.join(row[-1] for row in connection.execute(f'EXPLAIN QUERY PLAN {sql}', params))
+    return min(timings), rows, plan
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark WeatherData range queries as the table grows')
+    parser.add_argument('--sizes', default='1000000,10000000,50000000')
+    parser.add_argument('--cities', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--database', help='defaults to a temporary file that is removed afterwards')
+    parser.add_argument('--unindexed', action='store_true', help='benchmark the schema without indexes')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    sizes = sorted(int(size) for size in args.sizes.split(','))
+    path = args.database or os.path.join(tempfile.mkdtemp(), 'bench.db')
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA journal_mode = WAL')
+    connection.execute('PRAGMA synchronous = NORMAL')
+    connection.execute(SCHEMA)
+    if not args.unindexed:
+        for index in INDEXES:
+            connection.execute(index)
+
+    current = 0
+    try:
+        for size in sizes:
+            started = time.perf_counter()
+            grow(connection, current, size, args.cities)
+            load_seconds = time.perf_counter() - started
+            current = size
+
+            last_ms = START_MS + ((size - 1) // args.cities) * STEP_MS
+            city = f'City {random.randrange(args.cities)}'
+            params = {
+                'city_day': (city, last_ms - DAY_MS, last_ms),
+                'city_hour': (city, last_ms - HOUR_MS, last_ms),
+                'latest_5min': (last_ms - STEP_MS, last_ms),
+            }
+
+            results = []
+            for name, sql in QUERIES.items():
+                seconds, rows, plan = time_query(connection, sql, params[name], args.repeat)
+                results.append({
+                    'name': name,
+                    'table_rows': size,
+                    'indexed': not args.unindexed,
+                    'rows_returned': rows,
+                    'query_ms': round(seconds * 1000, 3),
+                    'load_seconds': round(load_seconds, 2),
+                    'plan': plan,
+                })
+            write_results(results, args.output)
+    finally:
+        connection.close()
+        if not args.database:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# Compares writes made directly through Prisma, as the services and the importer
+# did before, with writes going through the ingestion queue, on a scratch database:
+#   DATABASE_URL=file:/tmp/bench.db prisma migrate deploy
+#   python benchmarks/bench_ingest.py --database-url file:/tmp/bench.db --producers 200 --writes 20000
+# Each producer stands for an API request creating one reading and waits for it
+# to be committed. Meanwhile a second client plays the importer and inserts
+# --importer-rows rows every second, so both compete for the SQLite write lock.
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from prisma import Client
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import summarize, write_results
+from weather_db import apply_pragmas
+from weather_ingest import IngestQueue
+
+
+def synthetic_reading(rng):
+    city = rng.randrange(50)
+    return {
+        'city_name': f'City {city}',
+        'latitude': city * 1.7 - 40,
+        'longitude': city * 3.1 - 80,
+        'temperature': round(rng.uniform(-10, 35), 2),
+        'feels_like': round(rng.uniform(-15, 38), 2),
+        'humidity': rng.randint(20, 100),
+        'pressure': rng.randint(980, 1040),
+        'description': 'clear sky',
+        'timestamp': datetime.utcnow(),
+    }
+
+
+async def run_importer(write_many, rows, stopped):
+    rng = random.Random(rows)
+    while not stopped.is_set():
+        try:
+            await write_many([synthetic_reading(rng) for _ in range(rows)])
+        except Exception as e:
+            print(f"Importer write failed: {e}")
+        try:
+            await asyncio.wait_for(stopped.wait(), 1)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def produce(write, writes, producers):
+    latencies = []
+    errors = 0
+    rng = random.Random(writes)
+
+    async def producer(count):
+        nonlocal errors
+        for _ in range(count):
+            started = time.perf_counter()
+            try:
+                await write(synthetic_reading(rng))
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(producer(writes // producers) for _ in range(producers)))
+    return latencies, errors, time.perf_counter() - started
+
+
+async def measure(mode, args, api_db, importer_db, directory):
+    queues = []
+    if mode == 'direct':
+        write = lambda data: api_db.weatherdata.create(data=data)
+        write_many = lambda rows: importer_db.weatherdata.create_many(data=rows)
+    else:
+        api_queue = IngestQueue('bench-api', directory)
+        importer_queue = IngestQueue('bench-importer', directory)
+        await api_queue.start(api_db)
+        await importer_queue.start(importer_db)
+        queues = [api_queue, importer_queue]
+        write = lambda data: api_queue.submit([('create', data)])
+        write_many = lambda rows: importer_queue.submit([('create', row) for row in rows], wait=False, timeout=None)
+
+    stopped = asyncio.Event()
+    importer = asyncio.create_task(run_importer(write_many, args.importer_rows, stopped)) if args.importer_rows else None
+    latencies, errors, elapsed = await produce(write, args.writes, args.producers)
+    stopped.set()
+    if importer is not None:
+        await importer
+    for queue in queues:
+        await queue.stop()
+
+    result = summarize(f'writes_{mode}', latencies, elapsed, errors)
+    result.update({'producers': args.producers, 'importer_rows': args.importer_rows})
+    return result
+
+
+async def run(args):
+    api_db = Client(datasource={'url': args.database_url})
+    importer_db = Client(datasource={'url': args.database_url})
+    for db in (api_db, importer_db):
+        await db.connect()
+        await apply_pragmas(db)
+
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for mode in args.mode:
+                results.append(await measure(mode, args, api_db, importer_db, directory))
+    finally:
+        await api_db.disconnect()
+        await importer_db.disconnect()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare direct writes with the ingestion queue')
+    parser.add_argument('--database-url', required=True, help='scratch database, rows are added to it')
+    parser.add_argument('--mode', action='append', choices=['direct', 'queue'], help='repeat to run both')
+    parser.add_argument('--producers', type=int, default=200, help='concurrent API writers')
+    parser.add_argument('--writes', type=int, default=20000, help='readings created by the API writers in total')
+    parser.add_argument('--importer-rows', type=int, default=1000, help='rows inserted by the importer every second')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+    args.mode = args.mode or ['direct', 'queue']
+
+    write_results(asyncio.run(run(args)), args.output)
+
+
+if __name__ == '__main__':
+    main()
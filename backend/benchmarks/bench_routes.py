@@ -0,0 +1,61 @@
+# Measures requests/sec on GET /weather and GET /weather/<id> against a running server.
+# Run it once on the old revision and once on the new one with a different --label:
+#   python benchmarks/bench_routes.py --url http://127.0.0.1:8080 --label after --output bench.jsonl
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import os
+import sys
+import threading
+import time
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import login, summarize, write_results
+
+_local = threading.local()
+
+
+def _session(token):
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+        _local.session.headers['Authorization'] = f'Bearer {token}'
+    return _local.session
+
+
+def run_route(base_url, path, token, total, concurrency):
+    def call(_):
+        started = time.perf_counter()
+        response = _session(token).get(f'{base_url}{path}')
+        return time.perf_counter() - started, response.status_code >= 400
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(call, range(total)))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for latency, _ in results]
+    errors = sum(1 for _, failed in results if failed)
+    return summarize(path, latencies, elapsed, errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the weather read routes')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--weather-id', type=int, default=1)
+    parser.add_argument('--label', default='current')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    token = login(args.url)
+    results = []
+    for path in ('/weather', f'/weather/{args.weather_id}'):
+        result = run_route(args.url, path, token, args.requests, args.concurrency)
+        result['label'] = args.label
+        results.append(result)
+    write_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
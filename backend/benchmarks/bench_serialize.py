@@ -0,0 +1,90 @@
+# Times the serialization of N WeatherData rows, without the database, for the
+# old per-row dict + stdlib json path and the tuple and columnar paths.
+#   python benchmarks/bench_serialize.py --sizes 10000,100000,1000000
+# The encoder is orjson when it is installed and the stdlib json module otherwise.
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import types
+from datetime import datetime, timedelta, timezone
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import write_results
+from weather_api_service import weather_data_to_dict
+from weather_serialize import dumps, orjson, weather_columns, weather_dicts
+
+CITIES = 50
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def synthetic_records(count):
+    # Like the importer: every city of a cycle shares the timestamp of that cycle
+    rng = random.Random(count)
+    return [
+        types.SimpleNamespace(
+            id=i + 1,
+            city_name=f'City {i % CITIES}',
+            latitude=(i % CITIES) * 1.7 - 40,
+            longitude=(i % CITIES) * 3.1 - 80,
+            temperature=round(rng.uniform(-10, 35), 2),
+            feels_like=round(rng.uniform(-15, 38), 2),
+            humidity=rng.randint(20, 100),
+            pressure=rng.randint(980, 1040),
+            description='clear sky',
+            timestamp=START + timedelta(minutes=5 * (i // CITIES)),
+        )
+        for i in range(count)
+    ]
+
+
+def baseline(records):
+    return json.dumps([weather_data_to_dict(record) for record in records]).encode()
+
+
+def rows(records):
+    return dumps(weather_dicts(records))
+
+
+def columnar(records):
+    return dumps(weather_columns(records))
+
+
+def measure(name, serialize, records, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = serialize(records)
+        timings.append(time.perf_counter() - started)
+    best = min(timings)
+    return {
+        'name': name,
+        'rows': len(records),
+        'encoder': 'orjson' if orjson is not None else 'json',
+        'best_ms': round(best * 1000, 3),
+        'rows_per_second': round(len(records) / best),
+        'bytes': len(body),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure WeatherData serialization time and payload size')
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    results = []
+    for size in (int(size) for size in args.sizes.split(',')):
+        records = synthetic_records(size)
+        for name, serialize in (('baseline', baseline), ('rows', rows), ('columnar', columnar)):
+            results.append(measure(name, serialize, records, args.repeat))
+    write_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
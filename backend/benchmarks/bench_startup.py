@@ -0,0 +1,117 @@
+# Measures how long a new backend process takes to answer its first request:
+#   python benchmarks/bench_startup.py --runs 5
+#   python benchmarks/bench_startup.py --server asgi --env SWAGGER_UI=0
+#   python benchmarks/bench_startup.py --env RELOAD=0 --env SWAGGER_UI=0
+# Each run starts the server on the same scratch database and times it until
+# /health answers. Then `python -X importtime` breaks down the imports of building
+# the Flask app (create_app and init_app) by top-level package, slowest first.
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS)
+from common import summarize, write_results
+from run_suite import BACKEND, start_server, stop_server
+from seed import seed_database
+
+# What both entry points do first, without the database
+SETUP = 'from weather_app import create_app, init_app; init_app(create_app(), None, None)'
+
+
+def time_to_health(args, env):
+    url = f'http://127.0.0.1:{args.port}/health'
+    started = time.perf_counter()
+    server = start_server(args, env)
+    try:
+        while time.perf_counter() - started < args.timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f'Server exited with code {server.returncode}')
+            try:
+                if requests.get(url, timeout=1).ok:
+                    return time.perf_counter() - started
+            except requests.RequestException:
+                pass
+            time.sleep(0.02)
+        raise RuntimeError(f'Server not healthy after {args.timeout} seconds')
+    finally:
+        stop_server(server)
+
+
+def import_times(code, env):
+    # (self, cumulative, name, depth) in microseconds for every module loaded by
+    # running code, depth 0 being the modules it imports itself
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=BACKEND, env=env, capture_output=True, text=True, check=True,
+    )
+    times = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        times.append((int(self_us), int(cumulative_us), name.strip(), depth))
+    return times
+
+
+def import_breakdown(args, env):
+    times = import_times(SETUP, env)
+    packages = {}
+    for self_us, _, name, _ in times:
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0) + self_us
+    slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:args.top]
+    return {
+        'name': 'import_time',
+        'modules': len(times),
+        'total_ms': round(sum(cumulative for _, cumulative, _, depth in times if depth == 0) / 1000, 1),
+        'packages_ms': {package: round(self_us / 1000, 1) for package, self_us in slowest},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the startup of the backend and break its imports down')
+    parser.add_argument('--server', choices=['threaded', 'asgi'], default='threaded')
+    parser.add_argument('--port', type=int, default=8185)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--rows', type=int, default=10000, help='readings in the scratch database')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--top', type=int, default=15, help='packages listed in the breakdown')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='environment of the server, e.g. SWAGGER_UI=0 or RELOAD=0')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    overrides = dict(item.split('=', 1) for item in args.env)
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'bench.db')
+        seed_database(database, args.rows, 10)
+        env = {
+            **os.environ,
+            'DATABASE_URL': f'file:{database}',
+            'PORT': str(args.port),
+            'JWT_SECRET': os.getenv('JWT_SECRET', 'benchmark-secret'),
+            'INGEST_DIRECTORY': os.path.join(directory, 'ingest'),
+            'RETENTION_INTERVAL_SECONDS': '0',
+            **overrides,
+        }
+
+        time_to_health(args, env)  # warm up, compiles the bytecode and creates the default user
+        started = time.perf_counter()
+        durations = [time_to_health(args, env) for _ in range(args.runs)]
+        startup = summarize('startup', durations, time.perf_counter() - started)
+        breakdown = import_breakdown(args, env)
+
+    for result in (startup, breakdown):
+        result.update({'server': args.server, 'env': overrides})
+    write_results([startup, breakdown], args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import json
+import os
+import requests
+
+
+def login(base_url, username='test', password='testtest'):
+    response = requests.post(f'{base_url}/login', json={'username': username, 'password': password})
+    response.raise_for_status()
+    return response.json()['access_token']
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(name, latencies, elapsed, errors=0):
+    latencies = sorted(latencies)
+    return {
+        'name': name,
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def write_results(results, output=None):
+    for result in results:
+        print(json.dumps(result))
+    if output:
+        with open(output, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+
+
+def process_rss(pid):
+    # Resident memory in bytes of a process and its children (Linux only, read from
+    # /proc), e.g. the Flask reloader and the server it runs, or None when unknown
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+        children = []
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                children += [int(child) for child in f.read().split()]
+    except (OSError, StopIteration):
+        return None
+    return rss + sum(process_rss(child) or 0 for child in children)
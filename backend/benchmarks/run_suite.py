@@ -0,0 +1,137 @@
+# Runs the whole load-testing suite against a fresh server, so that two commits
+# can be compared on the same machine:
+#   python benchmarks/run_suite.py --rows 1000000 --cities 1000 --output bench.jsonl
+#   git checkout <other commit> && python benchmarks/run_suite.py --rows 1000000 --cities 1000 --output bench.jsonl
+# It seeds a scratch database, starts the server on it (weather.py, or the ASGI app
+# with --server asgi), waits for /health, then loads every API route, measures the
+# Socket.IO broadcast latency and times an importer cycle against the
+# OpenWeatherMap stub. Every result line carries the commit, the label and the seed
+# size; the scratch files are removed at the end.
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+BACKEND = os.path.dirname(BENCHMARKS)
+sys.path.insert(0, BENCHMARKS)
+from common import write_results
+from seed import seed_database
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BACKEND, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_server(args, env):
+    if args.server == 'asgi':
+        command = [sys.executable, '-m', 'uvicorn', 'weather_asgi:app', '--port', str(args.port), '--log-level', 'warning']
+    else:
+        command = [sys.executable, 'weather.py']
+    # A session of its own, so that stopping it also stops the Flask reloader child
+    return subprocess.Popen(command, cwd=BACKEND, env=env, start_new_session=True)
+
+
+def wait_for_health(url, server, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'Server exited with code {server.returncode}')
+        try:
+            if requests.get(f'{url}/health', timeout=2).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f'Server not healthy after {timeout} seconds')
+
+
+def stop_server(server):
+    try:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        os.killpg(server.pid, signal.SIGKILL)
+        server.wait()
+    except ProcessLookupError:
+        pass
+
+
+def run_benchmark(script, arguments, output, env):
+    # Each benchmark appends its results to the shared scratch file
+    command = [sys.executable, os.path.join(BENCHMARKS, script), *arguments, '--output', output]
+    completed = subprocess.run(command, cwd=BACKEND, env=env, stdout=subprocess.DEVNULL)
+    if completed.returncode:
+        print(f'{script} exited with code {completed.returncode}', file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed a database, start the server and run every benchmark against it')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--cities', type=int, default=100)
+    parser.add_argument('--server', choices=['threaded', 'asgi'], default='threaded')
+    parser.add_argument('--port', type=int, default=8180)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of load per route')
+    parser.add_argument('--clients', type=int, default=500, help='Socket.IO clients for the broadcast benchmark')
+    parser.add_argument('--importer-cities', type=int, default=500)
+    parser.add_argument('--skip', action='append', choices=['api', 'broadcast', 'importer'], default=[])
+    parser.add_argument('--label', default='current')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    url = f'http://127.0.0.1:{args.port}'
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'bench.db')
+        results_file = os.path.join(directory, 'results.jsonl')
+        results = [seed_database(database, args.rows, args.cities)]
+        env = {
+            **os.environ,
+            'DATABASE_URL': f'file:{database}',
+            'PORT': str(args.port),
+            'JWT_SECRET': os.getenv('JWT_SECRET', 'benchmark-secret'),
+            'INGEST_DIRECTORY': os.path.join(directory, 'ingest'),
+            'RETENTION_INTERVAL_SECONDS': '0',
+        }
+
+        server = start_server(args, env)
+        try:
+            wait_for_health(url, server, 120)
+            if 'api' not in args.skip:
+                run_benchmark('bench_api.py', [
+                    '--url', url, '--rows', str(args.rows), '--cities', str(args.cities),
+                    '--concurrency', str(args.concurrency), '--duration', str(args.duration),
+                    '--server-pid', str(server.pid),
+                ], results_file, env)
+            if 'broadcast' not in args.skip:
+                run_benchmark('bench_broadcast.py', ['--url', url, '--clients', str(args.clients)], results_file, env)
+        finally:
+            stop_server(server)
+
+        if 'importer' not in args.skip:
+            run_benchmark('bench_importer.py', [
+                '--cities', str(args.importer_cities), '--database-url', f'file:{database}',
+            ], results_file, env)
+
+        if os.path.exists(results_file):
+            with open(results_file) as f:
+                results += [json.loads(line) for line in f if line.strip()]
+
+    commit = current_commit()
+    for result in results:
+        result.update({'label': args.label, 'commit': commit, 'server': args.server,
+                       'seed_rows': args.rows, 'seed_cities': args.cities})
+    write_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# Creates a SQLite database with the Prisma migrations applied and fills it with
+# synthetic readings, one per city every 5 minutes up to now:
+#   python benchmarks/seed.py --database /tmp/bench.db --rows 1000000 --cities 1000
+#   DATABASE_URL=file:/tmp/bench.db python weather.py
+# Cities are named "City 0" .. "City N-1" and spread over the globe; the same seed
+# gives the same rows.
+import argparse
+import glob
+import os
+import random
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import write_results
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MIGRATIONS = os.path.join(BACKEND, 'prisma', 'migrations')
+STEP_MS = 5 * 60 * 1000
+DESCRIPTIONS = ('clear sky', 'few clouds', 'scattered clouds', 'broken clouds', 'light rain', 'mist')
+INSERT_BATCH_SIZE = 50000
+
+
+def city_name(city):
+    return f'City {city}'
+
+
+def city_coordinates(city):
+    return (city * 7.31) % 180 - 90, (city * 13.7) % 360 - 180
+
+
+def synthetic_rows(rows, cities, end_ms, seed=0):
+    rng = random.Random(seed)
+    first_ms = end_ms - ((rows - 1) // cities) * STEP_MS
+    for i in range(rows):
+        city = i % cities
+        lat, lon = city_coordinates(city)
+        temperature = round(rng.uniform(-10, 35), 2)
+        yield (
+            city_name(city), lat, lon, temperature, round(temperature - rng.uniform(0, 3), 2),
+            rng.randint(20, 100), rng.randint(980, 1040), rng.choice(DESCRIPTIONS),
+            first_ms + (i // cities) * STEP_MS,
+        )
+
+
+def seed_database(path, rows, cities, seed=0):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    connection = sqlite3.connect(path)
+    for migration in sorted(glob.glob(os.path.join(MIGRATIONS, '*', 'migration.sql'))):
+        with open(migration) as f:
+            connection.executescript(f.read())
+    connection.execute('PRAGMA journal_mode = WAL')
+
+    started = time.perf_counter()
+    generated = synthetic_rows(rows, cities, int(time.time() * 1000), seed)
+    while True:
+        batch = [row for _, row in zip(range(INSERT_BATCH_SIZE), generated)]
+        if not batch:
+            break
+        connection.executemany(
+            'INSERT INTO "WeatherData" ("city_name", "latitude", "longitude", "temperature", "feels_like", '
+            '"humidity", "pressure", "description", "timestamp") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            batch,
+        )
+        connection.commit()
+    connection.execute('ANALYZE')
+    connection.close()
+    elapsed = time.perf_counter() - started
+    return {'name': 'seed', 'rows': rows, 'cities': cities, 'seconds': round(elapsed, 3), 'bytes': os.path.getsize(path)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create a database filled with synthetic weather readings')
+    parser.add_argument('--database', required=True, help='SQLite file to create, replaced if it exists')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--cities', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    write_results([seed_database(args.database, args.rows, args.cities, args.seed)], args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# Local stand-in for the OpenWeatherMap API, so the importer can be exercised
+# without network access or API quota:
+#   python benchmarks/stub_openweather.py --port 8090 --latency-ms 50
+#   OPENWEATHER_URL=http://127.0.0.1:8090/data/2.5 python importWeatherData.py
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import argparse
+import json
+import random
+import threading
+import time
+
+
+def current_weather(lat, lon, city_id=0, name=''):
+    seed = int(abs(lat * 1000) + abs(lon * 1000)) + city_id
+    rng = random.Random(seed + int(time.time() // 600))
+    temp = round(rng.uniform(-10, 35), 2)
+    return {
+        'id': city_id,
+        'name': name,
+        'coord': {'lat': lat, 'lon': lon},
+        'dt': int(time.time() // 600 * 600),
+        'main': {
+            'temp': temp,
+            'feels_like': round(temp - rng.uniform(0, 3), 2),
+            'humidity': rng.randint(20, 100),
+            'pressure': rng.randint(980, 1040),
+        },
+        'weather': [{'description': rng.choice(['clear sky', 'few clouds', 'light rain', 'broken clouds'])}],
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Each server started by start_stub gets a subclass of its own, so the
+    # counters and the scripted failures below are per server
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    error_rate = 0.0
+    requests_served = 0
+    # Statuses answered, in order, before the normal answers (e.g. [429, 503])
+    fail_with = ()
+    in_flight = 0
+    max_in_flight = 0
+    # (path, query, headers) of every request
+    requests = ()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        handler = type(self)
+        with handler.lock:
+            handler.requests_served += 1
+            handler.requests.append((urlparse(self.path).path, parse_qs(urlparse(self.path).query), dict(self.headers)))
+            handler.in_flight += 1
+            handler.max_in_flight = max(handler.max_in_flight, handler.in_flight)
+            failure = handler.fail_with.pop(0) if handler.fail_with else None
+        try:
+            self.answer(failure)
+        finally:
+            with handler.lock:
+                handler.in_flight -= 1
+
+    def answer(self, failure):
+        if self.latency:
+            time.sleep(self.latency)
+        if failure is not None:
+            return self.send_json(failure, {'message': 'stub failure'})
+        if self.error_rate and random.random() < self.error_rate:
+            return self.send_json(503, {'message': 'stub failure'})
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path.endswith('/weather'):
+            lat = float(query.get('lat', ['0'])[0])
+            lon = float(query.get('lon', ['0'])[0])
+            weather = current_weather(lat, lon)
+            # One version per observation, for conditional requests
+            etag = f'"{lat}:{lon}:{weather["dt"]}"'
+            if self.headers.get('If-None-Match') == etag:
+                return self.send_json(304, None, {'ETag': etag})
+            return self.send_json(200, weather, {'ETag': etag})
+        if url.path.endswith('/group'):
+            ids = [int(city_id) for city_id in query.get('id', [''])[0].split(',') if city_id]
+            items = [
+                current_weather((city_id * 7.31) % 180 - 90, (city_id * 13.7) % 360 - 180, city_id, f'City {city_id}')
+                for city_id in ids
+            ]
+            return self.send_json(200, {'cnt': len(items), 'list': items})
+        self.send_json(404, {'message': 'not found'})
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode() if payload is not None else b''
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if payload is not None:
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(port=0, latency_ms=0, error_rate=0.0, fail_with=()):
+    # The handler class of the server is server.RequestHandlerClass
+    handler = type('StubServerHandler', (StubHandler,), {
+        'latency': latency_ms / 1000,
+        'error_rate': error_rate,
+        'fail_with': list(fail_with),
+        'requests': [],
+        'lock': threading.Lock(),
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/data/2.5'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve fake OpenWeatherMap responses')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server, url = start_stub(args.port, args.latency_ms, args.error_rate)
+    print(f"Stub OpenWeatherMap API listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
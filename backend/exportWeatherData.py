@@ -0,0 +1,88 @@
+import asyncio
+from prisma import Client
+from dotenv import load_dotenv
+from weather_db import database_url, apply_pragmas
+from weather_api_service import parse_time_range
+from weather_export import fetch_export_rows, write_export, require_pyarrow, EXPORT_BATCH_SIZE, EXPORT_FORMATS
+import argparse
+import os
+import queue
+import threading
+
+async def export_batches(db, f, export_format, start_ms, end_ms, city, batch_size):
+    # The Arrow writers are synchronous: they run in a thread fed through a
+    # bounded queue, so at most two batches are held in memory
+    require_pyarrow()
+    batches = queue.Queue(maxsize=1)
+    errors = []
+
+    def rows():
+        while (batch := batches.get()) is not None:
+            yield batch
+
+    def write():
+        try:
+            for chunk in write_export(rows(), export_format):
+                f.write(chunk)
+        except Exception as e:
+            errors.append(e)
+
+    def put(batch):
+        # False once the writer has stopped, nothing would take the batch
+        while writer.is_alive():
+            try:
+                batches.put(batch, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    writer = threading.Thread(target=write, name='export-writer')
+    writer.start()
+    loop = asyncio.get_running_loop()
+    exported = 0
+    after_id = 0
+    try:
+        while True:
+            batch = await fetch_export_rows(db, after_id, start_ms, end_ms, batch_size, city)
+            if not batch:
+                break
+            if not await loop.run_in_executor(None, put, batch):
+                break
+            exported += len(batch)
+            if len(batch) < batch_size:
+                break
+            after_id = batch[-1]['id']
+    finally:
+        await loop.run_in_executor(None, put, None)
+        await loop.run_in_executor(None, writer.join)
+    if errors:
+        raise errors[0]
+    return exported
+
+async def exportWeatherData(path, export_format, start_time=None, end_time=None, city=None, batch_size=EXPORT_BATCH_SIZE):
+    load_dotenv()
+    start_ms, end_ms = parse_time_range(start_time, end_time)
+
+    db = Client(datasource={'url': database_url()})
+    try:
+        await db.connect()
+        await apply_pragmas(db)
+        with open(path, 'wb') as f:
+            exported = await export_batches(db, f, export_format, start_ms, end_ms, city, batch_size)
+        print(f"Exported {exported} rows to {path} ({os.path.getsize(path)} bytes)")
+    finally:
+        await db.disconnect()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export weather data to an Arrow IPC stream or a Parquet file')
+    parser.add_argument('path', help='output file, import it back with importWeatherData.py --bulk <path>')
+    parser.add_argument('--format', choices=list(EXPORT_FORMATS), default=None,
+                        help='defaults to arrow for .arrow/.arrows files and parquet otherwise')
+    parser.add_argument('--start-time', help='first day to export (YYYY-MM-DD)')
+    parser.add_argument('--end-time', help='last day to export (YYYY-MM-DD)')
+    parser.add_argument('--city', help='only export this city')
+    parser.add_argument('--batch-size', type=int, default=EXPORT_BATCH_SIZE)
+    args = parser.parse_args()
+    export_format = args.format or ('arrow' if args.path.endswith(('.arrow', '.arrows')) else 'parquet')
+    asyncio.run(exportWeatherData(args.path, export_format, args.start_time, args.end_time, args.city, args.batch_size))
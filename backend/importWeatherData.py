@@ -1,72 +1,345 @@
 import asyncio
-from datetime import datetime, timedelta
-from prisma import Prisma
-import requests
-import schedule
+from datetime import datetime
+from prisma import Client
+from dotenv import load_dotenv
+from weather_db import database_url, apply_pragmas
+from weather_export import read_export
+from weather_ingest import start_ingest, stop_ingest, submit_writes
+from weather_metrics import import_cycle_duration, import_fetch_duration, import_unchanged_observations, start_metrics_server
+from weather_scheduler import StationScheduler, IMPORT_INTERVAL_SECONDS, IMPORT_TICK_SECONDS, STATION_REFRESH_SECONDS
+import argparse
+import gzip
+import httpx
+import json
+import os
+import random
+import sys
 import time
+import zlib
 
-async def getWeatherAndSave(db, city_name, lat, lon, api_key):
-    base_url = "https://api.openweathermap.org/data/2.5/weather"
+OPENWEATHER_URL = os.getenv('OPENWEATHER_URL', 'https://api.openweathermap.org/data/2.5')
+MAX_CONCURRENT_REQUESTS = int(os.getenv('IMPORT_CONCURRENCY', 20))
+MAX_RETRIES = 3
+BACKOFF_SECONDS = 0.5
+GROUP_SIZE = 20
+BULK_BATCH_SIZE = 1000
+ARROW_EXTENSIONS = ('.arrow', '.arrows', '.parquet')
+
+def create_http_client():
+    # One keep-alive pool for every cycle, sized to the number of requests in flight
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(10.0),
+        limits=httpx.Limits(
+            max_connections=MAX_CONCURRENT_REQUESTS,
+            max_keepalive_connections=MAX_CONCURRENT_REQUESTS,
+        ),
+    )
+
+def station_city(station):
+    # Station row in the shape the fetch functions take, id being the provider's
+    return {'id': station.provider_id, 'name': station.name, 'lat': station.latitude, 'lon': station.longitude}
+
+def weather_record(city_name, lat, lon, weather_data):
+    return {
+        'city_name': city_name,
+        'latitude': lat,
+        'longitude': lon,
+        'temperature': weather_data['main']['temp'],
+        'feels_like': weather_data['main']['feels_like'],
+        'humidity': weather_data['main']['humidity'],
+        'pressure': weather_data['main']['pressure'],
+        'description': weather_data['weather'][0]['description'],
+        'timestamp': datetime.utcnow(),
+    }
+
+async def get_with_retries(http_client, semaphore, url, params, headers=None):
+    # Retries network errors, 429 and 5xx with exponential backoff and jitter
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with semaphore:
+                response = await http_client.get(url, params=params, headers=headers)
+            if response.status_code != 429 and response.status_code < 500:
+                return response
+            error = f"HTTP {response.status_code}"
+        except httpx.HTTPError as e:
+            error = repr(e)
+
+        if attempt < MAX_RETRIES:
+            await asyncio.sleep(BACKOFF_SECONDS * 2 ** attempt + random.uniform(0, BACKOFF_SECONDS))
+
+    raise RuntimeError(f"giving up after {MAX_RETRIES + 1} attempts: {error}")
+
+async def getWeather(http_client, semaphore, city, api_key, validators=None):
+    # Returns (city, weather data), with None as data when the answer is
+    # 304 Not Modified. validators holds the ETag and Last-Modified of the last
+    # answer per city, sent back so the provider can skip an unchanged reading.
+    params = {
+        'lat': city['lat'],
+        'lon': city['lon'],
+        'appid': api_key,
+        'units': 'metric'
+    }
+    headers = validators.get(city['name']) if validators is not None else None
+
+    started = time.perf_counter()
+    try:
+        response = await get_with_retries(http_client, semaphore, f"{OPENWEATHER_URL}/weather", params, headers)
+    except RuntimeError as e:
+        import_fetch_duration.observe(time.perf_counter() - started, endpoint='weather', status='error')
+        print(f"Error fetching weather for {city['name']}: {e}")
+        return None
+    import_fetch_duration.observe(time.perf_counter() - started, endpoint='weather', status=response.status_code)
+
+    if response.status_code == 304:
+        return city, None
+    if response.status_code != 200:
+        print(f"Error fetching weather for {city['name']}: HTTP {response.status_code}")
+        return None
+
+    if validators is not None:
+        conditions = {}
+        if 'etag' in response.headers:
+            conditions['If-None-Match'] = response.headers['etag']
+        if 'last-modified' in response.headers:
+            conditions['If-Modified-Since'] = response.headers['last-modified']
+        validators[city['name']] = conditions or None
+    return city, response.json()
+
+async def getWeatherGroup(http_client, semaphore, cities, api_key):
+    # One request for up to GROUP_SIZE cities through the provider's group endpoint
+    cities_by_id = {city['id']: city for city in cities}
     params = {
-        'lat': lat,
-        'lon': lon,
+        'id': ','.join(str(city_id) for city_id in cities_by_id),
         'appid': api_key,
         'units': 'metric'
     }
 
-    response = requests.get(base_url, params=params)
-
-    if response.status_code == 200:
-        weather_data = response.json()
-        temperature = weather_data['main']['temp']
-        feels_like = weather_data['main']['feels_like']
-        humidity = weather_data['main']['humidity']
-        pressure = weather_data['main']['pressure']
-        description = weather_data['weather'][0]['description']
-
-        await db.weatherdata.create(
-            data={
-                'city_name': city_name,
-                'latitude': lat,
-                'longitude': lon,
-                'temperature': temperature,
-                'feels_like': feels_like,
-                'humidity': humidity,
-                'pressure': pressure,
-                'description': description,
-                'timestamp': datetime.utcnow(),
-            }
-        )
-
-async def scheduled_job(db, cities, api_key):
-    for city in cities:
-        await getWeatherAndSave(db, city['name'], city['lat'], city['lon'], api_key)
-    print(f"Job executed at {datetime.utcnow()}")
-
-async def importWeatherData():
-    cities = [
-        {'name': 'Paris', 'lat': 48.8566, 'lon': 2.3522},
-        {'name': 'New York', 'lat': 40.7128, 'lon': -74.0060},
-        {'name': 'Tokyo', 'lat': 35.6895, 'lon': 139.6917},
-        {'name': 'Sydney', 'lat': -33.8688, 'lon': 151.2093},
-        {'name': 'Cape Town', 'lat': -33.9249, 'lon': 18.4241},
+    started = time.perf_counter()
+    try:
+        response = await get_with_retries(http_client, semaphore, f"{OPENWEATHER_URL}/group", params)
+    except RuntimeError as e:
+        import_fetch_duration.observe(time.perf_counter() - started, endpoint='group', status='error')
+        print(f"Error fetching weather for group of {len(cities)} cities: {e}")
+        return []
+    import_fetch_duration.observe(time.perf_counter() - started, endpoint='group', status=response.status_code)
+
+    if response.status_code != 200:
+        print(f"Error fetching weather for group of {len(cities)} cities: HTTP {response.status_code}")
+        return []
+
+    observations = []
+    for weather_data in response.json().get('list', []):
+        city = cities_by_id.get(weather_data.get('id'))
+        if city is not None:
+            observations.append((city, weather_data))
+    return observations
+
+async def fetch_cycle(http_client, cities, api_key, mode='group', validators=None):
+    # (city, weather data) of every city that answered
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    grouped = [city for city in cities if mode == 'group' and city.get('id')]
+    single = [city for city in cities if not (mode == 'group' and city.get('id'))]
+
+    tasks = [
+        getWeatherGroup(http_client, semaphore, grouped[i:i + GROUP_SIZE], api_key)
+        for i in range(0, len(grouped), GROUP_SIZE)
+    ]
+    tasks += [
+        getWeather(http_client, semaphore, city, api_key, validators)
+        for city in single
     ]
 
-    api_key = 'eaeef179453028c6512a947bb6851f2f'
+    observations = []
+    for result in await asyncio.gather(*tasks):
+        if isinstance(result, list):
+            observations.extend(result)
+        elif result is not None:
+            observations.append(result)
+    return observations
+
+async def queue_records(records, observed=()):
+    # Appended to the ingestion log and committed by its writer; only waits while
+    # the log is full. The observation times of the stations go in the same group,
+    # so they are committed together with their readings.
+    ops = [('create', record) for record in records] + [('observe', item) for item in observed]
+    await submit_writes(ops, wait=False, timeout=None)
+    return len(records)
+
+async def scheduled_job(http_client, cities, api_key, mode='group', scheduler=None, validators=None):
+    # Fetches the cities and queues the readings the scheduler has not seen yet,
+    # by the provider's observation time (dt)
+    with import_cycle_duration.time():
+        observations = await fetch_cycle(http_client, cities, api_key, mode, validators)
+
+        records = []
+        observed = []
+        for city, weather_data in observations:
+            if weather_data is None:
+                continue
+            dt = weather_data.get('dt')
+            if scheduler is not None and not scheduler.observed(city['name'], dt, time.time()):
+                continue
+            records.append(weather_record(city['name'], city['lat'], city['lon'], weather_data))
+            if dt is not None:
+                observed.append({'name': city['name'], 'dt': dt})
+
+        unchanged = len(observations) - len(records)
+        import_unchanged_observations.inc(unchanged)
+        if records:
+            await queue_records(records, observed)
+    print(f"Job executed at {datetime.utcnow()}: queued {len(records)}/{len(cities)} cities, {unchanged} unchanged")
+    return len(records)
+
+async def run_schedule(db, http_client, api_key, mode='group'):
+    # Each station is fetched once per interval in a slot of its own, the
+    # stations due in the same tick share the requests (group mode). The station
+    # table is read again every STATION_REFRESH_SECONDS, for new stations and
+    # interval changes.
+    scheduler = StationScheduler()
+    validators = {}
+    jobs = set()
+    refresh_at = 0
+    while True:
+        now = time.time()
+        if now >= refresh_at:
+            refresh_at = now + STATION_REFRESH_SECONDS
+            try:
+                scheduler.update(await db.station.find_many(where={'enabled': True}), now)
+            except Exception as e:
+                print(f"Error reading stations: {e}")
+
+        due = scheduler.pop_due(now)
+        if due:
+            job = asyncio.create_task(scheduled_job(
+                http_client, [station_city(station) for station in due], api_key, mode, scheduler, validators,
+            ))
+            jobs.add(job)
+            job.add_done_callback(jobs.discard)
+        await asyncio.sleep(IMPORT_TICK_SECONDS)
+
+async def add_station(db, name, lat, lon, provider_id=None, interval=None):
+    data = {'latitude': lat, 'longitude': lon, 'provider_id': provider_id, 'enabled': True}
+    if interval is not None:
+        data['interval_seconds'] = interval
+    await db.station.upsert(where={'name': name}, data={'create': {'name': name, **data}, 'update': data})
+    print(f"Saved station {name}")
 
-    db = Prisma()
+def bulk_record(weather_data):
+    # Bulk snapshot lines carry the city next to the reading, current weather
+    # responses carry it at the top level: accept both shapes
+    city = weather_data.get('city', weather_data)
+    coord = city.get('coord', {})
+    record = weather_record(city['name'], coord['lat'], coord['lon'], weather_data)
+    if 'dt' in weather_data:
+        record['timestamp'] = datetime.utcfromtimestamp(weather_data['dt'])
+    return record
+
+async def iter_bulk_lines(source, http_client):
+    if source.startswith(('http://', 'https://')):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if source.endswith('.gz') else None
+        pending = b''
+        async with http_client.stream('GET', source) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                pending += decompressor.decompress(chunk) if decompressor else chunk
+                *lines, pending = pending.split(b'\n')
+                for line in lines:
+                    yield line
+        if decompressor:
+            pending += decompressor.flush()
+        if pending:
+            yield pending
+        return
+
+    opener = gzip.open if source.endswith('.gz') else open
+    with opener(source, 'rb') as f:
+        for line in f:
+            yield line
+
+async def import_export_file(db, source):
+    # Arrow IPC or Parquet file written by exportWeatherData.py or GET /weather/export
+    saved = 0
+    for batch in read_export(source, BULK_BATCH_SIZE):
+        saved += await queue_records(batch)
+    print(f"Import of {source} finished: queued {saved} rows")
+    return saved
+
+async def import_bulk(db, http_client, source, batch_size=BULK_BATCH_SIZE):
+    # Streams a newline-delimited (optionally gzipped) snapshot into batched inserts
+    if source.endswith(ARROW_EXTENSIONS):
+        return await import_export_file(db, source)
+
+    batch = []
+    saved = 0
+    async for line in iter_bulk_lines(source, http_client):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            batch.append(bulk_record(json.loads(line)))
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            print(f"Skipping invalid bulk line: {e}")
+            continue
+
+        if len(batch) >= batch_size:
+            saved += await queue_records(batch)
+            batch = []
+
+    if batch:
+        saved += await queue_records(batch)
+    print(f"Bulk import of {source} finished: queued {saved} rows")
+    return saved
+
+async def importWeatherData(mode='group', bulk_source=None, metrics_port=None, station=None):
+    load_dotenv()
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    api_key = os.getenv('OPENWEATHER_API_KEY', 'eaeef179453028c6512a947bb6851f2f')
+
+    db = Client(datasource={'url': database_url()})
+    http_client = create_http_client()
 
     try:
         await db.connect()
+        await apply_pragmas(db)
         print("Connected to the database")
-        loop = asyncio.get_event_loop()
-        schedule.every(5).minutes.do(lambda: loop.create_task(scheduled_job(db, cities, api_key)))
-        while True:
-            schedule.run_pending()
-            await asyncio.sleep(1)
+        if station is not None:
+            await add_station(db, **station)
+            return
+        await start_ingest(db, 'importer')
+        if bulk_source is not None:
+            await import_bulk(db, http_client, bulk_source)
+            # The rows are only imported once the writer has committed them
+            left = await stop_ingest()
+            if left:
+                print(f"Bulk import of {bulk_source} incomplete: {left} writes not committed, they are replayed by the next run of the importer")
+                return 1
+            return
+
+        await run_schedule(db, http_client, api_key, mode)
 
     finally:
+        await http_client.aclose()
+        await stop_ingest()
         await db.disconnect()
 
 if __name__ == "__main__":
-    asyncio.run(importWeatherData())
+    parser = argparse.ArgumentParser(description='Import the weather of every station in the database, each at its own interval')
+    parser.add_argument('--mode', choices=['group', 'single'], default='group',
+                        help=f'group packs up to {GROUP_SIZE} city ids per API request, single makes one request per city')
+    parser.add_argument('--bulk', metavar='FILE_OR_URL',
+                        help='import a newline-delimited (optionally .gz) bulk snapshot, or an .arrow/.arrows/.parquet export, once and exit')
+    parser.add_argument('--metrics-port', type=int, default=int(os.getenv('IMPORT_METRICS_PORT', 0)) or None,
+                        help='serve Prometheus metrics of the importer on this port')
+    parser.add_argument('--add-station', nargs=3, metavar=('NAME', 'LAT', 'LON'),
+                        help='create or update a station and exit')
+    parser.add_argument('--provider-id', type=int,
+                        help='OpenWeatherMap city id of the station, needed for the group endpoint')
+    parser.add_argument('--interval', type=int,
+                        help=f'seconds between two fetches of the station (default {IMPORT_INTERVAL_SECONDS:g})')
+    args = parser.parse_args()
+    station = None
+    if args.add_station:
+        name, lat, lon = args.add_station
+        station = {'name': name, 'lat': float(lat), 'lon': float(lon), 'provider_id': args.provider_id, 'interval': args.interval}
+    sys.exit(asyncio.run(importWeatherData(args.mode, args.bulk, args.metrics_port, station)))
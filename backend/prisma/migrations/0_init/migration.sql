@@ -0,0 +1,13 @@
+-- CreateTable
+CREATE TABLE "WeatherData" (
+    "id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+    "city_name" TEXT NOT NULL,
+    "latitude" REAL NOT NULL,
+    "longitude" REAL NOT NULL,
+    "temperature" REAL NOT NULL,
+    "feels_like" REAL NOT NULL,
+    "humidity" INTEGER NOT NULL,
+    "pressure" INTEGER NOT NULL,
+    "description" TEXT NOT NULL,
+    "timestamp" DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,5 @@
+-- CreateIndex
+CREATE INDEX "WeatherData_city_name_timestamp_idx" ON "WeatherData"("city_name", "timestamp");
+
+-- CreateIndex
+CREATE INDEX "WeatherData_timestamp_idx" ON "WeatherData"("timestamp");
@@ -0,0 +1,45 @@
+-- CreateTable
+CREATE TABLE "WeatherHourly" (
+    "id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+    "city_name" TEXT NOT NULL,
+    "bucket_start" DATETIME NOT NULL,
+    "samples" INTEGER NOT NULL,
+    "temperature_min" REAL NOT NULL,
+    "temperature_max" REAL NOT NULL,
+    "temperature_mean" REAL NOT NULL,
+    "feels_like_min" REAL NOT NULL,
+    "feels_like_max" REAL NOT NULL,
+    "feels_like_mean" REAL NOT NULL,
+    "humidity_min" REAL NOT NULL,
+    "humidity_max" REAL NOT NULL,
+    "humidity_mean" REAL NOT NULL,
+    "pressure_min" REAL NOT NULL,
+    "pressure_max" REAL NOT NULL,
+    "pressure_mean" REAL NOT NULL
+);
+
+-- CreateTable
+CREATE TABLE "WeatherDaily" (
+    "id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+    "city_name" TEXT NOT NULL,
+    "bucket_start" DATETIME NOT NULL,
+    "samples" INTEGER NOT NULL,
+    "temperature_min" REAL NOT NULL,
+    "temperature_max" REAL NOT NULL,
+    "temperature_mean" REAL NOT NULL,
+    "feels_like_min" REAL NOT NULL,
+    "feels_like_max" REAL NOT NULL,
+    "feels_like_mean" REAL NOT NULL,
+    "humidity_min" REAL NOT NULL,
+    "humidity_max" REAL NOT NULL,
+    "humidity_mean" REAL NOT NULL,
+    "pressure_min" REAL NOT NULL,
+    "pressure_max" REAL NOT NULL,
+    "pressure_mean" REAL NOT NULL
+);
+
+-- CreateIndex
+CREATE UNIQUE INDEX "WeatherHourly_city_name_bucket_start_key" ON "WeatherHourly"("city_name", "bucket_start");
+
+-- CreateIndex
+CREATE UNIQUE INDEX "WeatherDaily_city_name_bucket_start_key" ON "WeatherDaily"("city_name", "bucket_start");
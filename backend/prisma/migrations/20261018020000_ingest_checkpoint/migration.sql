@@ -0,0 +1,5 @@
+-- CreateTable
+CREATE TABLE "IngestCheckpoint" (
+    "name" TEXT NOT NULL PRIMARY KEY,
+    "seq" BIGINT NOT NULL
+);
@@ -0,0 +1,22 @@
+-- CreateTable
+CREATE TABLE "Station" (
+    "id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+    "name" TEXT NOT NULL,
+    "provider_id" INTEGER,
+    "latitude" REAL NOT NULL,
+    "longitude" REAL NOT NULL,
+    "interval_seconds" INTEGER NOT NULL DEFAULT 300,
+    "enabled" BOOLEAN NOT NULL DEFAULT true,
+    "last_observed_dt" INTEGER
+);
+
+-- CreateIndex
+CREATE UNIQUE INDEX "Station_name_key" ON "Station"("name");
+
+-- Cities the importer used to have built in
+INSERT INTO "Station" ("name", "provider_id", "latitude", "longitude") VALUES
+    ('Paris', 2988507, 48.8566, 2.3522),
+    ('New York', 5128581, 40.7128, -74.0060),
+    ('Tokyo', 1850147, 35.6895, 139.6917),
+    ('Sydney', 2147714, -33.8688, 151.2093),
+    ('Cape Town', 3369157, -33.9249, 18.4241);
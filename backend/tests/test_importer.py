@@ -0,0 +1,140 @@
+# Runs the importer's fetch side against the local OpenWeatherMap stub
+# (benchmarks/stub_openweather.py): python -m pytest tests
+import asyncio
+
+import pytest
+
+import importWeatherData
+from stub_openweather import start_stub
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    servers = []
+
+    def start(**options):
+        server, url = start_stub(**options)
+        servers.append(server)
+        monkeypatch.setattr(importWeatherData, 'OPENWEATHER_URL', url)
+        return server.RequestHandlerClass
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def queued(monkeypatch):
+    # Records passed to queue_records instead of the ingestion log
+    records = []
+
+    async def queue_records(batch, observed=()):
+        records.extend(batch)
+        return len(batch)
+
+    monkeypatch.setattr(importWeatherData, 'queue_records', queue_records)
+    return records
+
+
+def cities(count):
+    return [
+        {'id': i, 'name': f'City {i}', 'lat': (i * 7.31) % 180 - 90, 'lon': (i * 13.7) % 360 - 180}
+        for i in range(1, count + 1)
+    ]
+
+
+async def fetch(mode, stations, validators=None):
+    http_client = importWeatherData.create_http_client()
+    try:
+        return await importWeatherData.fetch_cycle(http_client, stations, 'stub', mode, validators)
+    finally:
+        await http_client.aclose()
+
+
+async def job(mode, stations, validators):
+    http_client = importWeatherData.create_http_client()
+    try:
+        return await importWeatherData.scheduled_job(http_client, stations, 'stub', mode, None, validators)
+    finally:
+        await http_client.aclose()
+
+
+@pytest.fixture
+def backoffs(monkeypatch):
+    # Delays the importer asked for between retries, without waiting for them
+    delays = []
+    sleep = asyncio.sleep
+
+    async def record(delay, *args, **kwargs):
+        delays.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(importWeatherData.asyncio, 'sleep', record)
+    monkeypatch.setattr(importWeatherData.random, 'uniform', lambda low, high: 0)
+    return delays
+
+
+@pytest.mark.parametrize('status', [429, 500, 503])
+def test_retries_throttling_and_server_errors_with_backoff(stub, backoffs, status):
+    handler = stub(fail_with=[status, status])
+
+    observations = asyncio.run(fetch('single', cities(1)))
+
+    assert len(observations) == 1
+    assert handler.requests_served == 3
+    backoff = importWeatherData.BACKOFF_SECONDS
+    assert backoffs == [backoff, backoff * 2]
+
+
+def test_gives_up_after_the_last_retry(stub, backoffs):
+    attempts = importWeatherData.MAX_RETRIES + 1
+    handler = stub(fail_with=[503] * attempts)
+
+    assert asyncio.run(fetch('single', cities(1))) == []
+    assert handler.requests_served == attempts
+    assert len(backoffs) == importWeatherData.MAX_RETRIES
+
+
+def test_does_not_retry_client_errors(stub, backoffs):
+    handler = stub(fail_with=[404])
+
+    assert asyncio.run(fetch('single', cities(1))) == []
+    assert handler.requests_served == 1
+    assert backoffs == []
+
+
+def test_requests_in_flight_stay_within_the_concurrency_limit(stub, monkeypatch):
+    monkeypatch.setattr(importWeatherData, 'MAX_CONCURRENT_REQUESTS', 4)
+    handler = stub(latency_ms=50)
+
+    observations = asyncio.run(fetch('single', cities(30)))
+
+    assert len(observations) == 30
+    assert handler.max_in_flight <= 4
+    assert handler.max_in_flight > 1
+
+
+def test_group_mode_asks_for_twenty_cities_per_request(stub):
+    handler = stub()
+
+    observations = asyncio.run(fetch('group', cities(45)))
+
+    assert len(observations) == 45
+    group_sizes = sorted(len(query['id'][0].split(',')) for path, query, _ in handler.requests)
+    assert group_sizes == [5, importWeatherData.GROUP_SIZE, importWeatherData.GROUP_SIZE]
+    assert all(path.endswith('/group') for path, _, _ in handler.requests)
+
+
+def test_not_modified_readings_are_not_queued_again(stub, queued):
+    handler = stub()
+    stations = cities(3)
+    validators = {}
+
+    assert asyncio.run(job('single', stations, validators)) == 3
+    assert asyncio.run(job('single', stations, validators)) == 0
+
+    assert len(queued) == 3
+    second_cycle = handler.requests[3:]
+    assert len(second_cycle) == 3
+    assert all('If-None-Match' in headers for _, _, headers in second_cycle)
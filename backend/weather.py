@@ -1,108 +1,73 @@
-from flask import Flask, request, jsonify
-from flask_socketio import SocketIO
-from prisma import Prisma, Client
-from apscheduler.schedulers.background import BackgroundScheduler
-from datetime import datetime, timedelta
-from weather_api import init_routes
-from weather_auth import init_auth_routes
-from weather_api_service import weather_data_to_dict
-from flask_jwt_extended import JWTManager
-from flasgger import Swagger
-from importWeatherData import importWeatherData
-from flask_cors import CORS
+from flask import request
+from flask_socketio import SocketIO, join_room, leave_room
+from weather_app import create_app, init_app, subscribed_cities, CORS_ORIGINS
+from weather_db import connect_db, disconnect_db, run_on_db_sync
+from weather_ingest import start_ingest, stop_ingest
+from weather_auth import ensure_default_user
+from weather_feed import ChangeFeed, FEED_LOCK_FILE, parse_since
+from weather_batcher import EmitBatcher
+from weather_retention import RetentionJob
+from weather_bus import socketio_queue_options
+from weather_metrics import socketio_connected_clients
 from dotenv import load_dotenv
-import asyncio
+import atexit
 import os
 
-
-def create_app():
-    app = Flask(__name__)
-    app.config["DEBUG"] = True
-    app.config['SECRET_KEY'] = 'secret'
-    app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET')  # Change this to a secure secret key
-    app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(days=1)
-    app.config['SWAGGER'] = {
-        'title': 'Weather API',
-        'uiversion': 3,
-        'openapi': '3.0.2',
-        'description': 'API for weather data management',
-        'termsOfService': 'https://example.com/terms',
-        'contact': {
-            'name': 'Your Name',
-            'url': 'https://example.com/contact',
-            'email': 'your.email@example.com',
-        },
-        'license': {
-            'name': 'Your License',
-            'url': 'https://example.com/license',
-        },
-    }
-    return app
-
-prisma = Client()
-app = create_app()
 load_dotenv()
-cors = CORS(app, resources={r"/*": {"origins": "http://localhost:5173"}})
-socketio = SocketIO(app, cors_allowed_origins="http://localhost:5173")
-
-init_routes(app, socketio)
-init_auth_routes(app)
-jwt = JWTManager(app)
-swagger = Swagger(app)
-
-async def get_latest_data_from_db():
-    try:
-        await prisma.connect()
-
-        current_datetime = datetime.utcnow()
-
-        five_minutes_ago = current_datetime - timedelta(minutes=5)
-        latest_data = await prisma.weatherdata.find_many(
-            where={
-                'timestamp': {
-                    'gte': five_minutes_ago,
-                    'lte': current_datetime
-                }
-            }
-        )
-
-        serialized_data = [weather_data_to_dict(data) for data in latest_data]
-        return serialized_data
-
-    except Exception as e:
-        print(f"Error retrieving latest data from database: {e}")
-        return None
-
-    finally:
-        await prisma.disconnect()
-
-async def emit_latest_data_to_clients():
-    try:
-        latest_data = await get_latest_data_from_db()
-        if latest_data is not None:
-            print("Emitting latest data to clients")
-            socketio.emit('latest_data', latest_data, namespace='/data')
-    except Exception as e:
-        print(f"Error emitting latest data to clients: {e}")
-
-def start_scheduler():
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(
-        lambda: asyncio.run(emit_latest_data_to_clients()),
-        trigger='interval',
-        minutes=5
-    )
-    scheduler.start()
-
+app = create_app()
+connect_db()
+atexit.register(disconnect_db)
+run_on_db_sync(ensure_default_user)
+run_on_db_sync(lambda db: start_ingest(db, 'api'))
+atexit.register(lambda: run_on_db_sync(lambda db: stop_ingest()))
+socketio_options = socketio_queue_options()
+socketio = SocketIO(app, cors_allowed_origins=CORS_ORIGINS, **socketio_options)
+
+# With a message queue several workers share the clients, only one of them runs the feed
+feed_lock = FEED_LOCK_FILE if socketio_options else None
+batcher = EmitBatcher(socketio, per_client=not socketio_options)
+feed = ChangeFeed(socketio, batcher, leader_lock=feed_lock)
+retention = RetentionJob(socketio, should_run=lambda: feed.is_leader)
+
+init_app(app, batcher, feed)
 
 @socketio.on('connect', namespace='/data')
-def handle_connect():
+def handle_connect(auth=None):
     print("Client connected")
+    for city in subscribed_cities(auth):
+        join_room(city)
+    if isinstance(auth, dict):
+        feed.resume(request.sid, parse_since(auth.get('since')))
+    # Last, a connection refused by an error above is never disconnected
+    socketio_connected_clients.inc()
+
+@socketio.on('subscribe', namespace='/data')
+def handle_subscribe(data):
+    for city in subscribed_cities(data):
+        join_room(city)
+
+@socketio.on('unsubscribe', namespace='/data')
+def handle_unsubscribe(data):
+    for city in subscribed_cities(data):
+        leave_room(city)
+
+@socketio.on('resume', namespace='/data')
+def handle_resume(data):
+    if isinstance(data, dict):
+        feed.resume(request.sid, parse_since(data.get('since')))
 
 @socketio.on('disconnect', namespace='/data')
 def handle_disconnect():
     print("Client disconnected")
+    socketio_connected_clients.dec()
+    batcher.forget(request.sid)
 
 if __name__ == '__main__':
-    start_scheduler()
-    socketio.run(app, port=8080, debug=True)
\ No newline at end of file
+    feed.start()
+    atexit.register(feed.stop)
+    atexit.register(batcher.stop)
+    retention.start()
+    atexit.register(retention.stop)
+    # The reloader starts everything a second time in a child process, RELOAD=0
+    # leaves it out for workers that are not edited
+    socketio.run(app, port=int(os.getenv('PORT', 8080)), debug=True, use_reloader=os.getenv('RELOAD', '1') == '1')
\ No newline at end of file
@@ -1,333 +1,292 @@
-from flask import request, jsonify
-from flasgger.utils import swag_from
+from flask import request, jsonify, Response
 from weather_api_service import (get_all_weather_service,
+                                 get_weather_page_service,
+                                 iter_weather_batches,
+                                 iter_weather_export_batches,
+                                 parse_time_range,
                                  get_weather_by_id_service,
+                                 get_latest_weather_service,
                                  create_weather_service,
+                                 create_weather_batch_service,
                                  delete_weather_service,
-                                 get_weather_by_filter_service,
-                                 update_weather_service)
+                                 get_weather_history_service,
+                                 get_nearest_weather_service,
+                                 get_weather_in_box_service,
+                                 get_weather_aggregate_service,
+                                 get_weather_downsample_service,
+                                 update_weather_service,
+                                 DEFAULT_PAGE_SIZE,
+                                 DEFAULT_NEAREST,
+                                 AGGREGATE_BUCKETS,
+                                 DOWNSAMPLE_FIELDS,
+                                 DEFAULT_DOWNSAMPLE_POINTS,
+                                 MIN_DOWNSAMPLE_POINTS,
+                                 MAX_DOWNSAMPLE_POINTS,
+                                 MAX_BATCH_SIZE)
+from weather_db import db_health
+from weather_ingest import IngestQueueFull
+from weather_cache import latest_cache, HISTORY_MAX_AGE
+from weather_window import hot_window
+from weather_feed import city_rooms
+from weather_serialize import dumps, RESPONSE_FORMATS
+from weather_export import load_pyarrow, write_export, EXPORT_FORMATS
+from weather_metrics import render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from weather_docs import swag_path
 from flask_jwt_extended import jwt_required
+import time
+
+def response_format_error():
+    return jsonify({'message': f"format must be one of {', '.join(RESPONSE_FORMATS)}"}), 400
+
+def coordinate_error(**coordinates):
+    for name, value in coordinates.items():
+        limit = 90 if name.endswith('lat') else 180
+        if value is None or not -limit <= value <= limit:
+            return jsonify({'message': f'{name} must be a number between -{limit} and {limit}'}), 400
+    return None
+
+def ndjson_stream(logger, after_id=None):
+    # A database error is raised again so that the connection is aborted: the
+    # client must not mistake a truncated stream for a complete one
+    try:
+        for batch in iter_weather_batches(after_id):
+            yield b''.join(dumps(row) + b'\n' for row in batch)
+    except Exception:
+        logger.exception("Error streaming weather data")
+        raise
+
+def json_array_stream(logger, after_id=None):
+    # Without the closing bracket when a database error aborts the stream
+    yield b'['
+    first = True
+    try:
+        for batch in iter_weather_batches(after_id):
+            chunk = dumps(batch)[1:-1]
+            yield chunk if first else b',' + chunk
+            first = False
+    except Exception:
+        logger.exception("Error streaming weather data")
+        raise
+    yield b']'
+
+def init_routes(app, emitter, feed):
+    @app.errorhandler(IngestQueueFull)
+    def ingest_queue_full(e):
+        return jsonify({'message': 'Too many writes waiting for the database, retry later'}), 503, {'Retry-After': '1'}
 
-def init_routes(app, socketio):
     @app.route('/weather', methods=['GET'])
-    @swag_from({
-        'parameters': [
-            {
-                'in': 'header',
-                'name': 'Authorization',
-                'required': True,
-                'description': 'Bearer token for authentication',
-                'type': 'string',
-                'format': 'JWT',
-                'default': 'Bearer YOUR_TOKEN',
-            },
-        ],
-        'responses': {
-            200: {
-                'description': 'Successful response',
-                'content': {
-                    'application/json': {
-                        'example': [
-                            {
-                                'id': 1,
-                                'city_name': 'Paris',
-                                'latitude': 48.8566,
-                                'longitude': 2.3522,
-                                'temperature': 20.5,
-                                'feels_like': 22.3,
-                                'humidity': 60,
-                                'pressure': 1015,
-                                'description': 'Partly Cloudy',
-                                'timestamp': '2024-03-06 12:30:00',
-                            },
-                        ],
-                    },
-                },
-            },
-        },
-    })
+    @swag_path('get_all_weather.yml')
     @jwt_required()
     async def get_all_weather():
-        weather_data = await get_all_weather_service()
+        after_id = request.args.get('after_id', None, type=int)
+        limit = request.args.get('limit', None, type=int)
+        stream = request.args.get('stream', None)
+        response_format = request.args.get('format', 'rows')
+        if response_format not in RESPONSE_FORMATS:
+            return response_format_error()
+
+        if stream == 'ndjson':
+            return Response(ndjson_stream(app.logger, after_id), mimetype='application/x-ndjson')
+        if stream == 'json':
+            return Response(json_array_stream(app.logger, after_id), mimetype='application/json')
+
+        if after_id is not None or limit is not None:
+            weather_data, next_after_id = await get_weather_page_service(after_id, limit or DEFAULT_PAGE_SIZE, response_format)
+            response = jsonify(weather_data)
+            if next_after_id is not None:
+                response.headers['X-Next-After-Id'] = str(next_after_id)
+            return response
+
+        weather_data = await get_all_weather_service(response_format)
         return jsonify(weather_data)
 
     @app.route('/weather/city/<string:city>', methods=['GET'])
-    @swag_from({
-        'parameters': [
-            {
-                'in': 'header',
-                'name': 'Authorization',
-                'required': True,
-                'description': 'Bearer token for authentication',
-                'type': 'string',
-                'format': 'JWT',
-            },
-            {
-                'in': 'path',
-                'name': 'city',
-                'required': True,
-                'description': 'City name for weather data',
-                'type': 'string',
-            },
-            {
-                'in': 'query',
-                'name': 'start_time',
-                'required': False,
-                'description': 'Start time for filtering',
-                'type': 'string',
-                'format': 'datetime',
-            },
-            {
-                'in': 'query',
-                'name': 'end_time',
-                'required': False,
-                'description': 'End time for filtering',
-                'type': 'string',
-                'format': 'datetime',
-            },
-        ],
-        'responses': {
-            200: {
-                'description': 'Successful response',
-                'content': {
-                    'application/json': {
-                        'example': [
-                            {
-                                'id': 1,
-                                'city_name': 'Paris',
-                                'latitude': 48.8566,
-                                'longitude': 2.3522,
-                                'temperature': 20.5,
-                                'feels_like': 22.3,
-                                'humidity': 60,
-                                'pressure': 1015,
-                                'description': 'Partly Cloudy',
-                                'timestamp': '2024-03-06 12:30:00',
-                            },
-                        ],
-                    },
-                },
-            },
-        },
-    })
+    @swag_path('get_weather_by_city.yml')
     @jwt_required()
     async def get_weather_by_city(city):
         start_time = request.args.get('start_time', None)
         end_time = request.args.get('end_time', None)
-        weather_data = await get_weather_by_filter_service(city, start_time, end_time)
+        response_format = request.args.get('format', 'rows')
+        if response_format not in RESPONSE_FORMATS:
+            return response_format_error()
+        history = await get_weather_history_service(city, start_time, end_time, response_format)
+        if history is None:
+            return jsonify(None)
+
+        body, etag, last_modified, end_ms, cache_hit = history
+        response = Response(body, mimetype='application/json')
+        response.headers['X-Cache'] = 'HIT' if cache_hit else 'MISS'
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.private = True
+        if end_ms is not None and end_ms < time.time() * 1000:
+            # The range is over, only a late write or a deletion can still change it
+            response.cache_control.max_age = HISTORY_MAX_AGE
+        else:
+            response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    @app.route('/weather/city/<string:city>/aggregate', methods=['GET'])
+    @swag_path('get_weather_aggregate.yml')
+    @jwt_required()
+    async def get_weather_aggregate(city):
+        start_time = request.args.get('start_time', None)
+        end_time = request.args.get('end_time', None)
+        bucket = request.args.get('bucket', '1h')
+        if bucket not in AGGREGATE_BUCKETS:
+            return jsonify({'message': f"bucket must be one of {', '.join(AGGREGATE_BUCKETS)}"}), 400
+        weather_data = await get_weather_aggregate_service(city, start_time, end_time, bucket)
+        return jsonify(weather_data)
+
+    @app.route('/weather/city/<string:city>/downsample', methods=['GET'])
+    @swag_path('get_weather_downsample.yml')
+    @jwt_required()
+    async def get_weather_downsample(city):
+        start_time = request.args.get('start_time', None)
+        end_time = request.args.get('end_time', None)
+        field = request.args.get('field', 'temperature')
+        points = request.args.get('points', DEFAULT_DOWNSAMPLE_POINTS, type=int)
+        if field not in DOWNSAMPLE_FIELDS:
+            return jsonify({'message': f"field must be one of {', '.join(DOWNSAMPLE_FIELDS)}"}), 400
+        if not MIN_DOWNSAMPLE_POINTS <= points <= MAX_DOWNSAMPLE_POINTS:
+            return jsonify({'message': f'points must be between {MIN_DOWNSAMPLE_POINTS} and {MAX_DOWNSAMPLE_POINTS}'}), 400
+        weather_data = await get_weather_downsample_service(city, start_time, end_time, field, points)
         return jsonify(weather_data)
 
     @app.route('/weather/<int:id>', methods=['GET'])
-    @swag_from({
-        'parameters': [
-            {
-                'in': 'header',
-                'name': 'Authorization',
-                'required': True,
-                'description': 'Bearer token for authentication',
-                'type': 'string',
-                'format': 'JWT',
-            },
-            {
-                'in': 'path',
-                'name': 'id',
-                'required': True,
-                'description': 'Weather data ID',
-                'type': 'integer',
-            },
-        ],
-        'responses': {
-            200: {
-                'description': 'Successful response',
-                'content': {
-                    'application/json': {
-                        'example': {
-                            'id': 1,
-                            'city_name': 'Paris',
-                            'latitude': 48.8566,
-                            'longitude': 2.3522,
-                            'temperature': 20.5,
-                            'feels_like': 22.3,
-                            'humidity': 60,
-                            'pressure': 1015,
-                            'description': 'Partly Cloudy',
-                            'timestamp': '2024-03-06 12:30:00',
-                        },
-                    },
-                },
-            },
-        },
-    })
+    @swag_path('get_weather_by_id.yml')
     @jwt_required()
     async def get_weather_by_id(id):
         weather_data = await get_weather_by_id_service(id)
         return jsonify(weather_data)
 
+    @app.route('/weather/latest', methods=['GET'])
+    @swag_path('get_latest_weather.yml')
+    @jwt_required()
+    async def get_latest_weather():
+        city = request.args.get('city', None)
+        weather_data, cache_hit = await get_latest_weather_service(city)
+        if weather_data is None:
+            return jsonify({'message': 'Error retrieving latest weather data'}), 500
+
+        response = jsonify(weather_data)
+        response.headers['X-Cache'] = 'HIT' if cache_hit else 'MISS'
+        response.add_etag()
+        return response.make_conditional(request)
+
+    @app.route('/weather/latest/stats', methods=['GET'])
+    @swag_path('get_latest_weather_stats.yml')
+    @jwt_required()
+    def get_latest_weather_stats():
+        return jsonify({**latest_cache.stats(), 'hot_window': hot_window.stats()})
+
+    @app.route('/weather/nearest', methods=['GET'])
+    @swag_path('get_nearest_weather.yml')
+    @jwt_required()
+    async def get_nearest_weather():
+        lat = request.args.get('lat', None, type=float)
+        lon = request.args.get('lon', None, type=float)
+        k = request.args.get('k', DEFAULT_NEAREST, type=int)
+        error = coordinate_error(lat=lat, lon=lon)
+        if error is not None:
+            return error
+
+        weather_data = await get_nearest_weather_service(lat, lon, k)
+        if weather_data is None:
+            return jsonify({'message': 'Error retrieving nearest weather data'}), 500
+        return jsonify(weather_data)
+
+    @app.route('/weather/bbox', methods=['GET'])
+    @swag_path('get_weather_in_box.yml')
+    @jwt_required()
+    async def get_weather_in_box():
+        box = {name: request.args.get(name, None, type=float) for name in ('min_lat', 'min_lon', 'max_lat', 'max_lon')}
+        error = coordinate_error(**box)
+        if error is not None:
+            return error
+        if box['min_lat'] > box['max_lat']:
+            return jsonify({'message': 'min_lat must not be greater than max_lat'}), 400
+
+        weather_data = await get_weather_in_box_service(box['min_lat'], box['min_lon'], box['max_lat'], box['max_lon'])
+        if weather_data is None:
+            return jsonify({'message': 'Error retrieving weather data in box'}), 500
+        return jsonify(weather_data)
+
+    @app.route('/weather/export', methods=['GET'])
+    @swag_path('export_weather.yml')
+    @jwt_required()
+    def export_weather():
+        export_format = request.args.get('format', 'parquet')
+        if export_format not in EXPORT_FORMATS:
+            return jsonify({'message': f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+        if not load_pyarrow():
+            return jsonify({'message': 'Exports need pyarrow on the server'}), 501
+
+        start_ms, end_ms = parse_time_range(request.args.get('start_time'), request.args.get('end_time'))
+        batches = iter_weather_export_batches(start_ms, end_ms, request.args.get('city'))
+        mimetype, extension = EXPORT_FORMATS[export_format]
+        return Response(
+            write_export(batches, export_format),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename=weather.{extension}'},
+        )
+
     @app.route('/weather', methods=['POST'])
-    @swag_from({
-        'parameters': [
-            {
-                'in': 'header',
-                'name': 'Authorization',
-                'required': True,
-                'description': 'Bearer token for authentication',
-                'type': 'string',
-                'format': 'JWT',
-            },
-            {
-                'in': 'body',
-                'name': 'weather_params',
-                'required': True,
-                'description': 'Weather data parameters for creation',
-                'schema': {
-                    'type': 'object',
-                    'properties': {
-                        'city_name': {'type': 'string'},
-                        'latitude': {'type': 'number'},
-                        'longitude': {'type': 'number'},
-                        'temperature': {'type': 'number'},
-                        'feels_like': {'type': 'number'},
-                        'humidity': {'type': 'integer'},
-                        'pressure': {'type': 'integer'},
-                        'description': {'type': 'string'},
-                    },
-                },
-            },
-        ],
-        'responses': {
-            200: {
-                'description': 'Successful response',
-                'content': {
-                    'application/json': {
-                        'example': {
-                            'id': 1,
-                            'city_name': 'Paris',
-                            'latitude': 48.8566,
-                            'longitude': 2.3522,
-                            'temperature': 20.5,
-                            'feels_like': 22.3,
-                            'humidity': 60,
-                            'pressure': 1015,
-                            'description': 'Partly Cloudy',
-                            'timestamp': '2024-03-06 12:30:00',
-                        },
-                    },
-                },
-            },
-        },
-    })
+    @swag_path('create_weather.yml')
     @jwt_required()
     async def create_weather():
         weather_params = request.json
         created_weather = await create_weather_service(weather_params)
-        socketio.emit('send_newdata', created_weather, namespace='/data')
+        feed.notify()
         return jsonify(created_weather)
 
+    @app.route('/weather/batch', methods=['POST'])
+    @swag_path('create_weather_batch.yml')
+    @jwt_required()
+    async def create_weather_batch():
+        items = request.json
+        if not isinstance(items, list):
+            return jsonify({'message': 'Expected a JSON array of weather data'}), 400
+        if len(items) > MAX_BATCH_SIZE:
+            return jsonify({'message': f'A batch holds at most {MAX_BATCH_SIZE} items'}), 413
+
+        created_weather, errors = await create_weather_batch_service(items)
+        if created_weather is None:
+            return jsonify({'message': 'Error creating weather data', 'errors': errors}), 500
+        if created_weather:
+            feed.notify()
+        return jsonify({'created': created_weather, 'errors': errors})
+
     @app.route('/weather', methods=['PATCH'])
-    @swag_from({
-        'parameters': [
-    {
-        'in': 'header',
-        'name': 'Authorization',
-        'required': True,
-        'description': 'Bearer token for authentication',
-        'type': 'string',
-        'format': 'JWT',
-    },
-    {
-        'in': 'body',
-        'name': 'weather_params',
-        'required': True,
-        'description': 'Weather data parameters for update',
-        'schema': {
-            'type': 'object',
-            'properties': {
-                'id': {'type': 'integer'},
-                'city_name': {'type': 'string'},
-                'latitude': {'type': 'number'},
-                'longitude': {'type': 'number'},
-                'temperature': {'type': 'number'},
-                'feels_like': {'type': 'number'},
-                'humidity': {'type': 'integer'},
-                'pressure': {'type': 'integer'},
-                'description': {'type': 'string'},
-            },
-        },
-    },
-    ],
-    'responses': {
-        200: {
-            'description': 'Successful response',
-            'content': {
-                'application/json': {
-                    'example': {
-                        'id': 1,
-                        'city_name': 'Paris',
-                        'latitude': 48.8566,
-                        'longitude': 2.3522,
-                        'temperature': 20.5,
-                        'feels_like': 22.3,
-                        'humidity': 60,
-                        'pressure': 1015,
-                        'description': 'Partly Cloudy',
-                        'timestamp': '2024-03-06 12:30:00',
-                    },
-                },
-            },
-        },
-    },
-    })
+    @swag_path('update_weather.yml')
     @jwt_required()
     async def update_weather():
         weather_params = request.json
-        updated_weather = await update_weather_service(weather_params)
-        socketio.emit('edit_data', updated_weather, namespace='/data')
+        updated_weather, previous_weather = await update_weather_service(weather_params)
+        if updated_weather is not None:
+            # Subscribers of the old city must also hear about a reading moved elsewhere
+            rooms = set(city_rooms(updated_weather['city_name']) + city_rooms(previous_weather['city_name']))
+            emitter.emit('edit_data', updated_weather, namespace='/data', to=list(rooms))
         return jsonify(updated_weather)
 
     @app.route('/weather/<int:id>', methods=['DELETE'])
-    @swag_from({
-        'parameters': [
-            {
-                'in': 'header',
-                'name': 'Authorization',
-                'required': True,
-                'description': 'Bearer token for authentication',
-                'type': 'string',
-                'format': 'JWT',
-            },
-            {
-                'in': 'path',
-                'name': 'id',
-                'required': True,
-                'description': 'Weather data ID',
-                'type': 'integer',
-            },
-        ],
-        'responses': {
-            200: {
-                'description': 'Successful response',
-                'content': {
-                    'application/json': {
-                        'example': {
-                            'id': 1,
-                            'city_name': 'Paris',
-                            'latitude': 48.8566,
-                            'longitude': 2.3522,
-                            'temperature': 20.5,
-                            'feels_like': 22.3,
-                            'humidity': 60,
-                            'pressure': 1015,
-                            'description': 'Partly Cloudy',
-                            'timestamp': '2024-03-06 12:30:00',
-                        },
-                    },
-                },
-            },
-        },
-    })
+    @swag_path('delete_weather.yml')
     @jwt_required()
     async def delete_weather(id):
         weather_data = await delete_weather_service(id)
-        socketio.emit('delete_data', id, namespace='/data')
+        if weather_data is not None:
+            emitter.emit('delete_data', id, namespace='/data', to=city_rooms(weather_data['city_name']))
         return jsonify(weather_data)
 
+
+    @app.route('/health', methods=['GET'])
+    @swag_path('health.yml')
+    def health():
+        if db_health():
+            return jsonify({'status': 'ok', 'database': 'up'})
+        return jsonify({'status': 'error', 'database': 'down'}), 503
+
+    @app.route('/metrics', methods=['GET'])
+    @swag_path('metrics.yml')
+    def metrics():
+        return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
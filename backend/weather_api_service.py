@@ -1,7 +1,34 @@
-from prisma import Prisma, Client
 from datetime import datetime, timezone
+import hashlib
+import time
+from weather_db import run_on_db, run_on_db_sync
+from weather_ingest import submit_writes, IngestQueueFull
+from weather_downsample import lttb
+from weather_cache import latest_cache, history_cache
+from weather_geo import station_index, GEO_REFRESH_SECONDS
+from weather_window import hot_window, HOT_WINDOW_REFRESH_SECONDS, HOT_WINDOW_RELOAD_SECONDS
+from weather_serialize import dumps, weather_dicts, serialize_weather
+from weather_export import fetch_export_rows, EXPORT_BATCH_SIZE
+from weather_retention import rollup_query, HOUR_MS
 
-prisma = Client()
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+
+AGGREGATE_BUCKETS = {
+    '5m': 5 * 60 * 1000,
+    '1h': 60 * 60 * 1000,
+    '1d': 24 * 60 * 60 * 1000,
+}
+DOWNSAMPLE_FIELDS = ('temperature', 'feels_like', 'humidity', 'pressure')
+DEFAULT_DOWNSAMPLE_POINTS = 500
+# LTTB keeps the first and last points and at least one in between
+MIN_DOWNSAMPLE_POINTS = 3
+MAX_DOWNSAMPLE_POINTS = 5000
+MAX_BATCH_SIZE = 5000
+DEFAULT_NEAREST = 5
+MAX_NEAREST = 100
+WEATHER_FIELDS = ('city_name', 'latitude', 'longitude', 'temperature', 'feels_like', 'humidity', 'pressure', 'description')
 
 def weather_data_to_dict(weather_data):
     return {
@@ -17,115 +44,576 @@ def weather_data_to_dict(weather_data):
         "timestamp": weather_data.timestamp.strftime("%Y-%m-%d %H:%M:%S"),  # Convert datetime to string
     }
 
-async def get_all_weather_service():
+async def get_all_weather_service(response_format='rows'):
     try:
-        await prisma.connect()
-        weather_data = await prisma.weatherdata.find_many()
-        formatted_data = [weather_data_to_dict(data) for data in weather_data]
-        return formatted_data
+        weather_data = await run_on_db(lambda db: db.weatherdata.find_many())
+        return serialize_weather(weather_data, response_format)
     except Exception as e:
         print(f"Error retrieving weather data: {e}")
         return None
-    finally:
-        await prisma.disconnect()
 
-from datetime import datetime, timedelta
-
-async def get_weather_by_filter_service(city, start_time=None, end_time=None):
+async def get_weather_page_service(after_id=None, limit=DEFAULT_PAGE_SIZE, response_format='rows'):
     try:
-        await prisma.connect()
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        where_conditions = {'id': {'gt': after_id}} if after_id is not None else {}
+        weather_data = await run_on_db(lambda db: db.weatherdata.find_many(
+            where=where_conditions,
+            order={'id': 'asc'},
+            take=limit,
+        ))
+        next_after_id = weather_data[-1].id if len(weather_data) == limit else None
+        return serialize_weather(weather_data, response_format), next_after_id
+    except Exception as e:
+        print(f"Error retrieving weather data page: {e}")
+        return None, None
+
+def iter_weather_batches(after_id=None, batch_size=STREAM_BATCH_SIZE):
+    # Runs in the thread that streams the response, one keyset query per batch
+    while True:
+        where_conditions = {'id': {'gt': after_id}} if after_id is not None else {}
+        weather_data = run_on_db_sync(lambda db: db.weatherdata.find_many(
+            where=where_conditions,
+            order={'id': 'asc'},
+            take=batch_size,
+        ))
+        if not weather_data:
+            return
+        yield weather_dicts(weather_data)
+        if len(weather_data) < batch_size:
+            return
+        after_id = weather_data[-1].id
 
-        where_conditions = {'city_name': city}
+def iter_weather_export_batches(start_ms, end_ms, city=None, batch_size=EXPORT_BATCH_SIZE):
+    after_id = 0
+    while True:
+        rows = run_on_db_sync(lambda db: fetch_export_rows(db, after_id, start_ms, end_ms, batch_size, city))
+        if not rows:
+            return
+        yield rows
+        if len(rows) < batch_size:
+            return
+        after_id = rows[-1]['id']
 
-        if start_time is not None:
-            start_datetime = datetime.fromisoformat(start_time).replace(hour=0, minute=0, second=0, microsecond=0)
-            where_conditions['timestamp'] = {'gte': start_datetime}
+def get_latest_weather_id():
+    latest = run_on_db_sync(lambda db: db.weatherdata.find_first(order={'id': 'desc'}))
+    return latest.id if latest is not None else 0
 
-        if end_time is not None:
-            end_datetime = datetime.fromisoformat(end_time).replace(hour=23, minute=59, second=59, microsecond=999999)
+def filter_time_range(start_time=None, end_time=None):
+    # Whole days: start_time from midnight, end_time until the end of its day. An
+    # end_time without start_time reads up to the end of today.
+    start_datetime = end_datetime = None
+    if start_time is not None:
+        start_datetime = datetime.fromisoformat(start_time).replace(hour=0, minute=0, second=0, microsecond=0)
 
-            if start_time is not None:
-                where_conditions.setdefault('timestamp', {})['lte'] = end_datetime
-            else:
-                where_conditions['timestamp'] = {'lte': datetime.now(timezone.utc).replace(hour=23, minute=59, second=59, microsecond=999999)}
+    if end_time is not None:
+        end_datetime = datetime.fromisoformat(end_time).replace(hour=23, minute=59, second=59, microsecond=999999)
+        if start_time is None:
+            end_datetime = datetime.now(timezone.utc).replace(hour=23, minute=59, second=59, microsecond=999999)
+    return start_datetime, end_datetime
 
-        weather_data_list = await prisma.weatherdata.find_many(where=where_conditions)
-        formatted_data_list = [weather_data_to_dict(data) for data in weather_data_list]
-        return formatted_data_list
+async def find_weather_by_filter(city, start_datetime, end_datetime, response_format='rows'):
+    if start_datetime is not None:
+        await refresh_hot_window()
+        end_ms = to_epoch_ms(end_datetime) if end_datetime is not None else None
+        recent = hot_window.find(city, to_epoch_ms(start_datetime), end_ms, response_format)
+        if recent is not None:
+            return recent
+
+    where_conditions = {'city_name': city}
+    if start_datetime is not None:
+        where_conditions['timestamp'] = {'gte': start_datetime}
+    if end_datetime is not None:
+        where_conditions.setdefault('timestamp', {})['lte'] = end_datetime
+
+    weather_data_list = await run_on_db(lambda db: db.weatherdata.find_many(where=where_conditions))
+    return serialize_weather(weather_data_list, response_format)
+
+async def get_weather_by_filter_service(city, start_time=None, end_time=None, response_format='rows'):
+    try:
+        start_datetime, end_datetime = filter_time_range(start_time, end_time)
+        return await find_weather_by_filter(city, start_datetime, end_datetime, response_format)
     except Exception as e:
         print(f"Error retrieving weather data: {e}")
         return None
-    finally:
-        await prisma.disconnect()
+
+async def get_weather_history_service(city, start_time=None, end_time=None, response_format='rows'):
+    # get_weather_by_filter_service encoded as JSON, with its strong ETag and
+    # Last-Modified, served from history_cache while no write touches the city and
+    # range. Returns (body, etag, last_modified, end_ms, cache_hit) or None.
+    try:
+        start_datetime, end_datetime = filter_time_range(start_time, end_time)
+        end_ms = to_epoch_ms(end_datetime) if end_datetime is not None else None
+        key = (city, to_epoch_ms(start_datetime) if start_datetime is not None else None, end_ms, response_format)
+
+        cached = history_cache.get(key)
+        if cached is not None:
+            return (*cached, end_ms, True)
+
+        generation = history_cache.generation(city)
+        body = dumps(await find_weather_by_filter(city, start_datetime, end_datetime, response_format))
+        etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+        history_cache.put(key, generation, body, etag, last_modified)
+        return body, etag, last_modified, end_ms, False
+    except Exception as e:
+        print(f"Error retrieving weather data: {e}")
+        return None
+
+
+def to_epoch_ms(value):
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp() * 1000)
+
+def format_epoch_ms(value):
+    return datetime.fromtimestamp(value / 1000, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+def parse_time_range(start_time=None, end_time=None):
+    # Same day boundaries as get_weather_by_filter_service, returned as the epoch
+    # milliseconds Prisma stores in SQLite so they can go straight into raw queries
+    start_ms = 0
+    end_datetime = datetime.now(timezone.utc)
+    if start_time is not None:
+        start_ms = to_epoch_ms(datetime.fromisoformat(start_time).replace(hour=0, minute=0, second=0, microsecond=0))
+    if end_time is not None:
+        end_datetime = datetime.fromisoformat(end_time).replace(hour=23, minute=59, second=59, microsecond=999999)
+    return start_ms, to_epoch_ms(end_datetime)
+
+AGGREGATE_FIELDS = ('temperature', 'humidity', 'pressure')
+
+def merge_buckets(rows):
+    # Raw and rolled-up rows cover different days, but merge equal buckets anyway
+    merged = {}
+    for row in rows:
+        current = merged.get(row['bucket_start'])
+        if current is None:
+            merged[row['bucket_start']] = row
+            continue
+        samples = current['samples'] + row['samples']
+        for field in AGGREGATE_FIELDS:
+            current[f'{field}_min'] = min(current[f'{field}_min'], row[f'{field}_min'])
+            current[f'{field}_max'] = max(current[f'{field}_max'], row[f'{field}_max'])
+            current[f'{field}_mean'] = (current[f'{field}_mean'] * current['samples'] + row[f'{field}_mean'] * row['samples']) / samples
+        current['samples'] = samples
+    return [merged[bucket_start] for bucket_start in sorted(merged)]
+
+async def get_weather_aggregate_service(city, start_time=None, end_time=None, bucket='1h'):
+    # Readings older than the retention period only exist in the rolled-up tables,
+    # which are regrouped into the requested bucket (5m falls back to hourly there)
+    try:
+        bucket_ms = AGGREGATE_BUCKETS[bucket]
+        start_ms, end_ms = parse_time_range(start_time, end_time)
+        rollup_sql, rollup_params = rollup_query(bucket_ms, city, start_ms, end_ms)
+        rolled_up_columns = ',\n'.join(
+            f'''MIN("{field}_min") AS {field}_min,
+                   MAX("{field}_max") AS {field}_max,
+                   SUM("{field}_mean" * "samples") / SUM("samples") AS {field}_mean'''
+            for field in AGGREGATE_FIELDS
+        )
+
+        async def aggregate(db):
+            raw = await db.query_raw(
+                '''
+                SELECT ("timestamp" / ?) * ? AS bucket_start,
+                       COUNT(*) AS samples,
+                       MIN("temperature") AS temperature_min,
+                       MAX("temperature") AS temperature_max,
+                       AVG("temperature") AS temperature_mean,
+                       MIN("humidity") AS humidity_min,
+                       MAX("humidity") AS humidity_max,
+                       AVG("humidity") AS humidity_mean,
+                       MIN("pressure") AS pressure_min,
+                       MAX("pressure") AS pressure_max,
+                       AVG("pressure") AS pressure_mean
+                FROM "WeatherData"
+                WHERE "city_name" = ? AND "timestamp" >= ? AND "timestamp" <= ?
+                GROUP BY bucket_start
+                ORDER BY bucket_start
+                ''',
+                bucket_ms, bucket_ms, city, start_ms, end_ms,
+            )
+            rolled_up = await db.query_raw(
+                f'''
+                SELECT ("bucket_start" / ?) * ? AS bucket_start,
+                       SUM("samples") AS samples,
+                       {rolled_up_columns}
+                FROM ({rollup_sql})
+                GROUP BY 1
+                ''',
+                bucket_ms, bucket_ms, *rollup_params,
+            )
+            return rolled_up + raw
+
+        rows = merge_buckets(await run_on_db(aggregate))
+        for row in rows:
+            row['city_name'] = city
+            row['bucket_start'] = format_epoch_ms(row['bucket_start'])
+        return rows
+    except Exception as e:
+        print(f"Error aggregating weather data: {e}")
+        return None
+
+async def get_weather_downsample_service(city, start_time=None, end_time=None, field='temperature',
+                                         points=DEFAULT_DOWNSAMPLE_POINTS):
+    # Hourly means stand in for readings older than the retention period
+    try:
+        if field not in DOWNSAMPLE_FIELDS:
+            raise ValueError(f"Unknown field '{field}'")
+        start_ms, end_ms = parse_time_range(start_time, end_time)
+        rollup_sql, rollup_params = rollup_query(HOUR_MS, city, start_ms, end_ms)
+
+        async def series(db):
+            rolled_up = await db.query_raw(
+                f'''
+                SELECT "bucket_start" + 0 AS x, "{field}_mean" AS y
+                FROM ({rollup_sql})
+                ORDER BY "bucket_start"
+                ''',
+                *rollup_params,
+            )
+            raw = await db.query_raw(
+                f'''
+                SELECT "timestamp" AS x, "{field}" AS y
+                FROM "WeatherData"
+                WHERE "city_name" = ? AND "timestamp" >= ? AND "timestamp" <= ?
+                ORDER BY "timestamp"
+                ''',
+                city, start_ms, end_ms,
+            )
+            return rolled_up + raw
+
+        rows = sorted(await run_on_db(series), key=lambda row: row['x'])
+        sampled = lttb([(row['x'], row['y']) for row in rows], points)
+        return [{'timestamp': format_epoch_ms(x), field: y} for x, y in sampled]
+    except Exception as e:
+        print(f"Error downsampling weather data: {e}")
+        return None
+
+async def find_latest(db, cities=None):
+    # Latest reading of every city, or of the given ones
+    city_filter = f'WHERE "city_name" IN ({", ".join("?" for _ in cities)})' if cities is not None else ''
+    latest = await db.query_raw(
+        f'''
+        SELECT MAX(w."id") AS id
+        FROM "WeatherData" w
+        JOIN (
+            SELECT "city_name", MAX("timestamp") AS "timestamp"
+            FROM "WeatherData"
+            {city_filter}
+            GROUP BY "city_name"
+        ) latest ON latest."city_name" = w."city_name" AND latest."timestamp" = w."timestamp"
+        GROUP BY w."city_name"
+        ''',
+        *(cities or ()),
+    )
+    return await db.weatherdata.find_many(
+        where={'id': {'in': [row['id'] for row in latest]}},
+        order={'city_name': 'asc'},
+    )
+
+async def get_latest_weather_service(city=None):
+    try:
+        if city is not None:
+            cached = latest_cache.get(city)
+            if cached is not None:
+                return [cached], True
+            await refresh_hot_window()
+            recent = hot_window.latest(city)
+            if recent is not None:
+                latest_cache.put(recent)
+                return [recent], False
+            weather_data = await run_on_db(lambda db: db.weatherdata.find_first(
+                where={'city_name': city},
+                order=[{'timestamp': 'desc'}, {'id': 'desc'}],
+            ))
+            if weather_data is None:
+                return [], False
+            formatted_data = weather_data_to_dict(weather_data)
+            latest_cache.put(formatted_data)
+            return [formatted_data], False
+
+        cached = latest_cache.get_all()
+        if cached is not None:
+            return cached, True
+
+        weather_data_list = await run_on_db(find_latest)
+        formatted_data_list = weather_dicts(weather_data_list)
+        latest_cache.put_all(formatted_data_list)
+        return formatted_data_list, False
+    except Exception as e:
+        print(f"Error retrieving latest weather data: {e}")
+        return None, False
 
 
 async def get_weather_by_id_service(id):
     try:
-        await prisma.connect()
-        weather_data = await prisma.weatherdata.find_first(where={'id': id})
+        weather_data = await run_on_db(lambda db: db.weatherdata.find_first(where={'id': id}))
         formatted_data = weather_data_to_dict(weather_data)
         return formatted_data
     except Exception as e:
         print(f"Error retrieving weather data: {e}")
         return None
-    finally:
-        await prisma.disconnect()
 
 async def create_weather_service(weather_params):
     try:
-        await prisma.connect()
-        created_weather = await prisma.weatherdata.create(
-            data={
-                'city_name': weather_params['city_name'],
-                'latitude': weather_params['latitude'],
-                'longitude': weather_params['longitude'],
-                'temperature': float(weather_params['temperature']),
-                'feels_like': float(weather_params['feels_like']),
-                'humidity': float(weather_params['humidity']),
-                'pressure': float(weather_params['pressure']),
-                'description': weather_params['description'],
-            }
-        )
+        data = {
+            'city_name': weather_params['city_name'],
+            'latitude': weather_params['latitude'],
+            'longitude': weather_params['longitude'],
+            'temperature': float(weather_params['temperature']),
+            'feels_like': float(weather_params['feels_like']),
+            'humidity': float(weather_params['humidity']),
+            'pressure': float(weather_params['pressure']),
+            'description': weather_params['description'],
+        }
+        created_weather, = await run_on_db(lambda db: submit_writes([('create', data)]))
 
-        return weather_data_to_dict(created_weather)
+        formatted_data = weather_data_to_dict(created_weather)
+        latest_cache.put(formatted_data)
+        history_cache.invalidate(formatted_data)
+        station_index.put_rows([formatted_data])
+        hot_window.add_rows([formatted_data])
+        return formatted_data
 
+    except IngestQueueFull:
+        raise
     except Exception as e:
         print(f"Error creating weather data: {e}")
         return None
 
-    finally:
-        await prisma.disconnect()
+def weather_batch_item(weather_params):
+    if not isinstance(weather_params, dict):
+        raise ValueError("item must be an object")
+
+    missing = [field for field in WEATHER_FIELDS if weather_params.get(field) is None]
+    if missing:
+        raise ValueError(f"missing fields: {', '.join(missing)}")
+
+    try:
+        data = {
+            'city_name': str(weather_params['city_name']),
+            'latitude': float(weather_params['latitude']),
+            'longitude': float(weather_params['longitude']),
+            'temperature': float(weather_params['temperature']),
+            'feels_like': float(weather_params['feels_like']),
+            'humidity': int(float(weather_params['humidity'])),
+            'pressure': int(float(weather_params['pressure'])),
+            'description': str(weather_params['description']),
+        }
+        if weather_params.get('timestamp') is not None:
+            data['timestamp'] = datetime.fromisoformat(weather_params['timestamp'])
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"invalid value: {e}")
+    return data
+
+async def create_weather_batch_service(items):
+    valid_data = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            valid_data.append(weather_batch_item(item))
+        except ValueError as e:
+            errors.append({'index': index, 'error': str(e)})
+
+    if not valid_data:
+        return [], errors
+
+    try:
+        # One group in the ingestion log, so the batch is committed in a single transaction
+        created_weather = await run_on_db(lambda db: submit_writes([('create', data) for data in valid_data]))
+        formatted_data_list = weather_dicts(created_weather)
+        for formatted_data in formatted_data_list:
+            latest_cache.put(formatted_data)
+            history_cache.invalidate(formatted_data)
+        station_index.put_rows(formatted_data_list)
+        hot_window.add_rows(formatted_data_list)
+        return formatted_data_list, errors
+    except IngestQueueFull:
+        raise
+    except Exception as e:
+        print(f"Error creating weather data batch: {e}")
+        return None, errors
 
 async def update_weather_service(weather_params):
     try:
-        await prisma.connect()
-        updated_weather = await prisma.weatherdata.update(
-            where={'id': weather_params['id']},
-            data={
-                'city_name': weather_params['city_name'],
-                'latitude': weather_params['latitude'],
-                'longitude': weather_params['longitude'],
-                'temperature': float(weather_params['temperature']),
-                'feels_like': float(weather_params['feels_like']),
-                'humidity': float(weather_params['humidity']),
-                'pressure': float(weather_params['pressure']),
-                'description': weather_params['description'],
-            }
-        )
-        return weather_data_to_dict(updated_weather)
+        data = {
+            'id': weather_params['id'],
+            'city_name': weather_params['city_name'],
+            'latitude': weather_params['latitude'],
+            'longitude': weather_params['longitude'],
+            'temperature': float(weather_params['temperature']),
+            'feels_like': float(weather_params['feels_like']),
+            'humidity': float(weather_params['humidity']),
+            'pressure': float(weather_params['pressure']),
+            'description': weather_params['description'],
+        }
+        result, = await run_on_db(lambda db: submit_writes([('update', data)]))
+        if result is None:
+            print(f"Error updating weather data: no weather data with id {data['id']}")
+            return None, None
+
+        updated_weather, previous_weather = result
+        formatted_data = weather_data_to_dict(updated_weather)
+        previous_data = weather_data_to_dict(previous_weather)
+        latest_cache.replace(formatted_data)
+        history_cache.invalidate(previous_data)
+        history_cache.invalidate(formatted_data)
+        station_index.put_rows([formatted_data])
+        hot_window.remove_rows([previous_data])
+        hot_window.add_rows([formatted_data])
+        return formatted_data, previous_data
+    except IngestQueueFull:
+        raise
     except Exception as e:
         print(f"Error updating weather data: {e}")
-        return None
-    finally:
-        await prisma.disconnect()
+        return None, None
 
 async def delete_weather_service(id):
     try:
-        await prisma.connect()
-        deleted_weather = await prisma.weatherdata.delete(where={'id': id})
-        return weather_data_to_dict(deleted_weather)
+        deleted_weather, = await run_on_db(lambda db: submit_writes([('delete', {'id': id})]))
+        if deleted_weather is None:
+            print(f"Error deleting weather data: no weather data with id {id}")
+            return None
+
+        formatted_data = weather_data_to_dict(deleted_weather)
+        latest_cache.discard(formatted_data)
+        history_cache.invalidate(formatted_data)
+        hot_window.remove_rows([formatted_data])
+        return formatted_data
+    except IngestQueueFull:
+        raise
     except Exception as e:
         print(f"Error deleting weather data: {e}")
         return None
+
+STATION_REFRESH_BATCH_SIZE = 10000
+
+async def refresh_station_index():
+    # The first call reads the latest coordinates of every city, later ones only the
+    # rows written since, by this process or another one
+    if station_index.refreshed_at is not None and time.monotonic() - station_index.refreshed_at < GEO_REFRESH_SECONDS:
+        return
+    refreshed_at = time.monotonic()
+
+    if station_index.last_id is None:
+        rows = await run_on_db(lambda db: db.query_raw('SELECT MAX("id") AS "id" FROM "WeatherData"'))
+        last_id = (rows[0]['id'] if rows else None) or 0
+        stations = await run_on_db(lambda db: db.query_raw(
+            '''
+            SELECT "city_name", "latitude", "longitude" FROM "WeatherData"
+            WHERE "id" IN (SELECT MAX("id") FROM "WeatherData" WHERE "id" <= ? GROUP BY "city_name")
+            ''',
+            last_id,
+        ))
+        station_index.put_rows(stations)
+        station_index.last_id = last_id
+
+    while True:
+        rows = await run_on_db(lambda db: db.query_raw(
+            'SELECT "id", "city_name", "latitude", "longitude" FROM "WeatherData" WHERE "id" > ? ORDER BY "id" LIMIT ?',
+            station_index.last_id, STATION_REFRESH_BATCH_SIZE,
+        ))
+        if rows:
+            station_index.put_rows(rows)
+            station_index.last_id = rows[-1]['id']
+        if len(rows) < STATION_REFRESH_BATCH_SIZE:
+            break
+    station_index.refreshed_at = refreshed_at
+
+HOT_WINDOW_BATCH_SIZE = 10000
+
+async def fetch_window_rows(db, after_id, last_id, start_ms, limit=HOT_WINDOW_BATCH_SIZE):
+    # "timestamp" + 0 keeps the stored epoch milliseconds as an integer
+    return await db.query_raw(
+        '''
+        SELECT "id", "city_name", "latitude", "longitude", "temperature", "feels_like",
+               "humidity", "pressure", "description", "timestamp" + 0 AS "timestamp"
+        FROM "WeatherData"
+        WHERE "id" > ? AND "id" <= ? AND "timestamp" >= ?
+        ORDER BY "id"
+        LIMIT ?
+        ''',
+        after_id, last_id, start_ms, limit,
+    )
+
+async def read_window_rows(after_id):
+    # Rows of the window with an id above after_id, and the highest id read
+    rows = await run_on_db(lambda db: db.query_raw('SELECT MAX("id") AS "id" FROM "WeatherData"'))
+    last_id = (rows[0]['id'] if rows else None) or 0
+    window_rows = []
+    while True:
+        rows = await run_on_db(lambda db: fetch_window_rows(db, after_id, last_id, hot_window.cutoff_ms()))
+        window_rows += rows
+        if len(rows) < HOT_WINDOW_BATCH_SIZE:
+            return window_rows, last_id
+        after_id = rows[-1]['id']
+
+async def refresh_hot_window():
+    # Reads the whole window on first use and every HOT_WINDOW_RELOAD_SECONDS, in
+    # between only the rows written since, by this process or another one. While a
+    # request refreshes it, the others use the window as it is.
+    if hot_window.span_ms <= 0 or not hot_window.sync_lock.acquire(blocking=False):
+        return
+    try:
+        now = time.monotonic()
+        reload = not hot_window.is_loaded or now - hot_window.loaded_at >= HOT_WINDOW_RELOAD_SECONDS
+        if not reload and now - hot_window.refreshed_at < HOT_WINDOW_REFRESH_SECONDS:
+            return
+
+        hot_window.begin_sync()
+        try:
+            rows, last_id = await read_window_rows(0 if reload else hot_window.last_id)
+        except Exception:
+            hot_window.abort_sync()
+            raise
+        hot_window.finish_sync(rows, last_id, reload)
+        if not reload:
+            hot_window.trim()
     finally:
-        await prisma.disconnect()
+        hot_window.sync_lock.release()
+
+async def latest_weather_by_city(cities):
+    latest = {}
+    missing = []
+    await refresh_hot_window()
+    for city in cities:
+        cached = latest_cache.get(city)
+        if cached is None:
+            cached = hot_window.latest(city)
+            if cached is not None:
+                latest_cache.put(cached)
+        if cached is not None:
+            latest[city] = cached
+        else:
+            missing.append(city)
+
+    # Stays well under SQLite's limit on query parameters
+    for first in range(0, len(missing), 500):
+        chunk = missing[first:first + 500]
+        for formatted_data in weather_dicts(await run_on_db(lambda db: find_latest(db, chunk))):
+            latest_cache.put(formatted_data)
+            latest[formatted_data['city_name']] = formatted_data
+    return latest
+
+async def get_nearest_weather_service(lat, lon, k=DEFAULT_NEAREST):
+    try:
+        await refresh_station_index()
+        nearest = station_index.nearest(lat, lon, max(1, min(k, MAX_NEAREST)))
+        latest = await latest_weather_by_city([city for _, city in nearest])
+        return [
+            {**latest[city], 'distance_km': round(distance, 3)}
+            for distance, city in nearest if city in latest
+        ]
+    except Exception as e:
+        print(f"Error retrieving nearest weather data: {e}")
+        return None
+
+async def get_weather_in_box_service(min_lat, min_lon, max_lat, max_lon):
+    try:
+        await refresh_station_index()
+        cities = station_index.within(min_lat, min_lon, max_lat, max_lon)
+        latest = await latest_weather_by_city(cities)
+        return [latest[city] for city in cities if city in latest]
+    except Exception as e:
+        print(f"Error retrieving weather data in box: {e}")
+        return None
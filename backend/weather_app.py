@@ -0,0 +1,55 @@
+from flask import Flask, g, request
+from datetime import timedelta
+from weather_api import init_routes
+from weather_auth import init_auth_routes, init_jwt
+from weather_serialize import WeatherJSONProvider
+from weather_metrics import http_request_duration
+from weather_profiler import init_profiler
+from weather_docs import init_docs
+from flask_cors import CORS
+import os
+import time
+
+CORS_ORIGINS = "http://localhost:5173"
+
+
+def create_app(app_class=Flask):
+    app = app_class(__name__)
+    app.json = WeatherJSONProvider(app)
+    app.config["DEBUG"] = True
+    app.config['SECRET_KEY'] = 'secret'
+    app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET')  # Change this to a secure secret key
+    app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(days=1)
+    return app
+
+
+def init_metrics(app):
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            http_request_duration.observe(
+                time.perf_counter() - started, method=request.method, route=route, status=response.status_code,
+            )
+        return response
+
+
+def init_app(app, emitter, feed):
+    # Shared by the threaded server (weather.py) and the ASGI one (weather_asgi.py)
+    CORS(app, resources={r"/*": {"origins": CORS_ORIGINS}})
+    init_metrics(app)
+    init_profiler(app)
+    init_routes(app, emitter, feed)
+    init_auth_routes(app)
+    init_jwt(app)
+    init_docs(app)
+
+
+def subscribed_cities(data):
+    cities = data.get('cities', []) if isinstance(data, dict) else []
+    return [city for city in cities if isinstance(city, str)]
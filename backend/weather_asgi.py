@@ -0,0 +1,220 @@
+# ASGI entry point: uvicorn weather_asgi:app --port 8080
+#
+# Everything asynchronous runs on the server's event loop: the Prisma client, the
+# Socket.IO server and the async views, which Flask would otherwise run in a new
+# event loop per request. Flask itself stays a WSGI app, served from a pool of
+# WSGI_THREADS threads, and hands its async views over to the loop.
+from flask import Flask
+from concurrent.futures import ThreadPoolExecutor
+from weather_app import create_app, init_app, subscribed_cities, CORS_ORIGINS
+from weather_db import connect_db_async, disconnect_db_async, run_on_loop
+from weather_feed import ChangeFeed, FEED_LOCK_FILE, parse_since
+from weather_batcher import EmitBatcher
+from weather_ingest import start_ingest, stop_ingest
+from weather_auth import ensure_default_user
+from weather_retention import RetentionJob
+from weather_bus import async_socketio_queue_options
+from weather_metrics import socketio_connected_clients
+from dotenv import load_dotenv
+import asyncio
+import io
+import os
+import socketio
+import sys
+import threading
+
+WSGI_THREADS = int(os.getenv('WSGI_THREADS', 64))
+
+
+class SharedLoopFlask(Flask):
+    def async_to_sync(self, func):
+        def run(*args, **kwargs):
+            return run_on_loop(func(*args, **kwargs))
+        return run
+
+
+class PooledWsgiToAsgi:
+    # Serves a WSGI app to ASGI HTTP requests from a pool of WSGI_THREADS threads
+    # (asgiref's WsgiToAsgi runs every request on the same single thread, so slow
+    # requests would queue behind each other). The request body is read before the
+    # app runs, the response is sent chunk by chunk as the app yields it.
+    def __init__(self, wsgi_application, threads=WSGI_THREADS):
+        self.wsgi_application = wsgi_application
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            raise ValueError(f"The WSGI app cannot serve {scope['type']} requests")
+        body = io.BytesIO()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.write(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        body.seek(0)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.run_wsgi_app, scope, body, send, loop)
+
+    def run_wsgi_app(self, scope, body, send, loop):
+        def sync_send(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        start = {'type': 'http.response.start'}
+        started = False
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            start['status'] = int(status.split(' ', 1)[0])
+            start['headers'] = [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]
+
+        response = self.wsgi_application(wsgi_environ(scope, body), start_response)
+        try:
+            for chunk in response:
+                if not chunk:
+                    continue
+                if not started:
+                    started = True
+                    sync_send(start)
+                sync_send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if not started:
+                sync_send(start)
+            sync_send({'type': 'http.response.body'})
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+
+
+def wsgi_environ(scope, body):
+    script_name = scope.get('root_path', '')
+    path_info = scope['path']
+    if script_name and path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name.encode('utf8').decode('latin1'),
+        'PATH_INFO': path_info.encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        value = value.decode('latin1')
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+    return environ
+
+
+class AsyncSocketIO:
+    # The part of the Flask-SocketIO API used by the routes and the change feed,
+    # on top of a socketio.AsyncServer
+    def __init__(self, server):
+        self.server = server
+        self.loop = None
+
+    def emit(self, event, data=None, namespace=None, to=None, callback=None):
+        self.run(self.server.emit(event, data, namespace=namespace, to=to, callback=callback))
+
+    def run(self, coroutine):
+        # Schedules a coroutine of the server from its loop, or waits for it from
+        # another thread
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if running_loop is self.loop:
+            self.loop.create_task(coroutine)
+        else:
+            asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def start_background_task(self, target, *args, **kwargs):
+        # The feed and the retention job block on the database loop between their
+        # emits and queries, so they get a thread of their own
+        thread = threading.Thread(target=target, args=args, kwargs=kwargs, daemon=True)
+        thread.start()
+        return thread
+
+
+load_dotenv()
+socketio_options = async_socketio_queue_options()
+server = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins=CORS_ORIGINS, **socketio_options)
+sio = AsyncSocketIO(server)
+
+feed_lock = FEED_LOCK_FILE if socketio_options else None
+batcher = EmitBatcher(sio, per_client=not socketio_options)
+feed = ChangeFeed(sio, batcher, leader_lock=feed_lock)
+retention = RetentionJob(sio, should_run=lambda: feed.is_leader)
+
+flask_app = create_app(SharedLoopFlask)
+init_app(flask_app, batcher, feed)
+
+
+@server.on('connect', namespace='/data')
+async def handle_connect(sid, environ, auth=None):
+    print("Client connected")
+    for city in subscribed_cities(auth):
+        await server.enter_room(sid, city, namespace='/data')
+    if isinstance(auth, dict):
+        await asyncio.to_thread(feed.resume, sid, parse_since(auth.get('since')))
+    # Last, a connection refused by an error above is never disconnected
+    socketio_connected_clients.inc()
+
+@server.on('subscribe', namespace='/data')
+async def handle_subscribe(sid, data):
+    for city in subscribed_cities(data):
+        await server.enter_room(sid, city, namespace='/data')
+
+@server.on('unsubscribe', namespace='/data')
+async def handle_unsubscribe(sid, data):
+    for city in subscribed_cities(data):
+        await server.leave_room(sid, city, namespace='/data')
+
+@server.on('resume', namespace='/data')
+async def handle_resume(sid, data):
+    if isinstance(data, dict):
+        await asyncio.to_thread(feed.resume, sid, parse_since(data.get('since')))
+
+@server.on('disconnect', namespace='/data')
+async def handle_disconnect(sid, reason=None):
+    print("Client disconnected")
+    socketio_connected_clients.dec()
+    batcher.forget(sid)
+
+
+async def startup():
+    sio.loop = asyncio.get_running_loop()
+    db = await connect_db_async()
+    await ensure_default_user(db)
+    await start_ingest(db, 'api')
+    await asyncio.to_thread(feed.start)
+    retention.start()
+
+async def shutdown():
+    feed.stop()
+    batcher.stop()
+    retention.stop()
+    await stop_ingest()
+    await disconnect_db_async()
+
+
+app = socketio.ASGIApp(server, PooledWsgiToAsgi(flask_app), on_startup=startup, on_shutdown=shutdown)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, port=int(os.getenv('PORT', 8080)))
@@ -1,27 +1,196 @@
-from flask import Flask, request, jsonify
-from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt_identity
+from flask import request, jsonify
+from flask_jwt_extended import JWTManager, create_access_token
+from flask_jwt_extended.config import config
 from werkzeug.security import generate_password_hash, check_password_hash
+from weather_db import run_on_db
+from collections import OrderedDict
+from importlib.metadata import version, PackageNotFoundError
+import asyncio
+import hashlib
+import inspect
+import os
+import threading
+import time
+
+# Any werkzeug method, e.g. scrypt:32768:8:1 (the default) or pbkdf2:sha256:600000.
+# Stored hashes made with another method are upgraded at the next login.
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt')
+# Created on startup when there is no user yet, for demonstration purposes
+DEFAULT_USERNAME = os.getenv('DEFAULT_USERNAME', 'test')
+DEFAULT_PASSWORD = os.getenv('DEFAULT_PASSWORD', 'testtest')
+JWT_CACHE_SIZE = int(os.getenv('JWT_CACHE_SIZE', 10000))
+# CachedJWTManager overrides a private method of flask-jwt-extended, it is only
+# used with the major version it was written against (tested with 4.7)
+JWT_CACHE_TESTED_VERSION = '4.'
+JWT_DECODE_PARAMETERS = ['self', 'encoded_token', 'csrf_value', 'allow_expired']
+
+_unknown_user_hash = None
+
+
+def hash_password(password):
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+
+def unknown_user_hash():
+    # Checked against when the username does not exist, so that the answer takes
+    # as long as for a wrong password. Its method prefix, e.g. scrypt:32768:8:1,
+    # tells which stored hashes are outdated.
+    global _unknown_user_hash
+    if _unknown_user_hash is None:
+        _unknown_user_hash = hash_password(os.urandom(16).hex())
+    return _unknown_user_hash
+
+
+def hash_method(password_hash):
+    return password_hash.split('$', 1)[0]
+
+
+async def ensure_default_user(db):
+    if await db.user.count() == 0:
+        await db.user.create(data={'username': DEFAULT_USERNAME, 'password_hash': hash_password(DEFAULT_PASSWORD)})
+        print(f"Created user {DEFAULT_USERNAME}")
+
+
+async def authenticate(username, password):
+    # Returns True when the credentials match a user. Hashing is slow on purpose,
+    # it runs in a thread so that the event loop (ASGI mode) keeps serving.
+    try:
+        user = await run_on_db(lambda db: db.user.find_unique(where={'username': username}))
+    except Exception as e:
+        print(f"Error reading user {username}: {e}")
+        return False
+
+    expected_hash = user.password_hash if user is not None else await asyncio.to_thread(unknown_user_hash)
+    if not await asyncio.to_thread(check_password_hash, expected_hash, password) or user is None:
+        return False
+
+    current_method = hash_method(await asyncio.to_thread(unknown_user_hash))
+    if hash_method(user.password_hash) != current_method:
+        password_hash = await asyncio.to_thread(hash_password, password)
+        try:
+            await run_on_db(lambda db: db.user.update(where={'id': user.id}, data={'password_hash': password_hash}))
+        except Exception as e:
+            print(f"Error upgrading the password hash of {username}: {e}")
+    return True
+
+
+class VerifiedTokenCache:
+    # Claims of the tokens whose signature has been checked, keyed by a digest of
+    # the token, least recently used first. An entry is only used until the token
+    # expires, so a hit never accepts a token the full check would refuse.
+    def __init__(self, max_entries=JWT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(encoded_token):
+        return hashlib.blake2b(encoded_token.encode(), digest_size=16).digest()
+
+    def get(self, key, allow_expired=False):
+        with self._lock:
+            claims = self._entries.get(key)
+            if claims is None:
+                return None
+            expires = claims.get('exp')
+            if not allow_expired and expires is not None and time.time() > expires + config.leeway:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        return dict(claims)
+
+    def put(self, key, claims):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = dict(claims)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CachedJWTManager(JWTManager):
+    # Skips the signature check of tokens already verified by this process.
+    # Tokens coming with a CSRF value (cookies) always get the full check.
+    def __init__(self, app=None, token_cache=None, **kwargs):
+        self.token_cache = token_cache or VerifiedTokenCache()
+        super().__init__(app, **kwargs)
+
+    def _decode_jwt_from_config(self, encoded_token, csrf_value=None, allow_expired=False):
+        if csrf_value is not None:
+            return super()._decode_jwt_from_config(encoded_token, csrf_value, allow_expired)
+
+        key = self.token_cache.key(encoded_token)
+        claims = self.token_cache.get(key, allow_expired)
+        if claims is not None:
+            return claims
+        claims = super()._decode_jwt_from_config(encoded_token, csrf_value, allow_expired)
+        if not allow_expired:
+            self.token_cache.put(key, claims)
+        return claims
+
+
+def jwt_cache_supported():
+    try:
+        installed = version('flask-jwt-extended')
+    except PackageNotFoundError:
+        return False
+    decode = getattr(JWTManager, '_decode_jwt_from_config', None)
+    return (installed.startswith(JWT_CACHE_TESTED_VERSION) and decode is not None
+            and list(inspect.signature(decode).parameters) == JWT_DECODE_PARAMETERS)
+
+
+def init_jwt(app):
+    # Every token gets the full check when the cache is off or cannot be used
+    if JWT_CACHE_SIZE <= 0:
+        return JWTManager(app)
+    if not jwt_cache_supported():
+        print("The JWT cache does not support this flask-jwt-extended version, tokens are checked on every request")
+        return JWTManager(app)
+    return CachedJWTManager(app)
 
-# Dummy user data for demonstration purposes
-user = {
-    'username': 'test',
-    'password': generate_password_hash('testtest', method='sha256')
-}
 
 def init_auth_routes(app):
     @app.route('/login', methods=['POST'])
-    def login():
+    async def login():
         username = request.json.get('username', None)
         password = request.json.get('password', None)
 
-        if username is None or password is None:
-            return jsonify({'message': 'Invalid credentials'}), 401
-
-        if username != user['username']:
+        if not isinstance(username, str) or not isinstance(password, str):
             return jsonify({'message': 'Invalid credentials'}), 401
 
-        if check_password_hash(user['password'], password):
+        if await authenticate(username, password):
             access_token = create_access_token(identity=username)
             return jsonify(access_token=access_token), 200
         else:
             return jsonify({'message': 'Invalid credentials'}), 401
+
+
+if __name__ == '__main__':
+    # Creates a user or changes its password: python weather_auth.py <username>
+    from weather_db import connect_db, disconnect_db, run_on_db_sync
+    from dotenv import load_dotenv
+    import getpass
+    import sys
+
+    load_dotenv()
+    if len(sys.argv) != 2:
+        sys.exit('usage: python weather_auth.py <username>')
+    username = sys.argv[1]
+    password_hash = hash_password(getpass.getpass(f'Password for {username}: '))
+    connect_db()
+    try:
+        run_on_db_sync(lambda db: db.user.upsert(
+            where={'username': username},
+            data={'create': {'username': username, 'password_hash': password_hash}, 'update': {'password_hash': password_hash}},
+        ))
+        print(f"Saved user {username}")
+    finally:
+        disconnect_db()
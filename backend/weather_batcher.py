@@ -0,0 +1,200 @@
+from collections import deque
+from itertools import groupby
+from weather_metrics import socketio_emit_duration, socketio_dropped_events
+from weather_serialize import dumps
+import asyncio
+import os
+import threading
+import time
+import zlib
+
+# Events are held for up to EMIT_BATCH_MS, or until EMIT_BATCH_EVENTS are waiting,
+# then sent as one `batch` frame. EMIT_BATCH_MS=0 emits every event on its own.
+EMIT_BATCH_MS = float(os.getenv('EMIT_BATCH_MS', 100))
+EMIT_BATCH_EVENTS = int(os.getenv('EMIT_BATCH_EVENTS', 500))
+# Frames whose JSON is at least this large are sent deflated
+EMIT_COMPRESS_BYTES = int(os.getenv('EMIT_COMPRESS_BYTES', 1024))
+# Frames a client may leave unacknowledged, then how many wait for it before the
+# oldest are dropped, and after how long an unacknowledged frame stops counting
+EMIT_CLIENT_INFLIGHT = int(os.getenv('EMIT_CLIENT_INFLIGHT', 2))
+EMIT_CLIENT_QUEUE = int(os.getenv('EMIT_CLIENT_QUEUE', 50))
+EMIT_ACK_TIMEOUT = float(os.getenv('EMIT_ACK_TIMEOUT', 10))
+
+
+def encode_events(events):
+    # [[event, data], ...] in the order they were emitted, as JSON text or as
+    # deflated bytes when large, and the number of events
+    payload = dumps(events)
+    if len(payload) >= EMIT_COMPRESS_BYTES:
+        return zlib.compress(payload), len(events)
+    return payload.decode(), len(events)
+
+
+def batch_packets(namespace, ack_id, frame, dropped):
+    # The messages of a `batch` Socket.IO event, as socketio.packet.Packet.encode
+    # writes them. The encoded events are shared by every client of the frame,
+    # only the acknowledgement id and `dropped` are written for each one.
+    events, _ = frame
+    prefix = '' if namespace == '/' else f'{namespace},'
+    if isinstance(events, bytes):
+        return [f'51-{prefix}{ack_id}["batch",{{"deflate":{{"_placeholder":true,"num":0}},"dropped":{dropped}}}]', events]
+    return [f'2{prefix}{ack_id}["batch",{{"events":{events},"dropped":{dropped}}}]']
+
+
+class ClientState:
+    def __init__(self):
+        self.inflight = deque()
+        self.waiting = deque()
+        self.dropped = 0
+
+
+class EmitBatcher:
+    # Coalesces the mutation events of a namespace (new rows, edits, deletes) into
+    # one `batch` frame per client every EMIT_BATCH_MS, with the same event names
+    # and payloads as the single emits. Clients in the same rooms share the encoded
+    # events, written to each of them as prebuilt packets. Each frame waits for the client's acknowledgement: a client that
+    # falls behind gets its frames queued, then loses the oldest ones, and the next
+    # frame it gets tells how many events it missed.
+    #
+    # Recipients are looked up in this process, so with a message queue between
+    # workers (per_client=False) frames are broadcast to the rooms instead, without
+    # acknowledgements and unencoded: the queue encodes messages as JSON, which
+    # has no bytes. Events emitted without `to` go to the whole namespace.
+    def __init__(self, socketio, namespace='/data', window_ms=EMIT_BATCH_MS, max_events=EMIT_BATCH_EVENTS, per_client=True):
+        self.socketio = socketio
+        self.namespace = namespace
+        self.window = window_ms / 1000
+        self.max_events = max_events
+        self.per_client = per_client
+        self._buffer = []
+        self._first_at = None
+        self._clients = {}
+        self._condition = threading.Condition()
+        self._lock = threading.Lock()
+        self._running = False
+
+    def emit(self, event, data, namespace=None, to=None):
+        if self.window <= 0 or (namespace or self.namespace) != self.namespace:
+            with socketio_emit_duration.time(event=event):
+                self.socketio.emit(event, data, namespace=namespace, to=to)
+            return
+
+        # None is the room every client of the namespace is in
+        rooms = (to,) if to is None or isinstance(to, str) else tuple(to)
+        with self._condition:
+            if not self._running:
+                self._running = True
+                self.socketio.start_background_task(self._run)
+            self._buffer.append((event, data, rooms))
+            if len(self._buffer) == 1:
+                self._first_at = time.monotonic()
+                self._condition.notify()
+            elif len(self._buffer) >= self.max_events:
+                self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+    def forget(self, sid):
+        with self._lock:
+            self._clients.pop(sid, None)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and (not self._buffer or (
+                        len(self._buffer) < self.max_events and time.monotonic() < self._first_at + self.window)):
+                    self._condition.wait(self._first_at + self.window - time.monotonic() if self._buffer else None)
+                if not self._running and not self._buffer:
+                    return
+                events, self._buffer = self._buffer, []
+            try:
+                with socketio_emit_duration.time(event='batch'):
+                    self.flush(events)
+            except Exception as e:
+                print(f"Error sending batched events: {e}")
+
+    def flush(self, events):
+        if not self.per_client:
+            self._broadcast(events)
+            return
+
+        # Clients grouped by the rooms they are in, among the rooms of these events
+        manager = self.socketio.server.manager
+        rooms_by_sid = {}
+        for room in {room for _, _, rooms in events for room in rooms}:
+            for sid, _ in manager.get_participants(self.namespace, room):
+                rooms_by_sid.setdefault(sid, set()).add(room)
+        sids_by_rooms = {}
+        for sid, rooms in rooms_by_sid.items():
+            sids_by_rooms.setdefault(frozenset(rooms), []).append(sid)
+
+        for rooms, sids in sids_by_rooms.items():
+            frame = encode_events([[event, data] for event, data, event_rooms in events if rooms.intersection(event_rooms)])
+            for sid in sids:
+                self._deliver(sid, frame)
+
+    def _broadcast(self, events):
+        # One frame for each run of events sent to the same rooms, so that a client
+        # in several rooms still gets the events in the order they happened
+        for rooms, run in groupby(events, key=lambda event: event[2]):
+            to = None if None in rooms else list(rooms)
+            frame = {'events': [[event, data] for event, data, _ in run], 'dropped': 0}
+            self.socketio.emit('batch', frame, namespace=self.namespace, to=to)
+
+    def _deliver(self, sid, frame):
+        now = time.monotonic()
+        with self._lock:
+            client = self._clients.setdefault(sid, ClientState())
+            while client.inflight and now - client.inflight[0] > EMIT_ACK_TIMEOUT:
+                client.inflight.popleft()
+            if len(client.inflight) >= EMIT_CLIENT_INFLIGHT or client.waiting:
+                if len(client.waiting) >= EMIT_CLIENT_QUEUE:
+                    _, dropped_events = client.waiting.popleft()
+                    client.dropped += dropped_events
+                    socketio_dropped_events.inc(dropped_events)
+                client.waiting.append(frame)
+                if len(client.inflight) >= EMIT_CLIENT_INFLIGHT:
+                    return
+                frame = client.waiting.popleft()
+            dropped, client.dropped = client.dropped, 0
+            client.inflight.append(now)
+        self._send(sid, frame, dropped)
+
+    def _send(self, sid, frame, dropped):
+        # Writes the prebuilt packets straight to Engine.IO, the server would encode
+        # the frame again for every client
+        server = self.socketio.server
+        if not asyncio.iscoroutinefunction(server.eio.send):
+            for eio_sid, message in self._packets(sid, frame, dropped):
+                server.eio.send(eio_sid, message)
+            return
+
+        async def send():
+            for eio_sid, message in self._packets(sid, frame, dropped):
+                await server.eio.send(eio_sid, message)
+        self.socketio.run(send())
+
+    def _packets(self, sid, frame, dropped):
+        manager = self.socketio.server.manager
+        eio_sid = manager.eio_sid_from_sid(sid, self.namespace)
+        if eio_sid is None:
+            return []
+        ack_id = manager._generate_ack_id(sid, lambda *args: self._acknowledged(sid))
+        return [(eio_sid, message) for message in batch_packets(self.namespace, ack_id, frame, dropped)]
+
+    def _acknowledged(self, sid):
+        with self._lock:
+            client = self._clients.get(sid)
+            if client is None:
+                return
+            if client.inflight:
+                client.inflight.popleft()
+            if not client.waiting:
+                return
+            frame = client.waiting.popleft()
+            dropped, client.dropped = client.dropped, 0
+            client.inflight.append(time.monotonic())
+        self._send(sid, frame, dropped)
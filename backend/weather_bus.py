@@ -0,0 +1,204 @@
+from socketio import PubSubManager, AsyncRedisManager
+from urllib.parse import urlparse
+import atexit
+import os
+import queue
+import socket
+import stat
+import struct
+import tempfile
+import threading
+
+# One directory per user, only its owner may use it: any process able to connect
+# to the sockets could inject emits
+DEFAULT_BUS_DIRECTORY = os.path.join(
+    os.getenv('XDG_RUNTIME_DIR') or tempfile.gettempdir(), f'weather-bus-{os.getuid()}',
+)
+# A worker that is this many frames behind, or takes longer than BUS_SEND_TIMEOUT
+# seconds to take one, is disconnected so that it does not hold up the others
+BUS_PEER_QUEUE = int(os.getenv('BUS_PEER_QUEUE', 1000))
+BUS_SEND_TIMEOUT = float(os.getenv('BUS_SEND_TIMEOUT', 2))
+
+_frame_header = struct.Struct('!I')
+
+
+def private_directory(path):
+    # Creates path if needed and checks that only the current user can use it
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    status = os.lstat(path)
+    if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or status.st_mode & 0o077:
+        raise RuntimeError(f"{path} must be a directory owned by the current user with mode 0700")
+    return path
+
+
+def connect_peer(path):
+    peer = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    peer.settimeout(BUS_SEND_TIMEOUT)
+    try:
+        peer.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        peer.close()
+        # Socket left behind by a worker that did not shut down cleanly
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return None
+    except OSError:
+        peer.close()
+        return None
+    return peer
+
+
+class BusPeer:
+    # Connection to another worker, written by a thread of its own so that a
+    # stalled worker only delays its own frames
+    def __init__(self, path, connection):
+        self.path = path
+        self.closed = False
+        self._connection = connection
+        self._frames = queue.Queue(maxsize=BUS_PEER_QUEUE)
+        threading.Thread(target=self._write, name='localbus-write', daemon=True).start()
+
+    def send(self, frame):
+        # False when the peer is gone or too far behind, it is then closed
+        if self.closed:
+            return False
+        try:
+            self._frames.put_nowait(frame)
+            return True
+        except queue.Full:
+            self.close()
+            return False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._connection.close()
+        try:
+            self._frames.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def _write(self):
+        while (frame := self._frames.get()) is not None:
+            try:
+                self._connection.sendall(frame)
+            except OSError:
+                # Connection left over from a worker that restarted: reconnect once
+                connection = None if self.closed else connect_peer(self.path)
+                try:
+                    if connection is None:
+                        raise OSError(f"{self.path} is unreachable")
+                    connection.sendall(frame)
+                    self._connection.close()
+                    self._connection = connection
+                except OSError:
+                    if connection is not None:
+                        connection.close()
+                    self.close()
+                    return
+
+
+class LocalBusManager(PubSubManager):
+    # Socket.IO client manager that fans emits out to every worker process on the
+    # same machine without an external broker. Each worker listens on a Unix
+    # socket in a directory private to the user and publishes by writing a
+    # length-prefixed JSON frame to every other socket found there.
+    name = 'localbus'
+
+    def __init__(self, url='local://', channel='socketio', write_only=False, logger=None, json=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self.directory = os.path.join(urlparse(url).path or DEFAULT_BUS_DIRECTORY, channel)
+        self.path = os.path.join(self.directory, f'{self.host_id}.sock')
+        self._messages = queue.Queue()
+        self._peers = {}
+        self._publish_lock = threading.Lock()
+        self._listener = None
+
+    def initialize(self):
+        private_directory(os.path.dirname(self.directory))
+        private_directory(self.directory)
+        if not self.write_only:
+            self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._listener.bind(self.path)
+            self._listener.listen()
+            atexit.register(self._remove_socket)
+            threading.Thread(target=self._accept, name='localbus-accept', daemon=True).start()
+        super().initialize()
+
+    def _remove_socket(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _accept(self):
+        while True:
+            connection, _ = self._listener.accept()
+            threading.Thread(target=self._read, args=(connection,), name='localbus-read', daemon=True).start()
+
+    def _read(self, connection):
+        with connection, connection.makefile('rb') as stream:
+            while True:
+                header = stream.read(_frame_header.size)
+                if len(header) < _frame_header.size:
+                    return
+                (size,) = _frame_header.unpack(header)
+                payload = stream.read(size)
+                if len(payload) < size:
+                    return
+                self._messages.put(payload)
+
+    def _publish(self, data):
+        payload = self.json.dumps(data).encode()
+        frame = _frame_header.pack(len(payload)) + payload
+
+        with self._publish_lock:
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if path == self.path or not name.endswith('.sock'):
+                    continue
+
+                peer = self._peers.get(path)
+                if peer is None or peer.closed:
+                    connection = connect_peer(path)
+                    if connection is None:
+                        self._peers.pop(path, None)
+                        continue
+                    peer = self._peers[path] = BusPeer(path, connection)
+                if not peer.send(frame):
+                    print(f"Disconnected {path} from the Socket.IO bus, it stopped reading")
+                    self._peers.pop(path, None)
+
+    def _listen(self):
+        while True:
+            yield self._messages.get()
+
+
+def socketio_queue_options():
+    # SOCKETIO_MESSAGE_QUEUE selects how emits reach clients connected to other workers:
+    #   unset             single process, emits stay in memory
+    #   local://[/dir]    LocalBusManager over Unix sockets, all workers on one machine
+    #   redis://host:port the Redis adapter shipped with python-socketio (needs `redis`)
+    url = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+    if not url:
+        return {}
+    if url.startswith('local:'):
+        return {'client_manager': LocalBusManager(url)}
+    return {'message_queue': url}
+
+
+def async_socketio_queue_options():
+    # Same variable for the ASGI server, which needs an asyncio client manager
+    url = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+    if not url:
+        return {}
+    if url.startswith(('redis://', 'rediss://')):
+        return {'client_manager': AsyncRedisManager(url)}
+    raise RuntimeError(f"SOCKETIO_MESSAGE_QUEUE={url} is only supported by the threaded server (weather.py)")
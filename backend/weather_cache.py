@@ -0,0 +1,193 @@
+from collections import OrderedDict
+from datetime import datetime, timezone
+import os
+import threading
+import time
+
+LATEST_CACHE_SIZE = int(os.getenv('LATEST_CACHE_SIZE', 10000))
+LATEST_CACHE_TTL = float(os.getenv('LATEST_CACHE_TTL', 300))
+
+
+def is_newer(row, other):
+    return (row['timestamp'], row['id']) >= (other['timestamp'], other['id'])
+
+
+class LatestReadingCache:
+    # Latest reading per city, kept up to date by the write services and the change
+    # feed. Bounded LRU: when there are more cities than max_entries the cache can
+    # no longer answer "all cities" on its own and those requests go to the
+    # database. Entries older than ttl seconds are treated as misses, in case a
+    # write reached SQLite without going through this process.
+    def __init__(self, max_entries=LATEST_CACHE_SIZE, ttl=LATEST_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._complete_at = None
+        self._lock = threading.Lock()
+
+    def _is_fresh(self, stored_at):
+        return time.monotonic() - stored_at < self.ttl
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._complete_at = None
+
+    def get(self, city):
+        with self._lock:
+            entry = self._entries.get(city)
+            if entry is None or not self._is_fresh(entry[1]):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(city)
+            self.hits += 1
+            return entry[0]
+
+    def get_all(self):
+        with self._lock:
+            if self._complete_at is None or not self._is_fresh(self._complete_at):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return sorted((row for row, _ in self._entries.values()), key=lambda row: row['city_name'])
+
+    def put(self, row):
+        with self._lock:
+            city = row['city_name']
+            entry = self._entries.get(city)
+            if entry is not None and not is_newer(row, entry[0]):
+                return
+            self._entries[city] = (row, time.monotonic())
+            self._entries.move_to_end(city)
+            self._evict()
+
+    def put_all(self, rows):
+        with self._lock:
+            now = time.monotonic()
+            self._entries = OrderedDict((row['city_name'], (row, now)) for row in rows)
+            self._complete_at = now if len(self._entries) <= self.max_entries else None
+            self._evict()
+
+    def replace(self, row):
+        # An update can move a reading to another city or make it older, so drop
+        # whichever entry held that id and let the next read go to the database
+        with self._lock:
+            for city, (cached, _) in list(self._entries.items()):
+                if cached['id'] == row['id']:
+                    del self._entries[city]
+                    self._complete_at = None
+            city = row['city_name']
+            entry = self._entries.get(city)
+            if entry is not None and is_newer(row, entry[0]):
+                self._entries[city] = (row, time.monotonic())
+
+    def discard(self, row):
+        with self._lock:
+            entry = self._entries.get(row['city_name'])
+            if entry is not None and entry[0]['id'] == row['id']:
+                del self._entries[row['city_name']]
+                self._complete_at = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+latest_cache = LatestReadingCache()
+
+
+HISTORY_CACHE_BYTES = int(os.getenv('HISTORY_CACHE_BYTES', 64 * 1024 * 1024))
+HISTORY_CACHE_TTL = float(os.getenv('HISTORY_CACHE_TTL', 300))
+# Browser cache lifetime of responses whose range ended before the request
+HISTORY_MAX_AGE = int(os.getenv('HISTORY_MAX_AGE', 86400))
+
+
+def row_timestamp_ms(row):
+    # Formatted rows carry a naive UTC "%Y-%m-%d %H:%M:%S" timestamp
+    stamp = datetime.strptime(row['timestamp'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    return int(stamp.timestamp() * 1000)
+
+
+class HistoryResponseCache:
+    # Serialized responses of GET /weather/city/<city>, keyed on the city, the
+    # normalized time range (epoch ms, None when open) and the response format.
+    # Bounded LRU on the total size of the bodies. A write drops the entries of its
+    # city whose range contains the reading's timestamp; other entries stay valid.
+    # Writes made by other processes are only seen by the leader's change feed, so
+    # entries also expire after ttl seconds.
+    def __init__(self, max_bytes=HISTORY_CACHE_BYTES, ttl=HISTORY_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries = OrderedDict()
+        self._keys_by_city = {}
+        self._generations = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def generation(self, city):
+        # Read before querying and passed back to put, so that a response computed
+        # while a write to the same city committed is not stored
+        with self._lock:
+            return self._epoch, self._generations.get(city, 0)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[3] >= self.ttl:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[:3]
+
+    def put(self, key, generation, body, etag, last_modified):
+        city = key[0]
+        with self._lock:
+            if (self._epoch, self._generations.get(city, 0)) != generation or len(body) > self.max_bytes:
+                return
+            self._remove(key)
+            self._entries[key] = (body, etag, last_modified, time.monotonic())
+            self._keys_by_city.setdefault(city, set()).add(key)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+            keys = self._keys_by_city[key[0]]
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_city[key[0]]
+
+    def invalidate(self, row):
+        city = row['city_name']
+        timestamp = row_timestamp_ms(row)
+        with self._lock:
+            self._generations[city] = self._generations.get(city, 0) + 1
+            for key in list(self._keys_by_city.get(city, ())):
+                _, start_ms, end_ms, _ = key
+                if (start_ms is None or start_ms <= timestamp) and (end_ms is None or timestamp <= end_ms):
+                    self._remove(key)
+
+    def invalidate_before(self, cutoff_ms):
+        # Retention deleted the raw readings older than cutoff_ms in every city
+        with self._lock:
+            self._epoch += 1
+            for key in list(self._entries):
+                if key[1] is None or key[1] < cutoff_ms:
+                    self._remove(key)
+
+
+history_cache = HistoryResponseCache()
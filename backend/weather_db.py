@@ -0,0 +1,163 @@
+from prisma import Client
+from weather_metrics import db_query_duration
+import asyncio
+import concurrent.futures
+import contextvars
+import os
+import threading
+
+DATABASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database.db')
+
+# journal_mode is stored in the database file, the others apply to the connection that runs them
+SQLITE_PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -20000',
+]
+
+_client = None
+_loop = None
+_thread = None
+
+
+def database_url():
+    url = os.getenv('DATABASE_URL', f'file:{DATABASE_PATH}')
+    pool_size = os.getenv('DATABASE_POOL_SIZE')
+    if pool_size:
+        separator = '&' if '?' in url else '?'
+        url = f'{url}{separator}connection_limit={int(pool_size)}'
+    return url
+
+
+def connect_db():
+    # One Prisma client and one event loop for the whole process: Flask runs every
+    # async view in a throwaway loop, so queries are handed over to this one instead.
+    global _client, _loop, _thread
+    if _loop is not None:
+        return _client
+
+    _loop = asyncio.new_event_loop()
+    _thread = threading.Thread(target=_loop.run_forever, name='prisma-loop', daemon=True)
+    _thread.start()
+
+    _client = Client(datasource={'url': database_url()})
+    asyncio.run_coroutine_threadsafe(_client.connect(), _loop).result()
+    asyncio.run_coroutine_threadsafe(apply_pragmas(_client), _loop).result()
+    print("Connected to the database")
+    return _client
+
+
+async def connect_db_async():
+    # ASGI mode: the server's event loop is the database loop, no extra thread
+    global _client, _loop
+    if _loop is not None:
+        return _client
+
+    _loop = asyncio.get_running_loop()
+    _client = Client(datasource={'url': database_url()})
+    await _client.connect()
+    await apply_pragmas(_client)
+    print("Connected to the database")
+    return _client
+
+
+async def disconnect_db_async():
+    global _client, _loop
+    if _loop is None:
+        return
+
+    try:
+        if _client.is_connected():
+            await _client.disconnect()
+    finally:
+        _client, _loop = None, None
+
+
+async def apply_pragmas(db):
+    if not database_url().startswith('file:'):
+        return
+    for pragma in SQLITE_PRAGMAS:
+        try:
+            await db.query_raw(pragma)
+        except Exception as e:
+            print(f"Error applying '{pragma}': {e}")
+
+
+def disconnect_db():
+    global _client, _loop, _thread
+    if _loop is None:
+        return
+
+    try:
+        if _client.is_connected():
+            asyncio.run_coroutine_threadsafe(_client.disconnect(), _loop).result()
+    finally:
+        _loop.call_soon_threadsafe(_loop.stop)
+        _thread.join()
+        _loop.close()
+        _client, _loop, _thread = None, None, None
+
+
+def query_name(query):
+    # Queries are mostly lambdas defined in a service: label them with the service
+    return query.__qualname__.split('.')[0]
+
+
+async def run_on_db(query):
+    if _loop is None:
+        raise RuntimeError("Database is not connected, call connect_db() first")
+
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+
+    with db_query_duration.time(query=query_name(query)):
+        if running_loop is _loop:
+            return await query(_client)
+
+        future = asyncio.run_coroutine_threadsafe(query(_client), _loop)
+        return await asyncio.wrap_future(future)
+
+
+def run_on_loop(coroutine):
+    # Runs a coroutine on the database loop from another thread and waits for it.
+    # The task gets a copy of the caller's context, so Flask's request and app
+    # context stay available inside it.
+    if _loop is None:
+        raise RuntimeError("Database is not connected, call connect_db() first")
+
+    context = contextvars.copy_context()
+    result = concurrent.futures.Future()
+
+    def finish(task):
+        if task.cancelled():
+            result.cancel()
+        elif task.exception() is not None:
+            result.set_exception(task.exception())
+        else:
+            result.set_result(task.result())
+
+    def start():
+        _loop.create_task(coroutine, context=context).add_done_callback(finish)
+
+    _loop.call_soon_threadsafe(start)
+    return result.result()
+
+
+def run_on_db_sync(query):
+    if _loop is None:
+        raise RuntimeError("Database is not connected, call connect_db() first")
+    with db_query_duration.time(query=query_name(query)):
+        return asyncio.run_coroutine_threadsafe(query(_client), _loop).result()
+
+
+def db_health():
+    try:
+        run_on_db_sync(lambda db: db.query_raw('SELECT 1 AS ok'))
+        return True
+    except Exception as e:
+        print(f"Database health check failed: {e}")
+        return False
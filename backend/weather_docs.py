@@ -0,0 +1,41 @@
+import os
+
+SPECS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'specs')
+# 0 leaves out the Swagger UI and the /apispec_1.json route, flasgger is then
+# never imported
+SWAGGER_UI = os.getenv('SWAGGER_UI', '1') == '1'
+
+SWAGGER_CONFIG = {
+    'title': 'Weather API',
+    'uiversion': 3,
+    'openapi': '3.0.2',
+    'description': 'API for weather data management',
+    'termsOfService': 'https://example.com/terms',
+    'contact': {
+        'name': 'Your Name',
+        'url': 'https://example.com/contact',
+        'email': 'your.email@example.com',
+    },
+    'license': {
+        'name': 'Your License',
+        'url': 'https://example.com/license',
+    },
+}
+
+
+def swag_path(name):
+    # Like flasgger's swag_from('specs/<name>'), without importing flasgger or
+    # wrapping the view: the YAML file is only read when the spec is requested
+    def decorator(function):
+        function.swag_path = os.path.join(SPECS_DIRECTORY, name)
+        function.swag_type = 'yml'
+        return function
+    return decorator
+
+
+def init_docs(app):
+    if not SWAGGER_UI:
+        return
+    from flasgger import Swagger
+    app.config['SWAGGER'] = SWAGGER_CONFIG
+    Swagger(app)
@@ -0,0 +1,37 @@
+def lttb(points, threshold):
+    # Largest-Triangle-Three-Buckets: keeps the first and last points and, for each
+    # bucket in between, the point forming the largest triangle with its neighbours.
+    # points is a list of (x, y) tuples sorted by x.
+    length = len(points)
+    if threshold >= length or threshold < 3:
+        return list(points)
+
+    sampled = [points[0]]
+    bucket_size = (length - 2) / (threshold - 2)
+    a = 0
+
+    for i in range(threshold - 2):
+        next_start = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, length)
+        next_bucket = points[next_start:next_end]
+        avg_x = sum(x for x, _ in next_bucket) / len(next_bucket)
+        avg_y = sum(y for _, y in next_bucket) / len(next_bucket)
+
+        start = int(i * bucket_size) + 1
+        end = next_start
+        point_ax, point_ay = points[a]
+
+        max_area = -1.0
+        max_index = start
+        for j in range(start, end):
+            x, y = points[j]
+            area = abs((point_ax - avg_x) * (y - point_ay) - (point_ax - x) * (avg_y - point_ay))
+            if area > max_area:
+                max_area = area
+                max_index = j
+
+        sampled.append(points[max_index])
+        a = max_index
+
+    sampled.append(points[-1])
+    return sampled
@@ -0,0 +1,142 @@
+import io
+import os
+
+# pyarrow is optional and slow to import, it is loaded by the first export
+pa = None
+pq = None
+
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 50000))
+EXPORT_COMPRESSION = os.getenv('EXPORT_COMPRESSION', 'zstd')
+EXPORT_FORMATS = {
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+EXPORT_COLUMNS = ('id', 'city_name', 'latitude', 'longitude', 'temperature', 'feels_like', 'humidity', 'pressure', 'description', 'timestamp')
+PARQUET_MAGIC = b'PAR1'
+ARROW_FILE_MAGIC = b'ARROW1'
+
+
+def load_pyarrow():
+    # False when pyarrow is not installed
+    global pa, pq
+    if pa is None:
+        try:
+            import pyarrow
+            import pyarrow.ipc
+            import pyarrow.parquet
+        except ImportError:
+            return False
+        pa, pq = pyarrow, pyarrow.parquet
+    return True
+
+
+def require_pyarrow():
+    if not load_pyarrow():
+        raise RuntimeError("Arrow and Parquet exports need pyarrow: pip install pyarrow")
+
+
+def export_schema():
+    return pa.schema([
+        ('id', pa.int64()),
+        ('city_name', pa.dictionary(pa.int32(), pa.string())),
+        ('latitude', pa.float64()),
+        ('longitude', pa.float64()),
+        ('temperature', pa.float64()),
+        ('feels_like', pa.float64()),
+        ('humidity', pa.int64()),
+        ('pressure', pa.int64()),
+        ('description', pa.dictionary(pa.int32(), pa.string())),
+        ('timestamp', pa.timestamp('ms', tz='UTC')),
+    ])
+
+
+async def fetch_export_rows(db, after_id, start_ms, end_ms, limit=EXPORT_BATCH_SIZE, city=None):
+    # Keyset page in id order. "timestamp" + 0 keeps the stored epoch milliseconds
+    # as an integer, which Arrow takes as is
+    city_condition = 'AND "city_name" = ?' if city is not None else ''
+    city_params = (city,) if city is not None else ()
+    return await db.query_raw(
+        f'''
+        SELECT "id", "city_name", "latitude", "longitude", "temperature", "feels_like",
+               "humidity", "pressure", "description", "timestamp" + 0 AS "timestamp"
+        FROM "WeatherData"
+        WHERE "id" > ? AND "timestamp" >= ? AND "timestamp" <= ? {city_condition}
+        ORDER BY "id"
+        LIMIT ?
+        ''',
+        after_id, start_ms, end_ms, *city_params, limit,
+    )
+
+
+def record_batch(rows, schema):
+    columns = {name: [row[name] for row in rows] for name in EXPORT_COLUMNS}
+    return pa.record_batch([pa.array(columns[field.name], field.type) for field in schema], schema=schema)
+
+
+class ChunkSink(io.RawIOBase):
+    # Write-only file handed to the Arrow writers. Whatever they wrote since the
+    # last drain() is sent to the client, so only one batch is held in memory
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def open_writer(sink, export_format, schema):
+    if export_format == 'parquet':
+        return pq.ParquetWriter(sink, schema, compression=EXPORT_COMPRESSION)
+    return pa.ipc.new_stream(sink, schema, options=pa.ipc.IpcWriteOptions(compression=EXPORT_COMPRESSION))
+
+
+def write_export(row_batches, export_format):
+    # Turns batches of rows into chunks of an Arrow IPC stream or a Parquet file
+    # with one row group per batch
+    require_pyarrow()
+    schema = export_schema()
+    sink = ChunkSink()
+    writer = open_writer(sink, export_format, schema)
+    try:
+        for rows in row_batches:
+            if rows:
+                writer.write_batch(record_batch(rows, schema))
+                yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def read_export(source, batch_size=EXPORT_BATCH_SIZE):
+    # Reads back a file written by write_export, Arrow IPC stream or Parquet,
+    # as lists of row dicts ready for create_many
+    require_pyarrow()
+    with open(source, 'rb') as f:
+        magic = f.read(len(ARROW_FILE_MAGIC))
+
+    if magic.startswith(PARQUET_MAGIC):
+        batches = pq.ParquetFile(source).iter_batches(batch_size=batch_size)
+    elif magic == ARROW_FILE_MAGIC:
+        reader = pa.ipc.open_file(pa.memory_map(source))
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+    else:
+        batches = pa.ipc.open_stream(pa.memory_map(source))
+
+    for batch in batches:
+        rows = batch.to_pylist()
+        for row in rows:
+            del row['id']
+        yield rows
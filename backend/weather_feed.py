@@ -0,0 +1,171 @@
+from weather_api_service import iter_weather_batches, get_latest_weather_id
+from weather_cache import latest_cache, history_cache
+from weather_geo import station_index
+from weather_window import hot_window
+import fcntl
+import os
+import tempfile
+import threading
+
+FEED_POLL_SECONDS = float(os.getenv('FEED_POLL_SECONDS', 2))
+FEED_LOCK_FILE = os.getenv('FEED_LOCK_FILE', os.path.join(tempfile.gettempdir(), 'weather-feed.lock'))
+# A client that missed more rows than this gets a `reload` event instead of the rows
+FEED_RESUME_MAX_ROWS = int(os.getenv('FEED_RESUME_MAX_ROWS', 5000))
+
+# Clients join one room per city they display, or this one to receive every city
+ALL_CITIES_ROOM = '*'
+
+
+def city_rooms(city):
+    return [city, ALL_CITIES_ROOM]
+
+
+def parse_since(value):
+    # The `since` sent by a client, None when it is missing or not a row id
+    if isinstance(value, bool):
+        return None
+    try:
+        since = int(value)
+    except (TypeError, ValueError):
+        return None
+    return since if since >= 0 else None
+
+
+class ChangeFeed:
+    # Pushes new WeatherData rows to Socket.IO clients in id order. The id is the
+    # sequence number: clients remember the highest id they received and send it
+    # back as `since` when they reconnect. Writes made through the API wake the
+    # feed immediately, rows written by the importer are picked up by a cheap
+    # `id > last_seq` query every FEED_POLL_SECONDS.
+    #
+    # With several workers sharing a message queue, only the worker holding
+    # `leader_lock` publishes, otherwise every client would get each row once per
+    # worker. The leader keeps last_seq in the lock file so a worker taking over
+    # continues where the previous one stopped.
+    def __init__(self, socketio, emitter, namespace='/data', poll_interval=FEED_POLL_SECONDS, leader_lock=None):
+        self.socketio = socketio
+        self.emitter = emitter
+        self.namespace = namespace
+        self.poll_interval = poll_interval
+        self.leader_lock = leader_lock
+        self.last_seq = None
+        self._lock_file = None
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._running = False
+
+    def start(self):
+        if self._running:
+            return
+        if self.leader_lock is None:
+            self.last_seq = get_latest_weather_id()
+        self._running = True
+        self.socketio.start_background_task(self._run)
+
+    @property
+    def is_leader(self):
+        return self.leader_lock is None or self._lock_file is not None
+
+    def _acquire_leadership(self):
+        lock_file = open(self.leader_lock, 'a+')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+
+        lock_file.seek(0)
+        stored_seq = lock_file.read().strip()
+        self.last_seq = int(stored_seq) if stored_seq else get_latest_weather_id()
+        self._lock_file = lock_file
+        print(f"Change feed leader, publishing after id {self.last_seq}")
+        return True
+
+    def _store_seq(self):
+        if self._lock_file is not None:
+            self._lock_file.seek(0)
+            self._lock_file.truncate()
+            self._lock_file.write(str(self.last_seq))
+            self._lock_file.flush()
+
+    def broadcast_seq(self):
+        if self.is_leader:
+            return self.last_seq
+        try:
+            with open(self.leader_lock) as f:
+                stored_seq = f.read().strip()
+            return int(stored_seq) if stored_seq else None
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def _run(self):
+        while self._running:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            if not self._running:
+                return
+            try:
+                if not self.is_leader and not self._acquire_leadership():
+                    continue
+                self.publish_pending()
+            except Exception as e:
+                print(f"Error publishing new weather data: {e}")
+
+    def publish_pending(self):
+        with self._lock:
+            for batch in iter_weather_batches(self.last_seq):
+                self.emit_rows(batch)
+                self.last_seq = batch[-1]['id']
+                self._store_seq()
+
+    def emit_rows(self, rows):
+        # Rows written by the importer reach this process only through the feed
+        rows_by_city = {}
+        for row in rows:
+            latest_cache.put(row)
+            history_cache.invalidate(row)
+            rows_by_city.setdefault(row['city_name'], []).append(row)
+        station_index.put_rows(rows)
+        hot_window.add_rows(rows)
+
+        # One event per city room, coalesced with the other mutations by the emitter
+        for city, city_rows in rows_by_city.items():
+            if len(city_rows) == 1:
+                self.emitter.emit('send_newdata', city_rows[0], namespace=self.namespace, to=city_rooms(city))
+            else:
+                self.emitter.emit('send_newdata_batch', city_rows, namespace=self.namespace, to=city_rooms(city))
+
+    def resume(self, sid, since, max_rows=FEED_RESUME_MAX_ROWS):
+        # Replays what a reconnecting client missed, up to what the feed has
+        # already broadcast: anything newer reaches it through the next broadcast.
+        # Only `until` is read under the publish lock, so a replay never holds up
+        # the broadcasts; those may then reach the client before the older rows.
+        if since is None:
+            return
+        with self._lock:
+            until = self.broadcast_seq()
+        if until is None or since >= until:
+            return
+
+        subscribed = set(self.socketio.server.rooms(sid, namespace=self.namespace))
+        everything = ALL_CITIES_ROOM in subscribed
+        scanned = 0
+        for batch in iter_weather_batches(since):
+            rows = [row for row in batch if row['id'] <= until]
+            scanned += len(rows)
+            if scanned > max_rows:
+                # Too far behind, the client loads its data again instead
+                self.socketio.emit('reload', {'until': until}, namespace=self.namespace, to=sid)
+                return
+            city_rows = [row for row in rows if everything or row['city_name'] in subscribed]
+            if city_rows:
+                self.socketio.emit('latest_data', city_rows, namespace=self.namespace, to=sid)
+            if len(rows) < len(batch):
+                return
@@ -0,0 +1,125 @@
+import math
+import os
+import threading
+
+GEO_CELL_DEGREES = float(os.getenv('GEO_CELL_DEGREES', 1.0))
+GEO_REFRESH_SECONDS = float(os.getenv('GEO_REFRESH_SECONDS', 30))
+EARTH_RADIUS_KM = 6371.0088
+HALF_CIRCUMFERENCE_KM = math.pi * EARTH_RADIUS_KM
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_boxes(lat, lon, radius_km):
+    # Boxes holding every point within radius_km of (lat, lon), two of them when the
+    # circle crosses the antimeridian. See "Finding Points Within a Distance of a
+    # Latitude/Longitude Using Bounding Coordinates", J. Matuschek.
+    angular = radius_km / EARTH_RADIUS_KM
+    min_lat = lat - math.degrees(angular)
+    max_lat = lat + math.degrees(angular)
+    if min_lat <= -90 or max_lat >= 90:
+        # The circle contains a pole, so every longitude
+        return [(max(min_lat, -90), -180, min(max_lat, 90), 180)]
+
+    delta_lon = math.degrees(math.asin(math.sin(angular) / math.cos(math.radians(lat))))
+    min_lon = lon - delta_lon
+    max_lon = lon + delta_lon
+    if min_lon < -180:
+        return [(min_lat, min_lon + 360, max_lat, 180), (min_lat, -180, max_lat, max_lon)]
+    if max_lon > 180:
+        return [(min_lat, min_lon, max_lat, 180), (min_lat, -180, max_lat, max_lon - 360)]
+    return [(min_lat, min_lon, max_lat, max_lon)]
+
+
+class StationIndex:
+    # Latest known coordinates of every city, bucketed in a grid of cell_degrees
+    # squares so that box and nearest lookups only look at the cells they cover
+    # instead of every station. Updated in place by the write services and the
+    # change feed; refresh_station_index picks up rows written by other processes
+    # through `last_id`.
+    def __init__(self, cell_degrees=GEO_CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self.last_id = None
+        self.refreshed_at = None
+        self._stations = {}
+        self._cells = {}
+        self._lock = threading.Lock()
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.cell_degrees), math.floor(lon / self.cell_degrees)
+
+    def put(self, city, lat, lon):
+        cell = self._cell(lat, lon)
+        with self._lock:
+            station = self._stations.get(city)
+            if station is not None:
+                if station == (lat, lon, cell):
+                    return
+                self._discard(city, station[2])
+            self._stations[city] = (lat, lon, cell)
+            self._cells.setdefault(cell, set()).add(city)
+
+    def put_rows(self, rows):
+        for row in rows:
+            self.put(row['city_name'], row['latitude'], row['longitude'])
+
+    def _discard(self, city, cell):
+        cities = self._cells[cell]
+        cities.discard(city)
+        if not cities:
+            del self._cells[cell]
+
+    def __len__(self):
+        return len(self._stations)
+
+    def _box_cells(self, min_lat, min_lon, max_lat, max_lon):
+        first_row, first_column = self._cell(min_lat, min_lon)
+        last_row, last_column = self._cell(max_lat, max_lon)
+        if (last_row - first_row + 1) * (last_column - first_column + 1) > len(self._cells):
+            # Large box, cheaper to walk the occupied cells
+            return [cell for cell in self._cells
+                    if first_row <= cell[0] <= last_row and first_column <= cell[1] <= last_column]
+        return [(row, column) for row in range(first_row, last_row + 1)
+                for column in range(first_column, last_column + 1) if (row, column) in self._cells]
+
+    def _within(self, min_lat, min_lon, max_lat, max_lon):
+        found = []
+        for cell in self._box_cells(min_lat, min_lon, max_lat, max_lon):
+            for city in self._cells[cell]:
+                lat, lon, _ = self._stations[city]
+                if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon:
+                    found.append((city, lat, lon))
+        return found
+
+    def within(self, min_lat, min_lon, max_lat, max_lon):
+        # Cities inside the box. min_lon > max_lon means the box crosses the antimeridian
+        with self._lock:
+            if min_lon > max_lon:
+                found = self._within(min_lat, min_lon, max_lat, 180) + self._within(min_lat, -180, max_lat, max_lon)
+            else:
+                found = self._within(min_lat, min_lon, max_lat, max_lon)
+        return sorted(city for city, _, _ in found)
+
+    def nearest(self, lat, lon, k):
+        # Looks in a circle that doubles until it holds k stations: every station
+        # closer than the radius has been seen, so the k closest found are exact.
+        # Returns [(distance_km, city)] closest first.
+        radius = max(self.cell_degrees * 111.0, 1.0)
+        with self._lock:
+            while True:
+                candidates = []
+                for box in bounding_boxes(lat, lon, radius):
+                    for city, station_lat, station_lon in self._within(*box):
+                        distance = haversine_km(lat, lon, station_lat, station_lon)
+                        if distance <= radius:
+                            candidates.append((distance, city))
+                if len(candidates) >= k or radius >= HALF_CIRCUMFERENCE_KM or len(candidates) == len(self._stations):
+                    return sorted(candidates)[:k]
+                radius *= 2
+
+
+station_index = StationIndex()
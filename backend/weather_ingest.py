@@ -0,0 +1,391 @@
+from datetime import datetime
+from weather_metrics import ingest_commit_duration, ingest_pending_writes
+import asyncio
+import fcntl
+import itertools
+import json
+import os
+import struct
+import threading
+import zlib
+
+INGEST_DIRECTORY = os.getenv('INGEST_DIRECTORY', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ingest'))
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 5000))
+INGEST_MAX_PENDING = int(os.getenv('INGEST_MAX_PENDING', 100000))
+INGEST_FULL_TIMEOUT = float(os.getenv('INGEST_FULL_TIMEOUT', 5))
+INGEST_SEGMENT_BYTES = int(os.getenv('INGEST_SEGMENT_BYTES', 64 * 1024 * 1024))
+INGEST_FSYNC = os.getenv('INGEST_FSYNC', '1') == '1'
+INGEST_DRAIN_SECONDS = float(os.getenv('INGEST_DRAIN_SECONDS', 30))
+RETRY_SECONDS = 0.05
+MAX_RETRY_SECONDS = 2.0
+
+# Payload length, CRC32 of the payload, sequence number of the group
+FRAME_HEADER = struct.Struct('<IIQ')
+
+CHECKPOINT_SQL = '''
+    INSERT INTO "IngestCheckpoint" ("name", "seq") VALUES (?, ?)
+    ON CONFLICT ("name") DO UPDATE SET "seq" = excluded."seq"
+'''
+
+_queue = None
+
+
+class IngestQueueFull(Exception):
+    pass
+
+
+def encode_ops(ops):
+    return json.dumps(ops, separators=(',', ':'), default=datetime.isoformat).encode()
+
+
+def decode_ops(payload):
+    ops = json.loads(payload)
+    for op, data in ops:
+        if isinstance(data.get('timestamp'), str):
+            data['timestamp'] = datetime.fromisoformat(data['timestamp'])
+    return [tuple(op) for op in ops]
+
+
+def read_frames(path):
+    # Yields (seq, ops, end offset) up to the first incomplete or corrupted frame,
+    # which is where a crash interrupted the last append
+    with open(path, 'rb') as f:
+        offset = 0
+        while True:
+            header = f.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return
+            length, checksum, seq = FRAME_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                return
+            offset += FRAME_HEADER.size + length
+            yield seq, decode_ops(payload), offset
+
+
+def is_transient(error):
+    message = str(error).lower()
+    return any(text in message for text in ('locked', 'busy', 'timed out', 'not connected'))
+
+
+class IngestLog:
+    # Append-only log in its own directory, split into segments named after the
+    # first sequence number they hold. One frame per group of writes. A process
+    # owns the directory through an flock on its lock file, so a worker that
+    # restarts after a crash, or any other one, can take it over and replay it.
+    def __init__(self, root, name, segment_bytes=INGEST_SEGMENT_BYTES):
+        self.segment_bytes = segment_bytes
+        self._segments = []
+        self._fd = None
+        self._size = 0
+        self._sync_lock = threading.Lock()
+
+        for slot in itertools.count():
+            directory = os.path.join(root, f'{name}-{slot}')
+            os.makedirs(directory, exist_ok=True)
+            lock_file = open(os.path.join(directory, 'lock'), 'a+')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            self.name = f'{name}-{slot}'
+            self.directory = directory
+            self._lock_file = lock_file
+            break
+
+    def recover(self):
+        # Frames left by the previous owner; a torn frame at the end of the last
+        # segment is cut off so new frames follow the last complete one
+        frames = []
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith('.log'))
+        for name in names:
+            path = os.path.join(self.directory, name)
+            end = 0
+            last_seq = int(name[:-4]) - 1
+            for last_seq, ops, end in read_frames(path):
+                frames.append((last_seq, ops))
+            if end < os.path.getsize(path):
+                print(f"Ingestion log {path}: dropping {os.path.getsize(path) - end} bytes of an incomplete write")
+                os.truncate(path, end)
+            self._segments.append([path, last_seq])
+        return frames
+
+    def append(self, seq, ops):
+        if self._fd is None or self._size >= self.segment_bytes:
+            self._rotate(seq)
+        payload = encode_ops(ops)
+        frame = FRAME_HEADER.pack(len(payload), zlib.crc32(payload), seq) + payload
+        os.write(self._fd, frame)
+        self._size += len(frame)
+        self._segments[-1][1] = seq
+
+    def _rotate(self, seq):
+        path = os.path.join(self.directory, f'{seq:020d}.log')
+        with self._sync_lock:
+            if self._fd is not None:
+                os.fsync(self._fd)
+                os.close(self._fd)
+            self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._size = 0
+        self._segments.append([path, seq])
+
+    def sync(self):
+        with self._sync_lock:
+            if self._fd is not None:
+                os.fsync(self._fd)
+
+    def release(self, committed_seq):
+        # Segments whose every frame is committed are no longer needed for replay
+        while len(self._segments) > 1 and self._segments[0][1] <= committed_seq:
+            os.remove(self._segments.pop(0)[0])
+        if self._fd is None and self._segments and self._segments[0][1] <= committed_seq:
+            os.remove(self._segments.pop(0)[0])
+
+    def close(self):
+        with self._sync_lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+        self._lock_file.close()
+
+
+async def apply_group(db, ops, want_results):
+    # Consecutive creates go through one create_many. Updates and deletes read the
+    # previous row first so that a missing id is a None result, not an error that
+    # would abort the whole transaction.
+    results = []
+    index = 0
+    while index < len(ops):
+        op, data = ops[index]
+        if op == 'create':
+            end = index
+            while end < len(ops) and ops[end][0] == 'create':
+                end += 1
+            rows = [data for _, data in ops[index:end]]
+            if len(rows) == 1 and want_results:
+                results.append(await db.weatherdata.create(data=rows[0]))
+            else:
+                count = await db.weatherdata.create_many(data=rows)
+                if want_results:
+                    # The transaction holds the write lock, the last count ids are these rows
+                    created = await db.weatherdata.find_many(order={'id': 'desc'}, take=count)
+                    results.extend(reversed(created))
+                else:
+                    results.extend([None] * count)
+            index = end
+            continue
+
+        if op == 'observe':
+            # Provider time of a station's last reading, stored with the reading
+            await db.station.update_many(where={'name': data['name']}, data={'last_observed_dt': data['dt']})
+            results.append(None)
+            index += 1
+            continue
+
+        previous = await db.weatherdata.find_first(where={'id': data['id']})
+        if previous is None:
+            results.append(None)
+        elif op == 'update':
+            fields = {key: value for key, value in data.items() if key != 'id'}
+            updated = await db.weatherdata.update(where={'id': data['id']}, data=fields)
+            results.append((updated, previous))
+        else:
+            await db.weatherdata.delete_many(where={'id': data['id']})
+            results.append(previous)
+        index += 1
+    return results
+
+
+class IngestQueue:
+    # Single writer for one process. Producers append a group of writes to the
+    # log and either wait for its result (API requests) or go on right away (the
+    # importer). The writer commits as many pending groups as fit in batch_size
+    # writes in one transaction, together with the sequence number of the last
+    # one in IngestCheckpoint, so a replay after a crash skips exactly the groups
+    # already in the database. A group is never split across transactions.
+    #
+    # Everything runs on the event loop of the Prisma client passed to start().
+    def __init__(self, name, directory=INGEST_DIRECTORY, batch_size=INGEST_BATCH_SIZE, max_pending=INGEST_MAX_PENDING):
+        self.name = name
+        self.directory = directory
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.log = None
+        self._db = None
+        self._seq = 0
+        self._pending = []
+        self._pending_writes = 0
+        self._wakeup = None
+        self._space = None
+        self._writer = None
+
+    async def start(self, db):
+        self._db = db
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Condition()
+        self.log = IngestLog(self.directory, self.name)
+
+        rows = await db.query_raw('SELECT "seq" FROM "IngestCheckpoint" WHERE "name" = ?', self.log.name)
+        committed = int(rows[0]['seq']) if rows else 0
+        frames = self.log.recover()
+        replay = [(seq, ops, None) for seq, ops in frames if seq > committed]
+        if replay:
+            print(f"Ingestion log {self.log.name}: replaying {len(replay)} groups written before a restart")
+        self._seq = max([committed] + [seq for seq, _ in frames])
+        self._pending.extend(replay)
+        self._pending_writes += sum(len(ops) for _, ops, _ in replay)
+        ingest_pending_writes.inc(self._pending_writes)
+        self.log.release(committed)
+
+        self._writer = asyncio.get_running_loop().create_task(self._run())
+        self._wakeup.set()
+
+    async def submit(self, ops, wait=True, timeout=INGEST_FULL_TIMEOUT):
+        # Returns one result per op once committed, or None right after the append
+        # when wait is False. Blocks while max_pending writes are waiting; after
+        # timeout seconds (None: forever) raises IngestQueueFull.
+        async with self._space:
+            has_room = lambda: self._pending_writes == 0 or self._pending_writes + len(ops) <= self.max_pending
+            try:
+                await asyncio.wait_for(self._space.wait_for(has_room), timeout)
+            except asyncio.TimeoutError:
+                raise IngestQueueFull(f"{self._pending_writes} writes are waiting for the database")
+
+            self._seq += 1
+            self.log.append(self._seq, ops)
+            future = asyncio.get_running_loop().create_future() if wait else None
+            self._pending.append((self._seq, ops, future))
+            self._pending_writes += len(ops)
+            ingest_pending_writes.inc(len(ops))
+        self._wakeup.set()
+        return await future if wait else None
+
+    async def _run(self):
+        delay = RETRY_SECONDS
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            groups = [self._pending[0]]
+            writes = len(groups[0][1])
+            for group in self._pending[1:]:
+                if writes + len(group[1]) > self.batch_size:
+                    break
+                groups.append(group)
+                writes += len(group[1])
+
+            try:
+                if INGEST_FSYNC:
+                    await asyncio.get_running_loop().run_in_executor(None, self.log.sync)
+                with ingest_commit_duration.time():
+                    results = await self._commit(groups)
+            except Exception as e:
+                if is_transient(e):
+                    print(f"Ingestion writer: {e}, retrying in {delay:.2f}s")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, MAX_RETRY_SECONDS)
+                    continue
+                # A write the database refuses must not hold back the others
+                print(f"Ingestion writer: {e}, committing the {len(groups)} groups one by one")
+                results = []
+                error = None
+                for group in groups:
+                    try:
+                        results.append((await self._commit([group]))[0])
+                    except Exception as group_error:
+                        if is_transient(group_error) or not await self._skip(group):
+                            error = group_error
+                            break
+                        print(f"Ingestion writer: dropping group {group[0]}: {group_error}")
+                        results.append(group_error)
+                if error is not None:
+                    # The groups left wait like after a transient error on the whole batch
+                    await self._finish(groups[:len(results)], results)
+                    print(f"Ingestion writer: {error}, retrying group {groups[len(results)][0]} in {delay:.2f}s")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, MAX_RETRY_SECONDS)
+                    continue
+
+            delay = RETRY_SECONDS
+            await self._finish(groups, results)
+
+    async def _commit(self, groups):
+        results = []
+        async with self._db.tx() as transaction:
+            for seq, ops, future in groups:
+                results.append(await apply_group(transaction, ops, future is not None))
+            await transaction.execute_raw(CHECKPOINT_SQL, self.log.name, groups[-1][0])
+        return results
+
+    async def _skip(self, group):
+        try:
+            await self._db.execute_raw(CHECKPOINT_SQL, self.log.name, group[0])
+            return True
+        except Exception as e:
+            print(f"Ingestion writer: could not skip group {group[0]}: {e}")
+            return False
+
+    async def _finish(self, groups, results):
+        for (seq, ops, future), result in zip(groups, results):
+            if future is not None and not future.done():
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        committed = sum(len(ops) for _, ops, _ in groups)
+        del self._pending[:len(groups)]
+        ingest_pending_writes.dec(committed)
+        async with self._space:
+            self._pending_writes -= committed
+            self._space.notify_all()
+        if groups:
+            self.log.release(groups[-1][0])
+
+    async def stop(self, timeout=INGEST_DRAIN_SECONDS):
+        # Gives the writer some time to drain, what is left is replayed on restart.
+        # Returns the number of writes left.
+        if self._writer is None:
+            return 0
+        left = 0
+        try:
+            await asyncio.wait_for(self._drained(), timeout)
+        except asyncio.TimeoutError:
+            left = self._pending_writes
+            print(f"Ingestion log {self.log.name}: {left} writes left for the next start")
+        self._writer.cancel()
+        self._writer = None
+        self.log.close()
+        return left
+
+    async def _drained(self):
+        async with self._space:
+            await self._space.wait_for(lambda: self._pending_writes == 0)
+
+
+async def start_ingest(db, name):
+    global _queue
+    if _queue is None:
+        _queue = IngestQueue(name)
+        await _queue.start(db)
+    return _queue
+
+
+async def stop_ingest(timeout=INGEST_DRAIN_SECONDS):
+    # Returns the number of writes left uncommitted
+    global _queue
+    left = 0
+    if _queue is not None:
+        left = await _queue.stop(timeout)
+        _queue = None
+    return left
+
+
+async def submit_writes(ops, wait=True, timeout=INGEST_FULL_TIMEOUT):
+    # ops is a list of ('create', data), ('update', {'id', ...data}), ('delete', {'id'})
+    # or ('observe', {'name', 'dt'})
+    if _queue is None:
+        raise RuntimeError("Ingestion queue is not started, call start_ingest() first")
+    return await _queue.submit(ops, wait, timeout)
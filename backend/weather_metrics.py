@@ -0,0 +1,150 @@
+# No Flask here: the importer loads this module too
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+# Prometheus text exposition format, https://prometheus.io/docs/instrumenting/exposition_formats/
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SLOW_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_registry = []
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # One counter per bucket plus +Inf, then the sum
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[len(self.buckets)] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted(self._series.items())
+            for key, values in series:
+                for bound, count in zip(self.buckets + ('+Inf',), values):
+                    lines.append(f'{self.name}_bucket{format_labels(self.labelnames, key, [("le", bound)])} {count}')
+                lines.append(f'{self.name}_sum{format_labels(self.labelnames, key)} {values[-1]}')
+                lines.append(f'{self.name}_count{format_labels(self.labelnames, key)} {values[-2]}')
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def render(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge', f'{self.name} {self.value}']
+
+
+class Counter(Gauge):
+    def render(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter', f'{self.name} {self.value}']
+
+
+def render_metrics():
+    return '\n'.join(line for metric in _registry for line in metric.render()) + '\n'
+
+
+http_request_duration = Histogram(
+    'weather_http_request_duration_seconds', 'HTTP request latency until the response is returned',
+    ('method', 'route', 'status'),
+)
+db_query_duration = Histogram(
+    'weather_db_query_duration_seconds', 'Time spent in database queries, by service', ('query',),
+)
+serialization_duration = Histogram(
+    'weather_serialization_duration_seconds', 'Time spent turning rows into dicts or columns and encoding JSON',
+    ('stage',),
+)
+socketio_connected_clients = Gauge(
+    'weather_socketio_connected_clients', 'Socket.IO clients connected to /data on this worker',
+)
+socketio_emit_duration = Histogram(
+    'weather_socketio_emit_duration_seconds', 'Time to fan one Socket.IO emit out to its recipients', ('event',),
+)
+socketio_dropped_events = Counter(
+    'weather_socketio_dropped_events_total', 'Batched events dropped for clients too slow to acknowledge them',
+)
+import_cycle_duration = Histogram(
+    'weather_import_cycle_duration_seconds', 'Duration of one importer cycle, fetch and insert', buckets=SLOW_BUCKETS,
+)
+import_fetch_duration = Histogram(
+    'weather_import_fetch_duration_seconds', 'OpenWeatherMap request latency, retries included, by endpoint and status',
+    ('endpoint', 'status'),
+)
+import_unchanged_observations = Counter(
+    'weather_import_unchanged_observations_total', 'Fetched readings not stored because the station had no new observation',
+)
+ingest_pending_writes = Gauge(
+    'weather_ingest_pending_writes', 'Writes appended to the ingestion log and not committed yet',
+)
+ingest_commit_duration = Histogram(
+    'weather_ingest_commit_duration_seconds', 'Duration of one group commit of the ingestion writer',
+)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port):
+    # /metrics for processes without Flask, like the importer
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
@@ -0,0 +1,124 @@
+from flask import g, request
+from collections import Counter, deque
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+# Off unless one of these is set:
+#   PROFILE_SLOW_MS=500       dump the stacks of every request slower than 500 ms
+#   PROFILE_ALLOW_HEADER=1    dump the stacks of any request sent with "X-Profile: 1"
+PROFILE_SLOW_MS = float(os.getenv('PROFILE_SLOW_MS', 0))
+PROFILE_ALLOW_HEADER = os.getenv('PROFILE_ALLOW_HEADER') == '1'
+PROFILE_HEADER = 'X-Profile'
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', 10))
+PROFILE_WINDOW_SECONDS = float(os.getenv('PROFILE_WINDOW_SECONDS', 60))
+PROFILE_DIRECTORY = os.getenv('PROFILE_DIRECTORY', os.path.join(tempfile.gettempdir(), 'weather-profiles'))
+
+# Innermost frames of threads that are waiting for work, left out of the samples
+IDLE_FRAMES = {
+    ('threading.py', 'wait'),
+    ('selectors.py', 'select'),
+    ('thread.py', '_worker'),
+    ('queue.py', 'get'),
+    ('socket.py', 'accept'),
+    ('socketserver.py', 'serve_forever'),
+}
+
+
+def collapse_stack(thread_name, frame):
+    innermost = (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+    if innermost in IDLE_FRAMES:
+        return None
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    names.append(thread_name)
+    return ';'.join(name.replace(';', ':') for name in reversed(names))
+
+
+class StackSampler:
+    # Samples the Python stack of every thread in the process every interval and
+    # keeps the last `window` seconds, so the stacks seen while a request ran can
+    # be pulled out once it turns out to be slow. With several requests in flight
+    # their samples overlap: each stack starts with the name of its thread.
+    def __init__(self, interval=PROFILE_INTERVAL_MS / 1000, window=PROFILE_WINDOW_SECONDS):
+        self.interval = interval
+        self.window = window
+        self._samples = deque()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident != own_ident:
+                    stack = collapse_stack(names.get(ident, str(ident)), frame)
+                    if stack is not None:
+                        stacks.append(stack)
+
+            now = time.perf_counter()
+            with self._lock:
+                self._samples.append((now, stacks))
+                while self._samples and now - self._samples[0][0] > self.window:
+                    self._samples.popleft()
+
+    def collect(self, started, finished):
+        with self._lock:
+            return Counter(stack for sampled_at, stacks in self._samples
+                           if started <= sampled_at <= finished for stack in stacks)
+
+
+def write_folded(counts, name, directory=PROFILE_DIRECTORY):
+    # Collapsed stack format, one "frame;frame;frame count" line per stack. Render
+    # it with flamegraph.pl or load it in speedscope
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{time.strftime("%Y%m%d-%H%M%S")}-{name}.folded')
+    with open(path, 'w') as f:
+        for stack, count in counts.most_common():
+            f.write(f'{stack} {count}\n')
+    return path
+
+
+def init_profiler(app):
+    if not PROFILE_SLOW_MS and not PROFILE_ALLOW_HEADER:
+        return
+
+    sampler = StackSampler()
+    sampler.start()
+
+    @app.before_request
+    def start_profile():
+        g.profile_started = time.perf_counter()
+
+    @app.after_request
+    def dump_profile(response):
+        started = g.pop('profile_started', None)
+        if started is None:
+            return response
+
+        finished = time.perf_counter()
+        elapsed_ms = (finished - started) * 1000
+        requested = PROFILE_ALLOW_HEADER and request.headers.get(PROFILE_HEADER) == '1'
+        if requested or (PROFILE_SLOW_MS and elapsed_ms >= PROFILE_SLOW_MS):
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            name = f'{request.method}-{re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_")}-{elapsed_ms:.0f}ms'
+            path = write_folded(sampler.collect(started, finished), name)
+            print(f"Slow request {request.method} {request.path} took {elapsed_ms:.0f} ms, stacks in {path}")
+            if requested:
+                response.headers['X-Profile-File'] = path
+        return response
@@ -0,0 +1,172 @@
+from weather_db import connect_db, disconnect_db, run_on_db_sync
+from weather_cache import history_cache
+from datetime import timedelta
+import argparse
+import os
+import threading
+import time
+
+# Off unless set: GET /weather/city/<city> and the exports only read raw readings,
+# so rolled-up days disappear from them
+RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', 0))
+HOURLY_RETENTION_DAYS = int(os.getenv('HOURLY_RETENTION_DAYS', 365))
+RETENTION_INTERVAL_SECONDS = float(os.getenv('RETENTION_INTERVAL_SECONDS', 3600))
+# The first run waits this long after startup, so it does not compete with the
+# first requests of a new worker
+RETENTION_START_DELAY = float(os.getenv('RETENTION_START_DELAY', 60))
+VACUUM_PAGES = int(os.getenv('VACUUM_PAGES', 2000))
+# A day is rolled up and deleted in one transaction, Prisma's default of 5 seconds
+# is too short for busy days
+ROLLUP_TIMEOUT = timedelta(seconds=float(os.getenv('ROLLUP_TIMEOUT_SECONDS', 300)))
+
+HOUR_MS = 60 * 60 * 1000
+DAY_MS = 24 * HOUR_MS
+ROLLUP_TABLES = {'WeatherHourly': HOUR_MS, 'WeatherDaily': DAY_MS}
+ROLLUP_FIELDS = ('temperature', 'feels_like', 'humidity', 'pressure')
+
+
+def rollup_sql(table, bucket_ms):
+    # Upsert so that late readings for an already rolled-up bucket are merged into it
+    columns = ', '.join(f'"{field}_{stat}"' for field in ROLLUP_FIELDS for stat in ('min', 'max', 'mean'))
+    aggregates = ', '.join(f'MIN("{field}"), MAX("{field}"), AVG("{field}")' for field in ROLLUP_FIELDS)
+    updates = ',\n'.join(
+        f'''"{field}_min" = MIN("{field}_min", excluded."{field}_min"),
+            "{field}_max" = MAX("{field}_max", excluded."{field}_max"),
+            "{field}_mean" = ("{field}_mean" * "samples" + excluded."{field}_mean" * excluded."samples") / ("samples" + excluded."samples")'''
+        for field in ROLLUP_FIELDS
+    )
+    return f'''
+        INSERT INTO "{table}" ("city_name", "bucket_start", "samples", {columns})
+        SELECT "city_name", ("timestamp" / {bucket_ms}) * {bucket_ms}, COUNT(*), {aggregates}
+        FROM "WeatherData"
+        WHERE "timestamp" >= ? AND "timestamp" < ?
+        GROUP BY "city_name", "timestamp" / {bucket_ms}
+        ON CONFLICT ("city_name", "bucket_start") DO UPDATE SET
+            {updates},
+            "samples" = "samples" + excluded."samples"
+    '''
+
+
+def rollup_query(bucket_ms, city, start_ms, end_ms):
+    # Rolled-up rows of one city for a range: the daily table for day buckets, the
+    # hourly table otherwise, completed by daily rows older than the hourly table
+    # keeps. Returns the SQL and its parameters.
+    daily = 'SELECT * FROM "WeatherDaily" WHERE "city_name" = ? AND "bucket_start" >= ? AND "bucket_start" <= ?'
+    if bucket_ms >= DAY_MS:
+        return daily, (city, start_ms, end_ms)
+    return f'''
+        SELECT * FROM "WeatherHourly" WHERE "city_name" = ? AND "bucket_start" >= ? AND "bucket_start" <= ?
+        UNION ALL
+        {daily} AND "bucket_start" < (
+            SELECT COALESCE(MIN("bucket_start") / {DAY_MS} * {DAY_MS}, ?) FROM "WeatherHourly" WHERE "city_name" = ?
+        )
+    ''', (city, start_ms, end_ms, city, start_ms, end_ms, end_ms + 1, city)
+
+
+def retention_cutoff(now_ms, days):
+    # Day aligned, so hourly and daily buckets are never split between raw and rolled-up rows
+    return (now_ms // DAY_MS - days) * DAY_MS
+
+
+async def roll_up_day(db, day_start):
+    async with db.tx(timeout=ROLLUP_TIMEOUT) as transaction:
+        for table, bucket_ms in ROLLUP_TABLES.items():
+            await transaction.execute_raw(rollup_sql(table, bucket_ms), day_start, day_start + DAY_MS)
+        return await transaction.execute_raw(
+            'DELETE FROM "WeatherData" WHERE "timestamp" >= ? AND "timestamp" < ?',
+            day_start, day_start + DAY_MS,
+        )
+
+
+async def oldest_reading(db):
+    rows = await db.query_raw('SELECT MIN("timestamp") + 0 AS "oldest" FROM "WeatherData"')
+    return rows[0]['oldest'] if rows else None
+
+
+async def incremental_vacuum(db, pages):
+    # Gives back at most `pages` free pages to the file system, does nothing until
+    # enable_incremental_vacuum has been run once
+    await db.query_raw(f'PRAGMA incremental_vacuum({int(pages)})')
+
+
+async def enable_incremental_vacuum(db):
+    # auto_vacuum can only be switched on by a full VACUUM, which rewrites the whole
+    # file: run it once from the command line, not from the server
+    await db.execute_raw('PRAGMA auto_vacuum = INCREMENTAL')
+    await db.execute_raw('VACUUM')
+
+
+def run_retention(raw_days=RETENTION_DAYS, hourly_days=HOURLY_RETENTION_DAYS, vacuum_pages=VACUUM_PAGES):
+    # Rolls readings older than raw_days into the hourly and daily tables one day per
+    # transaction, oldest first, then drops hourly rows older than hourly_days
+    now_ms = int(time.time() * 1000)
+    cutoff = retention_cutoff(now_ms, raw_days)
+    rolled_up = 0
+    while True:
+        oldest = run_on_db_sync(oldest_reading)
+        if oldest is None or oldest >= cutoff:
+            break
+        day_start = (oldest // DAY_MS) * DAY_MS
+        rolled_up += run_on_db_sync(lambda db: roll_up_day(db, day_start))
+        history_cache.invalidate_before(day_start + DAY_MS)
+
+    hourly_cutoff = retention_cutoff(now_ms, hourly_days)
+    hourly_pruned = run_on_db_sync(lambda db: db.execute_raw(
+        'DELETE FROM "WeatherHourly" WHERE "bucket_start" < ?', hourly_cutoff,
+    ))
+    if rolled_up or hourly_pruned:
+        run_on_db_sync(lambda db: incremental_vacuum(db, vacuum_pages))
+    print(f"Retention: rolled up {rolled_up} readings, pruned {hourly_pruned} hourly rows")
+    return rolled_up, hourly_pruned
+
+
+class RetentionJob:
+    # Runs run_retention every RETENTION_INTERVAL_SECONDS in the background.
+    # should_run lets several workers agree on a single one doing it.
+    def __init__(self, socketio, interval=RETENTION_INTERVAL_SECONDS, should_run=None, start_delay=RETENTION_START_DELAY):
+        self.socketio = socketio
+        self.interval = interval
+        self.start_delay = start_delay
+        self.should_run = should_run
+        self._wakeup = threading.Event()
+        self._running = False
+
+    def start(self):
+        if self._running or self.interval <= 0 or RETENTION_DAYS <= 0:
+            return
+        self._running = True
+        self.socketio.start_background_task(self._run)
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+
+    def _run(self):
+        self._wakeup.wait(self.start_delay)
+        while self._running:
+            if self.should_run is None or self.should_run():
+                try:
+                    run_retention()
+                except Exception as e:
+                    print(f"Error running retention: {e}")
+            self._wakeup.wait(self.interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Roll old readings into hourly and daily tables once, e.g. from cron')
+    parser.add_argument('--days', type=int, default=RETENTION_DAYS, help='days of raw readings to keep')
+    parser.add_argument('--hourly-days', type=int, default=HOURLY_RETENTION_DAYS, help='days of hourly rows to keep')
+    parser.add_argument('--vacuum-pages', type=int, default=VACUUM_PAGES)
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help='switch the database to incremental auto_vacuum first, runs a full VACUUM')
+    args = parser.parse_args()
+    if args.days <= 0:
+        parser.error('retention is off: set RETENTION_DAYS or pass --days')
+    connect_db()
+    try:
+        if args.enable_incremental_vacuum:
+            print("Switching the database to incremental auto_vacuum, running a full VACUUM")
+            run_on_db_sync(enable_incremental_vacuum)
+        run_retention(args.days, args.hourly_days, args.vacuum_pages)
+    finally:
+        disconnect_db()
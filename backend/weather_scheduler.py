@@ -0,0 +1,112 @@
+import heapq
+import math
+import os
+
+# Default interval of a station, stations can set their own (Station.interval_seconds)
+IMPORT_INTERVAL_SECONDS = float(os.getenv('IMPORT_INTERVAL_SECONDS', 300))
+# The importer looks for due stations every TICK seconds and reads the station
+# table again every STATION_REFRESH seconds
+IMPORT_TICK_SECONDS = float(os.getenv('IMPORT_TICK_SECONDS', 1))
+STATION_REFRESH_SECONDS = float(os.getenv('STATION_REFRESH_SECONDS', 60))
+# A station that has not reported a new observation for more than two intervals
+# is fetched less often, up to this many times less, until it reports one
+IMPORT_MAX_BACKOFF = int(os.getenv('IMPORT_MAX_BACKOFF', 4))
+
+GOLDEN_RATIO = (math.sqrt(5) - 1) / 2
+
+
+def station_phase(station_id, interval):
+    # Offset of a station in its interval. Consecutive ids land far apart
+    # (a golden ratio sequence), so fetches are spread evenly over the interval
+    # however many stations there are, and adding one does not move the others.
+    return (station_id * GOLDEN_RATIO) % 1 * interval
+
+
+def next_slot(now, phase, interval):
+    # First time after now that is `phase` seconds into an interval
+    return (math.floor((now - phase) / interval) + 1) * interval + phase
+
+
+class StationScheduler:
+    # Next fetch time of every enabled station, in a heap so that a tick only
+    # looks at the stations that are due. Each station keeps the same slot in its
+    # interval, restarts included. `observed` tells which readings are new: the
+    # provider's `dt` is compared with the last one stored for the station.
+    def __init__(self, max_backoff=IMPORT_MAX_BACKOFF):
+        self.max_backoff = max_backoff
+        self.last_observed = {}
+        self._changed_at = {}
+        self._stations = {}
+        self._next = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self._stations)
+
+    def update(self, stations, now):
+        # stations are Station rows; stations that are gone or disabled are
+        # forgotten, new ones and those whose interval changed are (re)scheduled
+        stations = {station.name: station for station in stations}
+        for name in list(self._stations):
+            if name not in stations:
+                del self._stations[name]
+                self._next.pop(name, None)
+                self._changed_at.pop(name, None)
+
+        for name, station in stations.items():
+            previous = self._stations.get(name)
+            self._stations[name] = station
+            if station.last_observed_dt is not None and name not in self.last_observed:
+                self.last_observed[name] = station.last_observed_dt
+            if previous is None:
+                self._changed_at[name] = now
+            if previous is None or previous.interval_seconds != station.interval_seconds:
+                self._schedule(name, now)
+
+    def interval(self, name):
+        return self._stations[name].interval_seconds or IMPORT_INTERVAL_SECONDS
+
+    def backoff(self, name, now):
+        # Measured from when this process saw the observation change, the
+        # provider's dt can be well behind the time it is published
+        changed_at = self._changed_at.get(name)
+        if changed_at is None:
+            return 1
+        return max(1, min(self.max_backoff, int((now - changed_at) / (2 * self.interval(name)))))
+
+    def _schedule(self, name, now):
+        station = self._stations[name]
+        interval = self.interval(name)
+        # Slots skipped by a station whose observations are not updated
+        later = (self.backoff(name, now) - 1) * interval
+        due = next_slot(now + later, station_phase(station.id, interval), interval)
+        self._next[name] = due
+        heapq.heappush(self._heap, (due, name))
+
+    def next_due(self):
+        while self._heap and self._next.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        # Stations due at `now`, already scheduled for their next slot
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            at, name = heapq.heappop(self._heap)
+            if self._next.get(name) != at:
+                continue
+            due.append(self._stations[name])
+            self._schedule(name, now)
+        return due
+
+    def observed(self, name, dt, now):
+        # True when the reading of `name` taken at `dt` (epoch seconds) has not
+        # been stored yet. Readings without a dt are always new.
+        last = self.last_observed.get(name)
+        if dt is None:
+            return True
+        if last is not None and dt <= last:
+            return False
+        self.last_observed[name] = dt
+        self._changed_at[name] = now
+        return True
@@ -0,0 +1,68 @@
+from flask.json.provider import DefaultJSONProvider
+from weather_metrics import serialization_duration
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+WEATHER_COLUMNS = ('id', 'city_name', 'latitude', 'longitude', 'temperature', 'feels_like', 'humidity', 'pressure', 'description', 'timestamp')
+RESPONSE_FORMATS = ('rows', 'columnar')
+
+
+def format_timestamps(values):
+    # Same output as strftime("%Y-%m-%d %H:%M:%S"). The importer writes every city
+    # of a cycle with the same timestamp, so each distinct value is formatted once
+    formatted = {value: value.isoformat(' ', 'seconds')[:19] for value in set(values)}
+    return [formatted[value] for value in values]
+
+
+def weather_columns(records):
+    # One list per column, read attribute by attribute instead of row by row
+    columns = {name: [getattr(record, name) for record in records] for name in WEATHER_COLUMNS}
+    columns['timestamp'] = format_timestamps(columns['timestamp'])
+    return columns
+
+
+def weather_tuples(records):
+    return list(zip(*weather_columns(records).values())) if records else []
+
+
+def weather_dicts(records):
+    with serialization_duration.time(stage='rows'):
+        return [dict(zip(WEATHER_COLUMNS, row)) for row in weather_tuples(records)]
+
+
+def serialize_weather(records, response_format='rows'):
+    if response_format == 'columnar':
+        with serialization_duration.time(stage='columnar'):
+            return weather_columns(records)
+    return weather_dicts(records)
+
+
+def dumps(value):
+    # Bytes ready to be written to a response, through orjson when it is installed
+    with serialization_duration.time(stage='json'):
+        if orjson is not None:
+            return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(value, separators=(',', ':')).encode()
+
+
+class WeatherJSONProvider(DefaultJSONProvider):
+    # Compact jsonify through orjson when it is installed, without sorting keys
+    sort_keys = False
+    compact = True
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        with serialization_duration.time(stage='json'):
+            if orjson is None:
+                return super().response(obj)
+            body = orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS)
+        return self._app.response_class(body, mimetype=self.mimetype)
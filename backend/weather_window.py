@@ -0,0 +1,259 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+from weather_cache import row_timestamp_ms
+import os
+import threading
+import time
+
+HOT_WINDOW_HOURS = float(os.getenv('HOT_WINDOW_HOURS', 24))
+# Rows written by other processes are picked up every REFRESH seconds; the whole
+# window is read again every RELOAD seconds for their updates and deletes
+HOT_WINDOW_REFRESH_SECONDS = float(os.getenv('HOT_WINDOW_REFRESH_SECONDS', 2))
+HOT_WINDOW_RELOAD_SECONDS = float(os.getenv('HOT_WINDOW_RELOAD_SECONDS', 900))
+
+# Column name and array typecode, 60 bytes per reading. Timestamps are kept in
+# epoch milliseconds rounded down to the second.
+COLUMNS = (
+    ('timestamp', 'q'), ('id', 'q'), ('latitude', 'd'), ('longitude', 'd'), ('temperature', 'd'),
+    ('feels_like', 'd'), ('humidity', 'i'), ('pressure', 'i'), ('description', 'i'),
+)
+ROW_COLUMNS = ('id', 'city_name', 'latitude', 'longitude', 'temperature', 'feels_like', 'humidity', 'pressure', 'description', 'timestamp')
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def format_timestamps(values):
+    # Same output as weather_data_to_dict, each distinct value formatted once
+    formatted = {
+        value: datetime.fromtimestamp(value / 1000, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        for value in set(values)
+    }
+    return [formatted[value] for value in values]
+
+
+class CityReadings:
+    # Readings of one city in (timestamp, id) order, one typed array per column.
+    # Used as a ring: readings leaving the window only move `start` forward, the
+    # arrays are compacted once the dropped part is as large as what is left.
+    def __init__(self):
+        self.start = 0
+        self.columns = {name: array(typecode) for name, typecode in COLUMNS}
+
+    def __len__(self):
+        return len(self.columns['id']) - self.start
+
+    def nbytes(self):
+        return sum(values.itemsize * len(values) for values in self.columns.values())
+
+    def _position(self, timestamp, row_id):
+        timestamps, ids = self.columns['timestamp'], self.columns['id']
+        position = bisect_left(timestamps, timestamp, self.start)
+        while position < len(ids) and timestamps[position] == timestamp and ids[position] < row_id:
+            position += 1
+        return position
+
+    def _matches(self, position, timestamp, row_id):
+        return position < len(self.columns['id']) and self.columns['timestamp'][position] == timestamp \
+            and self.columns['id'][position] == row_id
+
+    def insert(self, values):
+        # values holds one item per column. Returns False when the id is already there
+        position = self._position(values['timestamp'], values['id'])
+        if self._matches(position, values['timestamp'], values['id']):
+            return False
+        if position == len(self.columns['id']):
+            for name, column in self.columns.items():
+                column.append(values[name])
+        else:
+            for name, column in self.columns.items():
+                column.insert(position, values[name])
+        return True
+
+    def remove(self, timestamp, row_id):
+        position = self._position(timestamp, row_id)
+        if not self._matches(position, timestamp, row_id):
+            return False
+        for column in self.columns.values():
+            del column[position]
+        return True
+
+    def trim(self, cutoff_ms):
+        self.start = bisect_left(self.columns['timestamp'], cutoff_ms, self.start)
+        if self.start and self.start >= len(self):
+            for column in self.columns.values():
+                del column[:self.start]
+            self.start = 0
+
+    def between(self, start_ms, end_ms=None):
+        timestamps = self.columns['timestamp']
+        first = bisect_left(timestamps, start_ms, self.start)
+        last = bisect_right(timestamps, end_ms, first) if end_ms is not None else len(timestamps)
+        return first, last
+
+
+class HotWindow:
+    # The last `hours` of readings of every city, held in typed arrays instead of
+    # one Python object per reading. Kept up to date by the write services and the
+    # change feed, and by refresh_hot_window for rows written by other processes
+    # (the importer, other workers) through `last_id`.
+    #
+    # Answers a city range only when it starts inside the window, everything older
+    # stays with the database.
+    def __init__(self, hours=HOT_WINDOW_HOURS):
+        self.span_ms = int(hours * 3600 * 1000)
+        self.last_id = None
+        self.loaded_at = None
+        self.refreshed_at = None
+        self._cities = {}
+        self._descriptions = []
+        self._description_ids = {}
+        self._pending = None
+        self._lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+
+    @property
+    def is_loaded(self):
+        return self.loaded_at is not None
+
+    def cutoff_ms(self):
+        return now_ms() - self.span_ms
+
+    def covers(self, start_ms):
+        return self.is_loaded and start_ms is not None and start_ms >= self.cutoff_ms()
+
+    def _description_id(self, description):
+        description_id = self._description_ids.get(description)
+        if description_id is None:
+            description_id = self._description_ids[description] = len(self._descriptions)
+            self._descriptions.append(description)
+        return description_id
+
+    def _insert(self, cities, row, timestamp, cutoff):
+        # Whole seconds, like the formatted rows the services hand over
+        timestamp -= timestamp % 1000
+        if timestamp < cutoff:
+            return
+        city = cities.get(row['city_name'])
+        if city is None:
+            city = cities[row['city_name']] = CityReadings()
+        city.insert({
+            'timestamp': timestamp, 'id': row['id'], 'latitude': row['latitude'], 'longitude': row['longitude'],
+            'temperature': row['temperature'], 'feels_like': row['feels_like'], 'humidity': int(row['humidity']),
+            'pressure': int(row['pressure']), 'description': self._description_id(row['description']),
+        })
+
+    def _remove(self, cities, row, timestamp):
+        city = cities.get(row['city_name'])
+        if city is not None and city.remove(timestamp - timestamp % 1000, row['id']):
+            if not len(city):
+                del cities[row['city_name']]
+
+    def add_rows(self, rows):
+        # Formatted rows, as returned by the services
+        with self._lock:
+            if not self.is_loaded and self._pending is None:
+                return
+            cutoff = self.cutoff_ms()
+            for row in rows:
+                timestamp = row_timestamp_ms(row)
+                self._insert(self._cities, row, timestamp, cutoff)
+                if self._pending is not None:
+                    self._pending.append(('add', row, timestamp))
+
+    def remove_rows(self, rows):
+        with self._lock:
+            for row in rows:
+                timestamp = row_timestamp_ms(row)
+                self._remove(self._cities, row, timestamp)
+                if self._pending is not None:
+                    self._pending.append(('remove', row, timestamp))
+
+    def begin_sync(self):
+        # Writes seen from now on are replayed on top of the rows being read, in
+        # case one of them was read before the write
+        with self._lock:
+            self._pending = []
+
+    def finish_sync(self, rows, last_id, reload=False):
+        # Rows read from the database, with the epoch milliseconds timestamp as
+        # stored. A reload replaces the window, otherwise they are added to it.
+        cutoff = self.cutoff_ms()
+        with self._lock:
+            cities = {} if reload else self._cities
+            for row in rows:
+                self._insert(cities, row, row['timestamp'], cutoff)
+            for operation, row, timestamp in self._pending or ():
+                if operation == 'add':
+                    self._insert(cities, row, timestamp, cutoff)
+                else:
+                    self._remove(cities, row, timestamp)
+            self._cities = cities
+            self._pending = None
+            self.last_id = last_id
+            self.refreshed_at = time.monotonic()
+            if reload:
+                self.loaded_at = self.refreshed_at
+
+    def abort_sync(self):
+        with self._lock:
+            self._pending = None
+
+    def trim(self):
+        with self._lock:
+            cutoff = self.cutoff_ms()
+            for name, city in list(self._cities.items()):
+                city.trim(cutoff)
+                if not len(city):
+                    del self._cities[name]
+
+    def find(self, city_name, start_ms, end_ms=None, response_format='rows'):
+        # Readings of a city between start_ms and end_ms (open when None), in the
+        # shape serialize_weather gives them. None when the range is not covered.
+        with self._lock:
+            if not self.covers(start_ms):
+                return None
+            city = self._cities.get(city_name)
+            if city is None:
+                first = last = 0
+                columns = {name: [] for name, _ in COLUMNS}
+            else:
+                first, last = city.between(start_ms, end_ms)
+                columns = {name: values[first:last].tolist() for name, values in city.columns.items()}
+            descriptions = self._descriptions
+            columns['description'] = [descriptions[description_id] for description_id in columns['description']]
+        columns['timestamp'] = format_timestamps(columns['timestamp'])
+        columns['city_name'] = [city_name] * (last - first)
+        columns = {name: columns[name] for name in ROW_COLUMNS}
+        if response_format == 'columnar':
+            return columns
+        return [dict(zip(ROW_COLUMNS, row)) for row in zip(*columns.values())]
+
+    def latest(self, city_name):
+        # Latest reading of a city when it has one in the window: any other one is older
+        with self._lock:
+            city = self._cities.get(city_name) if self.is_loaded else None
+            if city is None or not len(city):
+                return None
+            row = {name: values[-1] for name, values in city.columns.items()}
+            row['description'] = self._descriptions[row['description']]
+        row['timestamp'] = format_timestamps([row['timestamp']])[0]
+        row['city_name'] = city_name
+        return {name: row[name] for name in ROW_COLUMNS}
+
+    def stats(self):
+        with self._lock:
+            readings = sum(len(city) for city in self._cities.values())
+            return {
+                'loaded': self.is_loaded,
+                'hours': self.span_ms / 3600000,
+                'cities': len(self._cities),
+                'readings': readings,
+                'bytes': sum(city.nbytes() for city in self._cities.values()),
+                'last_id': self.last_id,
+            }
+
+
+hot_window = HotWindow()
@@ -1,5 +1,5 @@
 import { io } from 'socket.io-client'
-import {useCallback, useEffect, useState} from "react";
+import {useEffect, useMemo, useRef, useState} from "react";
 import { AreaChart, EventProps } from '@tremor/react';
 import {
     Select,
@@ -50,6 +50,22 @@ type WeatherData = {
     timestamp: string
 }
 
+// Events the server coalesced, as [event, data] pairs in the order they happened.
+// Large frames carry the zlib-compressed JSON of that list instead.
+type BatchFrame = {
+    events?: [string, unknown][]
+    deflate?: ArrayBuffer
+    dropped: number
+}
+
+const readBatch = async (frame: BatchFrame): Promise<[string, unknown][]> => {
+    if (!frame.deflate) {
+        return frame.events ?? [];
+    }
+    const stream = new Blob([frame.deflate]).stream().pipeThrough(new DecompressionStream('deflate'));
+    return JSON.parse(await new Response(stream).text());
+}
+
 const formSchema = z.object({
     city_name: z.string(),
     temperature: z.string(),
@@ -64,7 +80,17 @@ export const Dashboard = () => {
     const [selectedCity, setSelectedCity] = useState<string>('Paris');
     const [startDate, setStartDate] = useState<Date>()
     const [endDate, setEndDate] = useState<Date>()
-    const socket = io('http://localhost:8080/data')
+    // Bumped to load the data again when the server dropped events for this client
+    const [reloadKey, setReloadKey] = useState(0)
+    // Highest row id received, sent back on reconnect so the server only replays what was missed
+    const lastSeq = useRef<number | null>(null)
+    const subscribedCity = useRef<string>(selectedCity)
+    const socket = useMemo(() => io('http://localhost:8080/data', {
+        auth: (cb) => cb({
+            cities: [subscribedCity.current],
+            ...(lastSeq.current === null ? {} : {since: lastSeq.current}),
+        }),
+    }), [])
     const navigate = useNavigate();
     const {logout} = useAuth();
     const {getItem} = useLocalStorage();
@@ -72,44 +98,96 @@ export const Dashboard = () => {
     const [sheetIsOpen, setSheetIsOpen] = useState(false);
     const [selectedData, setSelectedData] = useState<EventProps | null>(null);
 
-    socket.on('connect', () => {
-        console.log('connected')
-    })
-
-    const handleSocketData = useCallback((data: WeatherData[]) => {
-        const filteredData = data.filter((d: WeatherData) => d.city_name === selectedCity);
-        setWeatherData((prevData) => [...prevData, ...filteredData]);
-    }, [selectedCity]);
-
     useEffect(() => {
-        socket.on('latest_data', handleSocketData);
         return () => {
-            socket.off('latest_data', handleSocketData);
+            socket.disconnect();
         };
-    }, [socket, handleSocketData]);
+    }, [socket]);
 
-    socket.on('send_newdata', (data) => {
-        setWeatherData((prevData) => [...prevData, data]);
-    })
+    useEffect(() => {
+        const trackSeq = (data: WeatherData[]) => {
+            data.forEach((d) => {
+                lastSeq.current = Math.max(lastSeq.current ?? 0, d.id);
+            });
+        }
+
+        const addRows = (prevData: WeatherData[], data: WeatherData[]) => {
+            trackSeq(data);
+            return [...prevData, ...data.filter((d: WeatherData) => d.city_name === selectedCity)];
+        }
+
+        const editRow = (prevData: WeatherData[], updatedData: WeatherData) => {
+            if (updatedData.city_name !== selectedCity) {
+                return prevData.filter((data) => data.id !== updatedData.id);
+            }
+            return prevData.map((data) => data.id === updatedData.id ? updatedData : data);
+        }
 
-    socket.on('edit_data', (updatedData) => {
-        setWeatherData((prevData) => {
-            const newData = prevData.map((data) => {
-                if (data.id === updatedData.id) {
-                    return updatedData;
+        const deleteRow = (prevData: WeatherData[], id: number) => prevData.filter((data) => data.id !== id);
+
+        const applyEvent = (prevData: WeatherData[], [event, data]: [string, unknown]) => {
+            switch (event) {
+                case 'send_newdata':
+                    return addRows(prevData, [data as WeatherData]);
+                case 'send_newdata_batch':
+                    return addRows(prevData, data as WeatherData[]);
+                case 'edit_data':
+                    return editRow(prevData, data as WeatherData);
+                case 'delete_data':
+                    return deleteRow(prevData, data as number);
+                default:
+                    return prevData;
+            }
+        }
+
+        const handleSocketData = (data: WeatherData[]) => setWeatherData((prevData) => addRows(prevData, data));
+        const handleNewData = (data: WeatherData) => handleSocketData([data]);
+        const handleEditData = (updatedData: WeatherData) => setWeatherData((prevData) => editRow(prevData, updatedData));
+        const handleDeleteData = (id: number) => setWeatherData((prevData) => deleteRow(prevData, id));
+        // Sent instead of the missed rows when there are too many to replay
+        const handleReload = () => setReloadKey((key) => key + 1);
+
+        // Frames are applied one after the other, in one state update each, and
+        // acknowledged once applied so that the server sends the next ones
+        let frames = Promise.resolve();
+        const handleBatch = (frame: BatchFrame, ack?: () => void) => {
+            frames = frames.then(async () => {
+                try {
+                    const events = await readBatch(frame);
+                    setWeatherData((prevData) => events.reduce(applyEvent, prevData));
+                    if (frame.dropped > 0) {
+                        setReloadKey((key) => key + 1);
+                    }
+                } catch (error) {
+                    toast((error as Error).message);
+                } finally {
+                    ack?.();
                 }
-                return data;
             });
-            return newData;
-        });
-    });
+        }
 
-    socket.on('delete_data', (id) => {
-        setWeatherData((prevData) => {
-            const newData = prevData.filter((data) => data.id !== id);
-            return newData;
-        });
-    });
+        // The server only sends events for the cities a client subscribed to
+        subscribedCity.current = selectedCity;
+        socket.emit('subscribe', {cities: [selectedCity]});
+
+        socket.on('latest_data', handleSocketData);
+        socket.on('send_newdata', handleNewData);
+        socket.on('send_newdata_batch', handleSocketData);
+        socket.on('edit_data', handleEditData);
+        socket.on('delete_data', handleDeleteData);
+        socket.on('batch', handleBatch);
+        socket.on('reload', handleReload);
+        return () => {
+            socket.emit('unsubscribe', {cities: [selectedCity]});
+            socket.off('latest_data', handleSocketData);
+            socket.off('send_newdata', handleNewData);
+            socket.off('send_newdata_batch', handleSocketData);
+            socket.off('edit_data', handleEditData);
+            socket.off('delete_data', handleDeleteData);
+            socket.off('batch', handleBatch);
+            socket.off('reload', handleReload);
+        };
+    }, [socket, selectedCity]);
 
     useEffect(() => {
         const fetchWeatherData = async () => {
@@ -148,7 +226,7 @@ export const Dashboard = () => {
         };
 
         fetchWeatherData();
-    }, [selectedCity, startDate, endDate]);
+    }, [selectedCity, startDate, endDate, reloadKey]);
 
 
     const formatData = (data: WeatherData[]) => {